@@ -5,6 +5,8 @@
         - use forward slashes '/' to specify paths in arguments
         - the path to the QGIS project must exist. however the project file itself doesn't have to exist
         - path to .json file must exist
+        - the .json file is only read. the layer is edited in memory and saved as <project>_layer.gpkg
+            next to the project file
 
     ToDo items:
         - create path to QGIS project if it doesn't exist already
@@ -15,7 +17,6 @@
 """
 import os
 import logging
-from shutil import copyfile
 from qgis.core import *
 from qgis.PyQt import QtGui
 from PyQt5.QtCore import Qt as qt5
@@ -23,6 +24,17 @@ from pathlib import Path
 from dotenv import load_dotenv
 from datetime import datetime
 import layout_utils as utils
+import layout_metrics
+import classification
+import schema
+import transforms
+import tracing
+import tile_cache
+import basemap_cache
+import output_cache
+import layout_templates
+import inset_maps
+import tiled_export
 
 # Identify environment variable file
 env_path = Path('.') / 'qgis_variables.env'
@@ -53,9 +65,12 @@ ACRE_STRING = 'Area (ac)'
 DEFAULT_CONTENT_SIZE = 9 # mm??
 DEFAULT_COL_WIDTH = 45  # mm
 MAX_TABLE_HEIGHT = 480  # mm
+PREVIEW_DPI = 16  # A1 page is ~530 px wide
+PREVIEW_WARNINGS = set()  # warnings logged by previews of this process, previews are rebuilt on every option change
+QGIS_APP = None  # QgsApplication, created once per process by init_qgis()
 
 
-def get_args():
+def get_parser():
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--file", required=True, type=str,
@@ -74,10 +89,46 @@ def get_args():
                         help="variable to colour code map")
     parser.add_argument("--label_data", type=str,
                         help="data column to create labels out of")
+    parser.add_argument("--color_codes", nargs="+",
+                        help="export one map per colour code variable from a single layout, replaces --color_code")
+    parser.add_argument("--label_variables", nargs="+",
+                        help="label data column for each of --color_codes, or one for all of them")
+    parser.add_argument("--classes", type=int, default=classification.DEFAULT_CLASSES,
+                        help="number of classes when colour coding a continuous variable")
+    parser.add_argument("--classification", type=str, choices=list(classification.METHODS),
+                        help="method used to classify a continuous variable for colour coding, "
+                             "default is natural breaks for P and K and equal interval otherwise")
     parser.add_argument("--area_acres", type=bool,
                         help="display area in acres in table")
     parser.add_argument("--pdf", type=str, help="path to .pdf file to export layout to")
-    return parser.parse_args()
+    parser.add_argument("--raster", type=str,
+                        help="path to .tif or .png file to export layout to, rendered in strips with bounded memory")
+    parser.add_argument("--dpi", type=int, default=tiled_export.DEFAULT_DPI,
+                        help="resolution of --raster export")
+    parser.add_argument("--preview", type=str,
+                        help="path to .png file to write a low resolution preview of the first map to, "
+                             "without fetching the basemap or saving the project")
+    parser.add_argument("--tile_cache", type=str,
+                        help="optional MBTiles basemap cache (see tile_cache.py) to use instead of fetching tiles")
+    parser.add_argument("--basemap_cache", type=str,
+                        help="optional directory of rendered basemaps, reused by maps with the same extent and size")
+    parser.add_argument("--cache_dir", type=str,
+                        help="optional directory of cached outputs, unchanged farms are copied from it")
+    parser.add_argument("--max_cache_size", type=int, default=output_cache.DEFAULT_MAX_SIZE // 1024 ** 2,
+                        help="maximum size of output cache in MB")
+    parser.add_argument("--force", action="store_true",
+                        help="build layout even if its outputs are cached")
+    parser.add_argument("--template", type=str, default=layout_templates.DEFAULT_SPEC,
+                        help="layout spec (.json) the layout template is compiled from, see layout_templates.py")
+    parser.add_argument("--report", type=str,
+                        help="optional path to write a .json report of stage timings, counts and peak memory to")
+    parser.add_argument("--daemon", action="store_true",
+                        help="submit layout to a running render daemon (render_daemon.py) instead of starting QGIS")
+    return parser
+
+
+def get_args():
+    return get_parser().parse_args()
 
 
 """
@@ -88,23 +139,58 @@ def get_args():
 
 
 def get_table_fields(arguments):
+    """
+    get names of layer fields to display in table. headings come from field aliases
+    :param arguments:
+    :return: list of field names
+    """
     json_fields = ['name', 'referenceArea_ha']  # default fields always present in table
 
     if arguments.table_fields is not None:
         for item in arguments.table_fields:
             json_fields.append(item)
 
-    # convert to UI names
-    UI_names = []
-    for name in json_fields:
-        UI_names.append(JSON_TO_UI_DICT[name])
-
+    # area in acres is a virtual field, see layout_utils.set_display_fields()
     if arguments.area_acres:
-        index = UI_names.index(HECTARE_STRING)
-        UI_names.pop(index)
-        UI_names.insert(index, ACRE_STRING)
+        index = json_fields.index('referenceArea_ha')
+        json_fields[index] = utils.ACRE_FIELD
+
+    return json_fields
 
-    return UI_names
+
+def get_variants(arguments):
+    """
+    get the (colour code, label data) pair of each map to export
+    :param arguments:
+    :return: list of (color_code, label_data) tuples
+    """
+    if not arguments.color_codes:
+        return [(arguments.color_code, arguments.label_data)]
+
+    labels = arguments.label_variables
+    if not labels:
+        labels = [arguments.label_data] * len(arguments.color_codes)
+    elif len(labels) == 1:
+        labels = labels * len(arguments.color_codes)
+    elif len(labels) != len(arguments.color_codes):
+        raise ValueError("give one label variable, or one for each colour code")
+
+    return list(zip(arguments.color_codes, labels))
+
+
+def get_variant_pdf_path(pdf, color_code, n_variants):
+    """
+    get pdf path for one variant. with more than one variant the colour code is added to the file name
+    :param pdf: path given in arguments
+    :param color_code:
+    :param n_variants: number of variants exported
+    :return: Path
+    """
+    pdf_path = Path(pdf)
+    if n_variants > 1:
+        pdf_path = pdf_path.with_name(pdf_path.stem + '_' + str(color_code) + pdf_path.suffix)
+
+    return pdf_path
 
 
 def get_layer(arguments, proj):
@@ -114,133 +200,132 @@ def get_layer(arguments, proj):
     :param proj:
     :return:
     """
-    # todo make copy of layer file so that it can be edited and not alter original
-    # create layer data file
-    original_path = Path(arguments.file)
-    layer_data = original_path.parent / Path(original_path.stem + '_qgis_layer' + original_path.suffix)
-    copyfile(original_path, layer_data)
-
     layout_name = "fields"
     if arguments.color_code:
         layout_name = JSON_TO_UI_DICT[arguments.color_code]
 
-    # create layer
-    layer = QgsVectorLayer(str(layer_data.resolve()), layout_name, "ogr")
+    # read input file, it is never edited
+    source = QgsVectorLayer(str(Path(arguments.file).resolve()), layout_name, "ogr")
 
-    layer, feature_count = modify_layer(layer, arguments)  # modify based on user args
-
-    if not layer.isValid():
+    if not source.isValid():
         logging.info("Layer failed to load!")
-    else:
-        proj.addMapLayer(layer)
+        return source, 0
 
-    return layer, feature_count
+    # stage features in a memory layer, data stays identical to the input
+    # layer is only written to disk when the project is saved, see save_layer()
+    layer = source.materialize(QgsFeatureRequest())
+    layer.setName(layout_name)
 
+    with tracing.span('modify'):
+        utils.set_display_fields(layer, arguments)  # display based on user args
 
-def modify_layer(l, a):
-    """
-    Method which modifies layer based on user input
-     - performs sorting of layer features based on 'name' attribute
-     - applies expressions to data
-     - rounds float values to 2 decimal places
-     - changes headings to UI friendly versions
-    :param l:
-    :param a: argument namespace
-    :return:
-    """
-    count = 0  # number of features in layer
-
-    with edit(l):
+    proj.addMapLayer(layer)
 
-        # UI friendly attribute names
-        for field in l.fields():
-            field_id = l.fields().indexFromName(field.name())
-            l.renameAttribute(field_id, JSON_TO_UI_DICT[field.name()])
+    return layer, layer.featureCount()
 
-        # convert area to acres
-        if a.area_acres:
-            field_id = l.fields().indexFromName(HECTARE_STRING)
-            l.renameAttribute(field_id, ACRE_STRING)
 
-            for feature in l.getFeatures():
-                feature.setAttribute(feature.fieldNameIndex(ACRE_STRING), feature[ACRE_STRING]*2.47105)
-                l.updateFeature(feature)
-
-        # round to two decimal places all feature attributes that will go into table
-        for feature in l.getFeatures():
-            count += 1  # iterate count
-            for name in get_table_fields(a):
-                if isinstance(feature[name], float):  # if a float value round to two decimal places
-                    feature.setAttribute(feature.fieldNameIndex(name), round(feature[name], 2))
-                    l.updateFeature(feature)
+def save_layer(l, project_path):
+    """
+    Write a staged memory layer to a GeoPackage next to the project file and point the layer at it,
+    so that the layer is kept when the project is saved
+    :param l: memory layer
+    :param project_path: path to .qgs file
+    :return: path to GeoPackage
+    """
+    gpkg_path = get_layer_path(project_path)
 
-        # sort based on field name
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.layerName = 'fields'
+    # virtual fields stay on the layer, only write data from provider
+    fields = l.fields()
+    options.attributes = [i for i in range(fields.count()) if fields.fieldOrigin(i) == QgsFields.OriginProvider]
+    error = QgsVectorFileWriter.writeAsVectorFormatV2(l, str(gpkg_path), QgsCoordinateTransformContext(), options)
+    if error[0] != QgsVectorFileWriter.NoError:
+        logging.info("Layer could not be saved: " + error[1])
+        return None
 
-    return l, count
+    # renderer and labels are kept since geometry type doesn't change
+    l.setDataSource(str(gpkg_path) + '|layername=fields', l.name(), 'ogr', QgsDataProvider.ProviderOptions())
 
+    return gpkg_path
 
-def get_layout(name, proj):
-    manager = proj.layoutManager()
 
-    # create a new layout
-    # todo customise this layout to match Farmeye template?
-    layout = QgsPrintLayout(proj)
-    layoutName = name
+def get_layer_path(project_path):
+    """
+    :param project_path: path to .qgs file
+    :return: path to GeoPackage the layer is saved to
+    """
+    project_path = Path(project_path)
+    return project_path.parent / (project_path.stem + '_layer.gpkg')
 
-    # remove duplicate layouts
-    layouts_list = manager.printLayouts()
-    for l in layouts_list:
-        if l.name() == layoutName:
-            manager.removeLayout(l)
 
-    # initializes default settings for blank print layout canvas
-    layout.initializeDefaults()
+def get_outputs(arguments):
+    """
+    get paths of all files written for a layout
+    :param arguments:
+    :return: list of paths
+    """
+    project_path = get_project_path(arguments.project_path)
+    outputs = [project_path, get_layer_path(project_path)]
+    outputs += [inset_maps.get_inset_path(project_path, i) for i in range(arguments.map_count - 1)]
 
-    # set layout size
-    pc = layout.pageCollection()
-    pc.pages()[0].setPageSize('A1', QgsLayoutItemPage.Orientation.Landscape)
+    if arguments.pdf is not None:
+        variants = get_variants(arguments)
+        outputs += [get_variant_pdf_path(arguments.pdf, code, len(variants)) for code, label_data in variants]
 
-    layout.setName(layoutName)
-    manager.addLayout(layout)
+    if arguments.raster is not None:
+        variants = get_variants(arguments)
+        outputs += [get_variant_pdf_path(arguments.raster, code, len(variants)) for code, label_data in variants]
 
-    return layout
+    return [str(o) for o in outputs]
 
 
-def get_rectangle(l, proj):
-    # get layer extents
-    ext = l.extent()  # QgsRectangle object
-    xmin = ext.xMinimum()  # floats
-    xmax = ext.xMaximum()
-    ymin = ext.yMinimum()
-    ymax = ext.yMaximum()
+def get_basemap_layer(cache_path=None):
+    """
+    get ESRI imagery layer, read from a local MBTiles cache if one is given.
+    the tile url can be overridden with the BASEMAP_URL environment variable, an empty BASEMAP_URL disables the basemap
+    :param cache_path: optional path to .mbtiles file filled by tile_cache.py
+    :return: raster layer, invalid if basemap is disabled
+    """
+    if cache_path is not None:
+        if Path(cache_path).exists():
+            return QgsRasterLayer(str(Path(cache_path).resolve()), 'ESRI', 'gdal')
+        logging.warning("tile cache {0} doesn't exist, fetching basemap from server".format(cache_path))
 
-    r_min = QgsPointXY(xmin, ymin)
-    r_max = QgsPointXY(xmax, ymax)
+    url = os.environ.get('BASEMAP_URL', tile_cache.DEFAULT_TILE_URL)
+    if url == '':
+        logging.info("basemap disabled by BASEMAP_URL")
+        return QgsRasterLayer()
 
-    rect = QgsRectangle(r_min, r_max)
+    return QgsRasterLayer('type=xyz&url=' + url, 'ESRI', 'wms')
 
-    src_crs = QgsCoordinateReferenceSystem(4326)
-    dest_crs = QgsCoordinateReferenceSystem(32629)
-    xform = QgsCoordinateTransform(src_crs, dest_crs, proj)
-    rect = xform.transform(rect)
 
-    return rect
+def get_rectangle(l, proj):
+    """
+    :param l: layer
+    :param proj: project, extent is given in project CRS
+    :return: QgsRectangle of layer extent
+    """
+    return transforms.transform_rect(l.extent(), l.crs().authid(), proj.crs().authid())
 
 
-def set_polygon_style(l, code=None):
+def set_polygon_style(l, code=None, classes=classification.DEFAULT_CLASSES, method=None):
     """
     function which will render colours of polygons based on user input...
         - create another utilities file for rendering layers based on Farmeye-specific use cases
     :param l: a layer
     :param code: variable to base colour coding on
+    :param classes: number of classes for a continuous variable
+    :param method: classification method for a continuous variable, see classification.METHODS, None for default
     :return:
     """
 
     if code is None or "":  # if no colour code set, use default style
         style = DEFAULT_POLYGON_STYLE
         symbol = QgsFillSymbol.createSimple(style)
-        # create renderer to colour polygons in layer
-        l.renderer().setSymbol(symbol)
+        # create renderer to colour polygons in layer, replaces renderer of a previous variant
+        l.setRenderer(QgsSingleSymbolRenderer(symbol))
         l.triggerRepaint()
 
     elif 'index' in code:  # if an index is used for color coding
@@ -270,18 +355,25 @@ def set_polygon_style(l, code=None):
         styles = QgsStyle().defaultStyle()
         defaultColorRampNames = styles.colorRampNames()
         ramp = styles.colorRamp(defaultColorRampNames[-6])
-        renderer = QgsGraduatedSymbolRenderer()
-        renderer.setClassAttribute(code)
+        range_list = classification.get_ranges(l, code, ramp, classes, method)
+        if not range_list:  # nothing to classify, use default style
+            set_polygon_style(l)
+            return
+        renderer = QgsGraduatedSymbolRenderer(code, range_list)
         renderer.setSourceColorRamp(ramp)
-        # todo allow argument for number of classes
-        renderer.updateClasses(l, QgsGraduatedSymbolRenderer.EqualInterval, 10)
         l.setRenderer(renderer)
 
 
 def set_layer_labels(l, label_data='name'):
+    """
+    :param l: a layer
+    :param label_data: field name or expression to label polygons with
+    :return:
+    """
     label_settings = QgsPalLayerSettings()
     label_settings.drawLabels = True
     label_settings.fieldName = label_data
+    label_settings.isExpression = True
 
     # set up label text format
     text_format = QgsTextFormat()
@@ -345,288 +437,444 @@ def get_table_height(n, h_size, c_size):
     return size
 
 
-def main(args):
+def set_variant(l, legend, color_code, label_data, classes=classification.DEFAULT_CLASSES,
+                method=None):
     """
+    set layer style, labels and legend for one colour code variant
+    :param l: layer
+    :param legend: legend item, or None if no variant is colour coded
+    :param color_code: variable to colour code map, or None
+    :param label_data: data column to label polygons with, or None
+    :param classes: number of classes for a continuous colour code
+    :param method: classification method for a continuous colour code, None for default
     :return:
     """
+    l.setName("fields" if not color_code else JSON_TO_UI_DICT[color_code])
 
-    # todo: handle creation of qgis project from name instead of full path
+    # set layer colours
+    set_polygon_style(l, color_code, classes, method)
 
-    # Initialize QGIS Application
-    # QgsApplication.setPrefixPath(os.getenv("QGIS"), True)
-    app = QgsApplication([], False, None)
-    QgsApplication.initQgis()
-
-    # need to remove old layers and layouts from QgsProject.instance() because using
-    # QgsApplication.exitQgis() doesn't work when called from GUI
-
-    # remove old layers
-    registryLayers = QgsProject.instance().mapLayers().keys()
-    layersToRemove = set(registryLayers)
-    QgsProject.instance().removeMapLayers(list(layersToRemove))
-
-    # remove old layouts
-    layout_manager = QgsProject.instance().layoutManager()
-    layouts_list = layout_manager.printLayouts()
-    for l in layouts_list:
-        layout_manager.removeLayout(l)
-
-    # project is 'cleared' now
-    project = QgsProject.instance()
-    proj_path = str(get_project_path(args.project_path))
-    project.setFileName(proj_path)  # set project name
-    crs = QgsCoordinateReferenceSystem()
-    crs.createFromString("EPSG:32629")
-    project.setCrs(crs)
-
-    # add tile layer
-    tile_layer_url = 'type=xyz&url=https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}'
-    tile_layer = QgsRasterLayer(tile_layer_url, '', 'wms')
-    # tile_layer.setCrs(crs)
-
-    if tile_layer.isValid():
-        project.addMapLayer(tile_layer)
+    # set layer labels
+    if label_data:
+        set_layer_labels(l, utils.get_display_expression(l, label_data))
     else:
-        logging.info('invalid layer')
+        l.setLabelsEnabled(False)
 
-    # Create layout
-    layout = get_layout(args.layout_name, project)
+    if legend is not None:
+        legend.setVisibility(bool(color_code))
+        legend.updateLegend()
+
+
+def get_footer_text(args, color_code, label_data):
+    """
+    get text of labels at bottom of layout, bottom label first
+    :param args: argument namespace
+    :param color_code: colour code of variant
+    :param label_data: label data column of variant
+    :return: list of strings
+    """
+    now = datetime.now()  # current date and time
+    date = now.strftime("%d/%m/%Y")
+    labels_text = ["farmeye.ie",
+                   "Map prepared by Farmeye " + date,
+                   "Base layer copyright ESRI"]
+
+    if label_data:  # text label identifying polygon label variable
+        labels_text.append("Label variable: " + JSON_TO_UI_DICT[label_data])
+
+    if color_code and JSON_TO_UI_DICT[color_code] == 'P index':
+        labels_text.append("P index: grass")
+
+    if args.farm_name:
+        labels_text.append("Farm: " + args.farm_name)
+
+    return labels_text
+
+
+def set_footer_labels(layout, labels, labels_text, page_size, page_padding, spacing=10):
+    """
+    set text of labels at bottom of layout. label items are created when first needed and reused,
+    labels not needed by this text are hidden
+    :param layout:
+    :param labels: list of existing label items, extended in place
+    :param labels_text: list of strings, bottom label first
+    :param page_size: QgsLayoutSize of page
+    :param page_padding: mm
+    :param spacing: mm between labels
+    :return:
+    """
+
+    for i in range(len(labels), len(labels_text)):
+        label = QgsLayoutItemLabel(layout)
+        label.setFont(QtGui.QFont("Ariel", 16))
+        layout.addLayoutItem(label)
+        label.setReferencePoint(QgsLayoutItem.LowerLeft)
+        labels.append(label)
+
+    for i, label in enumerate(labels):
+        label.setVisibility(i < len(labels_text))
+        if i < len(labels_text):
+            label.setText(labels_text[i])
+            label.adjustSizeToText()
+            label.attemptMove(QgsLayoutPoint(page_padding,
+                                             page_size.height() - page_padding - (i*spacing),
+                                             QgsUnitTypes.LayoutMillimeters))
+
+
+def export_preview(layout, path):
+    """
+    Export first page of layout to a png at the layout dpi. the image is replaced in one step,
+    so a reader never sees a partly written file
+    :param layout:
+    :param path: path to .png file
+    :return:
+    """
+    settings = QgsLayoutExporter.ImageExportSettings()
+    settings.dpi = layout.renderContext().dpi()
+    settings.pages = [0]
+
+    partial_path = Path(path).with_suffix('.partial.png')
+    result = QgsLayoutExporter(layout).exportToImage(str(partial_path), settings)
+    if result != QgsLayoutExporter.Success:
+        raise RuntimeError("preview could not be exported (error {0})".format(result))
+    os.replace(str(partial_path), str(path))
+
+
+def init_qgis():
+    """
+    Initialise the QGIS application. Only the first call in a process pays the start-up cost,
+    later calls return the application which is already running
+    :return: QgsApplication instance
+    """
+    global QGIS_APP
+
+    if QGIS_APP is None:
+        # QgsApplication.setPrefixPath(os.getenv("QGIS"), True)
+        QGIS_APP = QgsApplication([], False, None)
+        QgsApplication.initQgis()
+
+    return QGIS_APP
+
+
+def build_layout(args):
+    """
+    Build the project, layout and layer for one farm and export it. QGIS must already be initialised
+    :param args: argument namespace
+    :return:
+    """
+
+    # todo: handle creation of qgis project from name instead of full path
+
+    schema.get_registry()  # picks up changes to attribute names file in long running processes
+
+    with tracing.span('project'):
+        # each job owns its project, so jobs in one process don't share layers or layouts
+        project = QgsProject()
+        proj_path = str(get_project_path(args.project_path))
+        project.setFileName(proj_path)  # set project name
+
+        # add tile layer, previews only use a local basemap
+        if args.preview is None or args.tile_cache is not None:
+            tile_layer = get_basemap_layer(args.tile_cache)
+        else:
+            tile_layer = QgsRasterLayer()
+
+        if tile_layer.isValid():
+            project.addMapLayer(tile_layer)
+        elif args.preview is None:
+            logging.warning('invalid basemap layer, map will have no basemap')
+        elif 'basemap' not in PREVIEW_WARNINGS:
+            PREVIEW_WARNINGS.add('basemap')
+            logging.warning('invalid basemap layer, previews will have no basemap')
+
+        # Create layout from compiled template, only items which depend on the farm are set below
+        spec = layout_templates.read_spec(args.template)
+        layout = layout_templates.get_layout(args.layout_name, project, args.template)
 
     # get layout extents/size?
     # returns a QgsLayoutSize object
     # QgsPrintLayout(QgsLayout) -> QgsLayoutPageCollection -> QgsLayoutItemPage -> QgsLayoutSize
     page_size = layout.pageCollection().pages()[0].pageSize()
 
-    page_padding = 15
-    map_padding = 10
+    # maps, basemap and simplification tolerance follow preview resolution, --raster only sets dpi of its export
+    if args.preview is not None:
+        layout.renderContext().setDpi(PREVIEW_DPI)
 
-    # Create a layer
-    new_layer, num_features = get_layer(args, project)
+    page_padding = spec['padding']
+    map_padding = spec['map_padding']
 
-    color_code = None if args.color_code is None or "" else JSON_TO_UI_DICT[args.color_code]
+    with tracing.span('layer'):
+        # Create a layer
+        new_layer, num_features = get_layer(args, project)
 
-    # set layer colours
-    set_polygon_style(new_layer, color_code)
+        # draw maps in the UTM zone of the farm
+        project.setCrs(transforms.get_crs(transforms.get_layer_utm_authid(new_layer)))
 
-    # set layer labels
-    if args.label_data is not None or "":
-        set_layer_labels(new_layer, JSON_TO_UI_DICT[args.label_data])
+    tracing.count('features', num_features)
+    if tracing.is_tracing():
+        tracing.count('vertices', utils.count_vertices(new_layer))
+
+    # layer style, labels and legend are set for each variant before it is exported
+    variants = get_variants(args)
+    tracing.count('variants', len(variants))
 
     """
         Data column
     """
-    data_col_width = DEFAULT_COL_WIDTH * (len(get_table_fields(args))) + page_padding
-
-    # order layer features by 'name'
-    request = QgsFeatureRequest()
-
-    # set order by field
-    clause = QgsFeatureRequest.OrderByClause('to_int(name)', ascending=True)
-    orderby = QgsFeatureRequest.OrderBy([clause])
-    request.setOrderBy(orderby)
-
-    features = new_layer.getFeatures(request)
-
-    #for feature in features:
-    # todo sort layer features by name?
-    #   print(feature.attributes())
-
-    # Create a table attached to specific layout
-    table = QgsLayoutItemAttributeTable.create(layout)
-    table.setVectorLayer(new_layer)  # add layer info to table
-    table.setDisplayedFields(get_table_fields(args))
-    table.setMaximumNumberOfFeatures(100)
-    table.setVerticalGrid(False)  # don't draw vertical lines
-    columns = table.columns()
-    for column in columns:
-        column.setWidth(DEFAULT_COL_WIDTH)  # width in mm
-        column.setHAlignment(qt5.AlignHCenter)
-
-    table.setColumns(columns)
-
-    # Create table font
-    text_format_heading, text_format_content = utils.get_text_formats(num_features)
-    table.setHeaderTextFormat(text_format_heading)
-    table.setContentTextFormat(text_format_content)
-    # get table height based on layer features and font sizes
-    table_height = utils.get_table_height(num_features, text_format_heading.size(), text_format_content.size())
-    layout.addMultiFrame(table)
-
-    # Base class for frame items, which form a layout multiframe item.
-    frame = QgsLayoutFrame(layout, table)
-    frame.setFrameEnabled(True)  # draw frame around outside since vertical grid lines are not drawn
-    frame.setFrameStrokeWidth(QgsLayoutMeasurement(0.5, QgsUnitTypes.LayoutMillimeters))
-    frame.attemptResize(QgsLayoutSize(table.totalWidth(),
-                                      table_height))
-    frame.attemptMove(QgsLayoutPoint(page_padding,
-                                     page_padding,
-                                     QgsUnitTypes.LayoutMillimeters))
-    table.addFrame(frame)
+    with tracing.span('table'):
+        # order layer features by 'name'
+        request = QgsFeatureRequest()
+
+        # set order by field
+        clause = QgsFeatureRequest.OrderByClause('to_int(name)', ascending=True)
+        orderby = QgsFeatureRequest.OrderBy([clause])
+        request.setOrderBy(orderby)
+
+        features = new_layer.getFeatures(request)
+
+        #for feature in features:
+        # todo sort layer features by name?
+        #   print(feature.attributes())
+
+        # Create a table attached to specific layout
+        table = QgsLayoutItemAttributeTable.create(layout)
+        table.setVectorLayer(new_layer)  # add layer info to table
+        table.setDisplayedFields(get_table_fields(args))
+        table.setMaximumNumberOfFeatures(num_features)
+        table.setVerticalGrid(False)  # don't draw vertical lines
+        table.setCellMargin(utils.TABLE_MARGIN)  # same margin as column widths and table height are computed with
+
+        # Create table font, large tables are split over frames on extra pages once font is at its minimum size
+        content_size, frame_rows = utils.get_table_pages(num_features)
+        text_format_heading, text_format_content = utils.get_text_formats(num_features, content_size)
+
+        columns = table.columns()
+        for column in columns:
+            column.setAttribute(utils.get_display_expression(new_layer, column.attribute()))  # rounded values
+            column.setHAlignment(qt5.AlignHCenter)
+
+        # columns are as wide as their widest heading or value at the table font sizes
+        widths = layout_metrics.get_column_widths(new_layer, columns, text_format_heading, text_format_content)
+        for column, width in zip(columns, widths):
+            column.setWidth(width)  # width in mm
+
+        table.setColumns(columns)
+        data_col_width = sum(widths) + page_padding
+
+        table.setHeaderTextFormat(text_format_heading)
+        table.setContentTextFormat(text_format_content)
+        layout.addMultiFrame(table)
+        utils.add_pages(layout, len(frame_rows))
+
+        # Base class for frame items, which form a layout multiframe item.
+        # one frame per page, sized for its rows
+        for page, rows in enumerate(frame_rows):
+            frame = QgsLayoutFrame(layout, table)
+            frame.setFrameEnabled(True)  # draw frame around outside since vertical grid lines are not drawn
+            frame.setFrameStrokeWidth(QgsLayoutMeasurement(0.5, QgsUnitTypes.LayoutMillimeters))
+            frame.attemptResize(QgsLayoutSize(table.totalWidth(),
+                                              utils.get_table_height(rows,
+                                                                     text_format_heading.size(),
+                                                                     text_format_content.size())))
+            frame.attemptMove(QgsLayoutPoint(page_padding,
+                                             page_padding,
+                                             QgsUnitTypes.LayoutMillimeters), page=page)
+            table.addFrame(frame)
+
+        if len(frame_rows) > 1:  # rows which don't fit estimated frame sizes continue on another page
+            table.setResizeMode(QgsLayoutMultiFrame.ExtendToNextPage)
+
+        tracing.count('pages', len(frame_rows))
+
+        # height of table on first page, other items are placed around it
+        table_height = utils.get_table_height(frame_rows[0], text_format_heading.size(), text_format_content.size())
 
     #
     # Legend
     #
-    if args.color_code:
-        legend = QgsLayoutItemLegend(layout)
-        root = QgsLayerTree()
-
-        # don't include ESRI in legend
-        for lyr in project.mapLayers().values():
-            if lyr.name() != 'ESRI':
-                root.addLayer(lyr)
-
-        legend.model().setRootGroup(root)
-        layout.addLayoutItem(legend)
-
-        legend.setResizeToContents(False)
-        legend.attemptResize(QgsLayoutSize(50, 85))
-
-        legend.setReferencePoint(QgsLayoutItem.UpperLeft)
-        legend.attemptMove(QgsLayoutPoint(page_padding,
-                                          page_padding + table_height + map_padding,
-                                          QgsUnitTypes.LayoutMillimeters))
-
-        if table_height > 400:  # allow more space in table
-            legend.attemptMove(QgsLayoutPoint(115, 500, QgsUnitTypes.LayoutMillimeters))
-
-        # legend fonts and icon sizes
-        legend.setStyleFont(QgsLegendStyle.Subgroup, text_format_heading.font())
-        legend.setStyleFont(QgsLegendStyle.SymbolLabel, text_format_content.font())
-        legend.setStyleMargin(QgsLegendStyle.SymbolLabel, 5.0)
-        legend.setSymbolHeight(10.0)
-        legend.setSymbolWidth(16.0)
-        legend.setStyleMargin(QgsLegendStyle.Symbol, 5.0)
-        legend.setLineSpacing(5.0)
-
-    # labels at bottom
-    now = datetime.now() # current date and time
-    date = now.strftime("%d/%m/%Y")
-    labels_text = ["farmeye.ie",
-                   "Map prepared by Farmeye " + date,
-                   "Base layer copyright ESRI"]
+    with tracing.span('legend'):
+        legend = layout_templates.get_item(layout, 'legend')
+        if not any(code for code, label_data in variants):
+            layout.removeLayoutItem(legend)
+            legend = None
+        else:
+            root = QgsLayerTree()
 
-    if args.label_data is not None or "":  # text label identifying polygon label variable
-        labels_text.append("Label variable: " + JSON_TO_UI_DICT[args.label_data])
+            # don't include ESRI in legend
+            for lyr in project.mapLayers().values():
+                if lyr.name() != 'ESRI':
+                    root.addLayer(lyr)
 
-    if color_code == 'P index':
-        labels_text.append("P index: grass")
+            legend.model().setRootGroup(root)
 
-    if args.farm_name:
-        labels_text.append("Farm: " + args.farm_name)
+            legend.attemptMove(QgsLayoutPoint(page_padding,
+                                              page_padding + table_height + map_padding,
+                                              QgsUnitTypes.LayoutMillimeters))
 
-    n_labels = len(labels_text)
-    spacing = 10  # mm?
+            if table_height > 400:  # allow more space in table
+                legend.attemptMove(QgsLayoutPoint(115, 500, QgsUnitTypes.LayoutMillimeters))
 
-    for i in range(n_labels):
-        label = QgsLayoutItemLabel(layout)
-        label.setText(labels_text[i])
-        label.setFont(QtGui.QFont("Ariel", 16))
-        layout.addLayoutItem(label)
-        label.adjustSizeToText()
-        label.setReferencePoint(QgsLayoutItem.LowerLeft)
-        label.attemptMove(QgsLayoutPoint(page_padding,
-                                         page_size.height() - page_padding - (i*spacing),
-                                         QgsUnitTypes.LayoutMillimeters))
+            # legend fonts follow table fonts, icon sizes are set in the template
+            legend.setStyleFont(QgsLegendStyle.Subgroup, text_format_heading.font())
+            legend.setStyleFont(QgsLegendStyle.SymbolLabel, text_format_content.font())
+
+    # labels at bottom, text depends on variant. extra labels are created if the template has too few
+    footer = spec['items']['footer']
+    footer_labels = [layout_templates.get_item(layout, 'footer_{0}'.format(i)) for i in range(footer['count'])]
 
     """
         Map(s)
     """
 
-    # Create and add the full sized map
-    farm_map = QgsLayoutItemMap(layout)
-    farm_map.setRect(20, 20, 20, 20)  # DO NOT REMOVE I have no idea what this does, but it is necessary
-    farm_map.setExtent(utils.get_rectangle(new_layer, project))  # Set Map Extent
-    layout.addLayoutItem(farm_map)
-    # resize map, account for data column width
-    farm_map.attemptResize(QgsLayoutSize(page_size.width() - data_col_width - (2*page_padding),
-                                         page_size.height() - (2*page_padding)))
-    farm_map.setReferencePoint(QgsLayoutItem.LowerRight)
-    farm_map.attemptMove(QgsLayoutPoint(page_size.width() - page_padding,
-                                        page_size.height() - page_padding,
-                                        QgsUnitTypes.LayoutMillimeters))
-
-    if args.map_count > 1:  # add the rest of the maps in smaller size
+    with tracing.span('maps'):
+        # full sized map
+        farm_map = layout_templates.get_item(layout, 'farm_map')
+        farm_map.setExtent(utils.get_rectangle(new_layer, project))  # Set Map Extent
+        # resize map, account for data column width
+        farm_map.attemptResize(QgsLayoutSize(page_size.width() - data_col_width - (2*page_padding),
+                                             page_size.height() - (2*page_padding)))
+        farm_map.attemptMove(QgsLayoutPoint(page_size.width() - page_padding,
+                                            page_size.height() - page_padding,
+                                            QgsUnitTypes.LayoutMillimeters))
+
+        # smallest change to geometries which can be seen on the largest scale map
+        # the finest output decides, a raster at a higher dpi than the pdf keeps more vertices
+        dpi = layout.renderContext().dpi()
+        if args.raster is not None and args.preview is None:
+            dpi = max(dpi, args.dpi)
+        tolerance = utils.get_simplify_tolerance(layout, farm_map, new_layer, dpi)
+
+        # basemap rendered once per extent and map size, shared by all maps of the same farm.
+        # if it can't be rendered the map item renders the basemap itself
+        if args.basemap_cache is not None and tile_layer.isValid():
+            basemap_cache.add_basemap_underlay(layout, farm_map, tile_layer, args.basemap_cache)
+
+        # the rest of the maps in smaller size, cropped from one render of the full sized map
+        insets = []
         for c in range(args.map_count - 1):  # -1 since one map already created
-            # creating a map based on layout
-            farm_map = QgsLayoutItemMap(layout)
-            # I have no idea what this does, but it is necessary
-            farm_map.setRect(20, 20, 20, 20)
-            farm_map.setExtent(utils.get_rectangle(new_layer, project))  # Set Map Extent
-            farm_map.setReferencePoint(QgsLayoutItem.LowerRight)
-            utils.set_frame(farm_map)  # set frame attributes around map
-            layout.addLayoutItem(farm_map)
-            farm_map.attemptResize(QgsLayoutSize((page_size.width()-data_col_width) / 2,
-                                                  page_size.width() / 2,
-                                                  QgsUnitTypes.LayoutMillimeters))
-            farm_map.attemptMove(QgsLayoutPoint(page_size.width() - (50 * c),
-                                                page_size.height() - (50 * c),
-                                                QgsUnitTypes.LayoutMillimeters))
+            inset = inset_maps.add_inset(layout,
+                                         ((page_size.width() - data_col_width) / 2, page_size.width() / 2),
+                                         QgsLayoutPoint(page_size.width() - (50 * c),
+                                                        page_size.height() - (50 * c),
+                                                        QgsUnitTypes.LayoutMillimeters))
+            utils.set_frame(inset)  # set frame attributes around map
+            insets.append(inset)
 
     #
     # scalebar
     #
-    scalebar = QgsLayoutItemScaleBar(layout)
-    scalebar.setStyle('Single Box')
-    scalebar.setUnits(QgsUnitTypes.DistanceMeters)
-    scalebar.setNumberOfSegments(4)
-    scalebar.setNumberOfSegmentsLeft(0)
-    # this will depend on the map extent
-    # todo dynamically set units per segment based on map extent?
-    scalebar.setUnitsPerSegment(100)
-    scalebar.setLinkedMap(farm_map)
-    scalebar.setUnitLabel('m')
-    scalebar.setMaximumBarWidth(250.0)
-    scalebar.setHeight(8)
-
-    # scalebar text format
-    # set up label text format
-    text_format = QgsTextFormat()
-    text_format.setFont(QtGui.QFont("Arial", 36, QtGui.QFont.Bold))
-    text_format.setSize(40)
-    buffer = QgsTextBufferSettings()
-    buffer.setEnabled(True)
-    buffer.setSize(1.5)
-    text_format.setBuffer(buffer)
-    shadow = QgsTextShadowSettings()
-    shadow.setEnabled(True)
-    text_format.setShadow(shadow)
-    text_format.setSizeUnit(QgsUnitTypes.RenderMapUnits)
-    scalebar.setTextFormat(text_format)
-    scalebar.update()
-
-    # position scalebar
-    scalebar.setReferencePoint(QgsLayoutItem.LowerLeft)
-    layout.addLayoutItem(scalebar)
-    scalebar.attemptMove(QgsLayoutPoint(data_col_width + page_padding + map_padding,
-                                        page_size.height() - page_padding - map_padding,
-                                        QgsUnitTypes.LayoutMillimeters))
-
-    # north arrow
-    arrow_path = os.environ['QGIS'] + "/svg/arrows/NorthArrow_11.svg"
-    arrow = QgsLayoutItemPicture(layout)
-    arrow.setPicturePath(arrow_path)
-    arrow.setReferencePoint(QgsLayoutItem.UpperRight)
-    layout.addLayoutItem(arrow)
-    arrow.attemptResize(QgsLayoutSize(40, 60, QgsUnitTypes.LayoutMillimeters))
-    arrow.attemptMove(QgsLayoutPoint(page_size.width() - page_padding - map_padding,
-                                     page_padding + map_padding,
-                                     QgsUnitTypes.LayoutMillimeters))
+    with tracing.span('scalebar'):
+        # style is set in the template
+        scalebar = layout_templates.get_item(layout, 'scalebar')
+        scalebar.setLinkedMap(farm_map)
+        scalebar.update()
+
+        # position scalebar
+        scalebar.attemptMove(QgsLayoutPoint(data_col_width + page_padding + map_padding,
+                                            page_size.height() - page_padding - map_padding,
+                                            QgsUnitTypes.LayoutMillimeters))
+
+    # vertices closer together than a printed pixel are dropped from the exported maps
+    original_geometries = None
+    if args.pdf is not None or args.raster is not None or args.preview is not None:
+        with tracing.span('simplify'):
+            original_geometries = utils.simplify_layer(new_layer, tolerance)
 
     # this creates a QgsLayoutExporter object
     exporter = QgsLayoutExporter(layout)
 
-    # export to pdf if required
-    if args.pdf is not None:
-        pdf_path = Path(args.pdf)
-        exporter.exportToPdf(pdf_path, QgsLayoutExporter.PdfExportSettings())
+    # only the layer style, labels, legend and footer change between variants
+    for color_code, label_data in variants:
+        with tracing.span('style'):
+            set_variant(new_layer, legend, color_code, label_data, args.classes, args.classification)
+            set_footer_labels(layout, footer_labels, get_footer_text(args, color_code, label_data),
+                              page_size, page_padding, footer['spacing'])
+
+        if insets:
+            with tracing.span('insets'):
+                inset_maps.render_insets(layout, farm_map, insets, utils.get_rectangle(new_layer, project),
+                                         project.layerTreeRoot().layerOrder(), args.preview or proj_path,
+                                         tile_layer if tile_layer.isValid() else None, args.basemap_cache)
+
+        # preview shows the first variant, nothing else is exported or saved
+        if args.preview is not None:
+            with tracing.span('preview'):
+                export_preview(layout, args.preview)
+            return
+
+        # export to pdf if required
+        if args.pdf is not None:
+            with tracing.span('export'):
+                pdf_path = get_variant_pdf_path(args.pdf, color_code, len(variants))
+                exporter.exportToPdf(str(pdf_path), QgsLayoutExporter.PdfExportSettings())
+
+        if args.raster is not None:
+            with tracing.span('raster'):
+                raster_path = get_variant_pdf_path(args.raster, color_code, len(variants))
+                tiled_export.export_tiled(layout, str(raster_path), args.dpi)
+
+    # project keeps full detail geometries
+    with tracing.span('save'):
+        if original_geometries is not None:
+            utils.restore_geometries(new_layer, original_geometries)
+
+        # save the project with last variant, staged layer is written next to it
+        save_layer(new_layer, proj_path)
+        project.write()
+
+
+def run_layout(args):
+    """
+    Build layout for one farm unless its outputs are cached, QGIS is only initialised if it is needed
+    :param args: argument namespace
+    :return:
+    """
+    key = None
+    if args.cache_dir is not None:
+        color_tables = [DEFAULT_POLYGON_STYLE, P_K_INDEX_COLORS, PH_INDEX_COLORS,
+                        layout_templates.read_spec(args.template)]
+        key = output_cache.get_cache_key(args, utils.DEFAULT_ATTRIBUTE_NAMES, color_tables)
+        with tracing.span('cache'):
+            restored = not args.force and output_cache.restore(key, args.cache_dir, get_outputs(args))
+        if restored:
+            logging.info("{0}: outputs restored from cache".format(args.file))
+            return
+
+    # Initialize QGIS Application
+    with tracing.span('init'):
+        init_qgis()
+
+    build_layout(args)
 
-    # save the project
-    project.write()
+    if key is not None:
+        with tracing.span('cache'):
+            output_cache.store(key, args.cache_dir, get_outputs(args), args.max_cache_size * 1024 ** 2)
+
+
+def main(args):
+    """
+    :return:
+    """
+    if args.report is not None:
+        tracing.start_trace(args.file)
+
+    try:
+        run_layout(args)
+    finally:
+        report = tracing.end_trace()
+        if report is not None:
+            tracing.write_report(report, args.report)
 
 
 if __name__ == "__main__":
     arguments = get_args()
 
-    main(arguments)
+    if arguments.daemon:
+        import render_daemon
+        logging.basicConfig(level=logging.INFO)
+        result = render_daemon.submit_job(arguments)
+        logging.info("{0}: created {1} in {2:.2f}s".format(arguments.file, result['project_path'], result['seconds']))
+    else:
+        main(arguments)
 
 
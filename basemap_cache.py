@@ -0,0 +1,173 @@
+"""
+    Cache of rendered basemap images, so the basemap is rendered once for several maps of the same farm
+
+    The basemap is rendered to an image keyed by extent, CRS, map size, dpi and basemap source.
+    Layouts with the same map extent and size (e.g. P index, K index and pH maps of one farm) reuse the image:
+    it is placed under the map item as a picture and the map item only renders the vector layers over it.
+
+    Note:
+        - a render with errors (e.g. tiles which couldn't be fetched) is never cached, the map item then renders
+          the basemap itself
+        - images are written under a temporary name and renamed into place, so other processes never read a
+          partial image
+        - the cache is kept under a size cap, least recently used images are removed first
+"""
+import os
+import uuid
+import hashlib
+import logging
+from pathlib import Path
+from qgis.core import *
+from qgis.PyQt.QtCore import QRectF, QSize
+from qgis.PyQt.QtGui import QColor
+
+DEFAULT_CACHE_DIR = 'basemap_cache/'
+IMAGE_FORMAT = 'jpg'  # aerial imagery, compresses far better than png
+IMAGE_QUALITY = 90
+DEFAULT_MAX_SIZE = 1024 ** 3  # bytes
+
+
+def get_cache_key(extent, crs, size_mm, dpi, source):
+    """
+    :param extent: QgsRectangle of map
+    :param crs: QgsCoordinateReferenceSystem of map
+    :param size_mm: (width, height) of map in mm
+    :param dpi:
+    :param source: data source of basemap layer
+    :return: hex digest identifying rendered image
+    """
+    values = [round(v, 3) for v in (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())]
+    values += [crs.authid(), round(size_mm[0], 3), round(size_mm[1], 3), round(dpi, 3), source]
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def render_layers(layers, extent, crs, size_px, dpi):
+    """
+    Render layers to an image
+    :param layers: list of map layers, top layer first
+    :param extent: QgsRectangle
+    :param crs: QgsCoordinateReferenceSystem
+    :param size_px: QSize of image
+    :param dpi:
+    :return: (QImage, list of error messages)
+    """
+    settings = QgsMapSettings()
+    settings.setLayers(layers)
+    settings.setDestinationCrs(crs)
+    settings.setOutputSize(size_px)
+    settings.setOutputDpi(dpi)
+    settings.setExtent(extent)
+    settings.setBackgroundColor(QColor(255, 255, 255, 0))
+
+    job = QgsMapRendererParallelJob(settings)
+    job.start()
+    job.waitForFinished()
+
+    return job.renderedImage(), ['{0}: {1}'.format(e.layerID, e.message) for e in job.errors()]
+
+
+def evict(cache_dir, max_size):
+    """
+    Remove least recently used images until cache is below max_size
+    :param cache_dir:
+    :param max_size: bytes
+    :return: number of images removed
+    """
+    images = []
+    for path in Path(cache_dir).glob('*.' + IMAGE_FORMAT):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:  # removed by another process
+            continue
+        images.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for last_used, size, path in images)
+    removed = 0
+    for last_used, size, path in sorted(images):
+        if total <= max_size:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+
+    return removed
+
+
+def get_basemap_image(layer, extent, crs, size_mm, dpi, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+    """
+    Get path to rendered basemap image, rendering it only if it isn't cached yet
+    :param layer: basemap raster layer
+    :param extent: QgsRectangle of map
+    :param crs: QgsCoordinateReferenceSystem of map
+    :param size_mm: (width, height) of map in mm
+    :param dpi:
+    :param cache_dir: directory of rendered images
+    :param max_size: bytes
+    :return: path to image, None if the basemap couldn't be rendered
+    """
+    key = get_cache_key(extent, crs, size_mm, dpi, layer.source())
+    path = Path(cache_dir) / (key + '.' + IMAGE_FORMAT)
+
+    try:
+        os.utime(str(path))  # mark as recently used
+        return path
+    except FileNotFoundError:  # not cached, or removed by another process
+        pass
+
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    size_px = QSize(int(round(size_mm[0] / 25.4 * dpi)), int(round(size_mm[1] / 25.4 * dpi)))
+    image, errors = render_layers([layer], extent, crs, size_px, dpi)
+    if errors or image.isNull():
+        logging.warning("basemap not cached, rendering failed: {0}".format('; '.join(errors) or "no image"))
+        return None
+
+    partial_path = path.parent / '.{0}-{1}.{2}'.format(key, uuid.uuid4().hex, IMAGE_FORMAT)
+    try:
+        if not image.save(str(partial_path), IMAGE_FORMAT, IMAGE_QUALITY):
+            logging.warning("basemap not cached, could not write {0}".format(partial_path))
+            return None
+        os.replace(str(partial_path), str(path))
+    finally:
+        if partial_path.exists():
+            partial_path.unlink()
+    logging.info("rendered basemap {0}".format(path))
+
+    evict(cache_dir, max_size)
+    return path
+
+
+def add_basemap_underlay(layout, map_item, basemap, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Replace basemap rendering of a map item with a cached image of the basemap placed underneath it.
+    call after map item has its final size and position
+    :param layout: layout containing map item
+    :param map_item: QgsLayoutItemMap
+    :param basemap: basemap raster layer
+    :param cache_dir: directory of rendered images
+    :return: QgsLayoutItemPicture holding basemap image, None if the basemap couldn't be rendered and the map item
+        renders it itself
+    """
+    size = layout.convertToLayoutUnits(map_item.sizeWithUnits())  # QSizeF in mm
+    dpi = layout.renderContext().dpi()
+    path = get_basemap_image(basemap, map_item.extent(), map_item.crs(), (size.width(), size.height()), dpi,
+                             cache_dir)
+    if path is None:
+        return None
+
+    picture = QgsLayoutItemPicture(layout)
+    picture.setPicturePath(str(path.resolve()))
+    picture.setResizeMode(QgsLayoutItemPicture.Stretch)
+    layout.addLayoutItem(picture)
+    picture.attemptSetSceneRect(QRectF(map_item.pos(), map_item.rect().size()))
+    layout.moveItemToBottom(picture)
+
+    # map only draws the layers on top of the basemap
+    layers = [l for l in layout.project().mapLayers().values() if l.id() != basemap.id()]
+    map_item.setLayers(layers)
+    map_item.setKeepLayerSet(True)
+    map_item.setBackgroundEnabled(False)
+
+    return picture
@@ -0,0 +1,174 @@
+"""
+    Script which generates layouts for many farms in a single QGIS session
+
+    QGIS is initialised once and every farm layout is built and exported in that session,
+    so start-up cost is only paid once per batch.
+
+    Input is either a directory of farm .json files or a manifest file listing farms and per-farm options.
+    Manifest format (.json), keys match the arguments of advanced_layout.py:
+        [
+            {"file": "farms/farm_a.json", "farm_name": "Farm A", "color_code": "index_K"},
+            {"file": "farms/farm_b.json", "table_fields": ["P_mg_per_l"], "pdf": "pdfs/farm_b.pdf"}
+        ]
+
+    Note:
+        - options not given for a farm use the defaults of advanced_layout.py
+        - if no project_path is given for a farm, the project is saved as <farm file name>.qgs in --project_dir
+"""
+import json
+import time
+import logging
+from pathlib import Path
+import advanced_layout
+import tracing
+
+# layer copies written next to each farm file by older versions, <farm>_qgis_layer.json
+LAYER_COPY_SUFFIX = '_qgis_layer'
+
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True, type=str,
+                        help="directory of farm files (.json) or manifest file (.json) listing farms and options")
+    parser.add_argument("--project_dir", type=str, default=advanced_layout.DEFAULT_PROJECT_DIR,
+                        help="directory to save projects to when a farm has no project_path")
+    parser.add_argument("--pdf_dir", type=str,
+                        help="optional directory to export a pdf for each farm which has no pdf path")
+    parser.add_argument("--cache_dir", type=str,
+                        help="optional directory of cached outputs, unchanged farms are copied from it")
+    parser.add_argument("--force", action="store_true",
+                        help="build layouts even if their outputs are cached")
+    parser.add_argument("--report", type=str,
+                        help="optional path to write a .json report of stage timings of every farm and the batch to")
+    return parser.parse_args()
+
+
+def is_generated(file, exclude=()):
+    """
+    :param file: Path of .json file in a directory of farms
+    :param exclude: paths of other files written by the batch, e.g. its report
+    :return: True if file was written by a run rather than being a farm
+    """
+    if file.resolve() in [Path(e).resolve() for e in exclude]:
+        return True
+
+    # layer copy of a farm in the same directory
+    return (file.stem.endswith(LAYER_COPY_SUFFIX)
+            and file.with_name(file.stem[:-len(LAYER_COPY_SUFFIX)] + file.suffix).exists())
+
+
+def read_manifest(input_string, exclude=()):
+    """
+    Read list of farm entries from a directory of farm files or a manifest file
+    :param input_string: path to directory or manifest
+    :param exclude: paths of files written by the batch, skipped when reading a directory
+    :return: list of dicts, one per farm
+    """
+    input_path = Path(input_string)
+
+    if input_path.is_dir():
+        return [{'file': str(f)} for f in sorted(input_path.glob('*.json')) if not is_generated(f, exclude)]
+
+    with open(input_path, 'r') as data:
+        entries = json.load(data)
+
+    for entry in entries:
+        if 'file' not in entry:
+            raise ValueError("manifest entry has no 'file': {0}".format(entry))
+
+    return entries
+
+
+def get_farm_args(entry, project_dir=advanced_layout.DEFAULT_PROJECT_DIR, pdf_dir=None):
+    """
+    Create an argument namespace for one farm, same as parsed by advanced_layout.py
+    :param entry: dict of options for farm, must contain 'file'
+    :param project_dir: directory for project when entry has no project_path
+    :param pdf_dir: optional directory for pdf when entry has no pdf path
+    :return: argument namespace
+    """
+    stem = Path(entry['file']).stem
+    project_path = entry.get('project_path', str(Path(project_dir) / (stem + '.qgs')))
+
+    args = advanced_layout.get_parser().parse_args(['-f', entry['file'], '-p', project_path])
+
+    for key, value in entry.items():
+        if key not in vars(args):
+            raise ValueError("unknown option '{0}' for farm {1}".format(key, entry['file']))
+        setattr(args, key, value)
+
+    if args.pdf is None and pdf_dir is not None:
+        args.pdf = str(Path(pdf_dir) / (stem + '.pdf'))
+
+    return args
+
+
+def run_batch(jobs, reports=None):
+    """
+    Build and export a layout for every job in one QGIS session
+    a failing farm is logged and does not stop the batch
+    :param jobs: list of argument namespaces
+    :param reports: optional list, the run report of each job is appended to it (see tracing.py)
+    :return: list of (file, seconds, error) tuples in job order, error is None on success
+    """
+    start = time.perf_counter()
+    advanced_layout.init_qgis()
+    logging.info("QGIS initialised in {0:.2f}s".format(time.perf_counter() - start))
+
+    results = []
+    for args in jobs:
+        start = time.perf_counter()
+        error = None
+        if reports is not None:
+            tracing.start_trace(args.file)
+        try:
+            advanced_layout.run_layout(args)
+        except Exception as e:
+            logging.exception("failed to create layout for {0}".format(args.file))
+            error = str(e)
+        finally:
+            report = tracing.end_trace()
+            if report is not None:
+                report['error'] = error
+                reports.append(report)
+
+        seconds = time.perf_counter() - start
+        logging.info("{0}: {1:.2f}s{2}".format(args.file, seconds, "" if error is None else " (failed)"))
+        results.append((args.file, seconds, error))
+
+    return results
+
+
+def main(args):
+    """
+    :return:
+    """
+    if args.pdf_dir is not None:
+        Path(args.pdf_dir).mkdir(parents=True, exist_ok=True)
+    Path(args.project_dir).mkdir(parents=True, exist_ok=True)
+
+    entries = read_manifest(args.input, [args.report] if args.report is not None else [])
+    for entry in entries:  # options given for a farm override options for the batch
+        entry.setdefault('cache_dir', args.cache_dir)
+        entry.setdefault('force', args.force)
+
+    jobs = [get_farm_args(entry, args.project_dir, args.pdf_dir) for entry in entries]
+    reports = [] if args.report is not None else None
+    results = run_batch(jobs, reports)
+
+    failed = [r for r in results if r[2] is not None]
+    total = sum(r[1] for r in results)
+    logging.info("{0} farms in {1:.2f}s, {2} failed".format(len(results), total, len(failed)))
+
+    if reports is not None:
+        tracing.write_report(tracing.aggregate(reports), args.report)
+
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    arguments = get_args()
+
+    main(arguments)
@@ -0,0 +1,386 @@
+"""
+    Benchmark of the layout scripts on synthetic farms
+
+    Farms are generated as GeoJSON with the columns in column_names.txt, values of each column are generated
+    according to its type in the attribute names file. Fields are laid out in a grid with shared boundaries,
+    each boundary is densified to the requested number of vertices per polygon.
+
+    advanced_layout.py, farm_layout.py and farm_layout_docker.py are run on every farm in a separate process,
+    headless (QT_QPA_PLATFORM=offscreen) and without a basemap (BASEMAP_URL empty, or --basemap_url for a local
+    tile server). Time and peak memory of each run are recorded, advanced_layout.py also reports time per stage.
+    Results are compared against a stored baseline, runs which got slower than --tolerance (and by at least
+    MIN_REGRESSION_SECONDS) or which failed are reported as regressions and the exit code is 1.
+    Failed runs are not timed. Stage times and the peak memory growth of each stage come from the
+    advanced_layout.py run report, they are only collected for advanced_layout.py and are None for the other scripts.
+
+    Usage:
+        python benchmark.py --fields 10 100 1000 --vertices 40 400 --save_baseline
+        python benchmark.py --fields 10 100 1000 --vertices 40 400
+
+    Note:
+        - baselines are only comparable on the same machine
+        - peak memory is None on Windows
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import platform
+import subprocess
+from pathlib import Path
+import schema
+
+SCRIPTS = ['advanced_layout', 'farm_layout', 'farm_layout_docker']
+COLUMN_NAMES = 'column_names.txt'
+DEFAULT_WORK_DIR = 'benchmarks/work/'
+DEFAULT_BASELINE = 'benchmarks/baseline.json'
+DEFAULT_TOLERANCE = 0.2  # fraction slower than baseline before a run is a regression
+MIN_REGRESSION_SECONDS = 0.05  # smaller slowdowns are noise, whatever the fraction
+ORIGIN = (-8.0, 53.0)  # lon, lat of first field
+FIELD_SIZE = (0.003, 0.002)  # degrees, about 200 m x 220 m
+HECTARES_PER_FIELD = 4.4
+
+# generated value range of numeric columns, other numeric columns use DEFAULT_RANGE
+VALUE_RANGES = {
+    'P_mg_per_l': (1.0, 15.0),
+    'K_mg_per_l': (40.0, 300.0),
+    'pH_water': (5.0, 7.8),
+    'pH_SMP': (5.5, 7.2),
+    'index_K': (1, 4),
+    'index_P_grass': (1, 4),
+    'index_P_nongrass': (1, 4),
+}
+DEFAULT_RANGE = (0.0, 100.0)
+DISTRIBUTIONS = ['uniform', 'normal', 'lognormal']
+
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fields", nargs="+", type=int, default=[10, 100, 500],
+                        help="number of fields of each generated farm")
+    parser.add_argument("--vertices", nargs="+", type=int, default=[40, 400],
+                        help="vertices per polygon of each generated farm")
+    parser.add_argument("--distribution", type=str, default='uniform', choices=DISTRIBUTIONS,
+                        help="distribution of generated numeric values")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of generated farms, the same seed gives the same farms")
+    parser.add_argument("--scripts", nargs="+", default=SCRIPTS, choices=SCRIPTS,
+                        help="scripts to benchmark")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs of each script and farm, the fastest run is kept")
+    parser.add_argument("--basemap_url", type=str, default='',
+                        help="tile url of a local basemap, no basemap by default")
+    parser.add_argument("--work_dir", type=str, default=DEFAULT_WORK_DIR,
+                        help="directory for generated farms, projects, pdfs and reports")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE,
+                        help="path to baseline results (.json)")
+    parser.add_argument("--save_baseline", action="store_true",
+                        help="store results as the new baseline instead of comparing against it")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="fraction slower than baseline which counts as a regression")
+    return parser.parse_args()
+
+
+"""
+
+    Synthetic farms
+
+"""
+
+
+def get_offset(t):
+    """
+    deterministic wiggle of a boundary, so both fields sharing a boundary generate the same vertices
+    :param t: coordinate along boundary
+    :return: offset across boundary in degrees
+    """
+    return 0.00002 * math.sin(t * 7919.0) + 0.00001 * math.sin(t * 104729.0)
+
+
+def get_point(gx, gy, per_edge):
+    """
+    vertices are placed on a lattice of per_edge points per field side, so both fields sharing a boundary
+    generate exactly the same vertices
+    :param gx: lattice column
+    :param gy: lattice row
+    :param per_edge: lattice points per field side
+    :return: [lon, lat]
+    """
+    lon = ORIGIN[0] + FIELD_SIZE[0] * gx / per_edge
+    lat = ORIGIN[1] + FIELD_SIZE[1] * gy / per_edge
+    if gx % per_edge == 0 and gy % per_edge != 0:  # on a north-south boundary, corners are not moved
+        lon += get_offset(lat)
+    elif gy % per_edge == 0 and gx % per_edge != 0:  # on an east-west boundary
+        lat += get_offset(lon)
+    return [lon, lat]
+
+
+def get_polygon(col, row, vertices):
+    """
+    :param col: column of field in grid
+    :param row: row of field in grid
+    :param vertices: number of vertices of polygon
+    :return: GeoJSON polygon coordinates
+    """
+    p = max(vertices // 4, 1)
+    x0, y0 = col * p, row * p
+    # anticlockwise around the field, p lattice steps per side
+    lattice = ([(x0 + i, y0) for i in range(p)] + [(x0 + p, y0 + i) for i in range(p)] +
+               [(x0 + p - i, y0 + p) for i in range(p)] + [(x0, y0 + p - i) for i in range(p)])
+    ring = [get_point(gx, gy, p) for gx, gy in lattice]
+    ring.append(ring[0])
+
+    return [ring]
+
+
+def get_value(rng, field_type, name, distribution):
+    """
+    :param rng: random.Random
+    :param field_type: type from attribute names file
+    :param name: column name
+    :param distribution: one of DISTRIBUTIONS
+    :return: generated value of column
+    """
+    low, high = VALUE_RANGES.get(name, DEFAULT_RANGE)
+
+    if field_type == 'int':
+        return rng.randint(low, high)
+    if field_type == 'date':
+        return '2020-{0:02d}-{1:02d}'.format(rng.randint(1, 12), rng.randint(1, 28))
+    if field_type == 'str':
+        return '{0}-{1:06d}'.format(name, rng.randint(0, 999999))
+
+    if distribution == 'normal':
+        value = rng.gauss((low + high) / 2, (high - low) / 6)
+    elif distribution == 'lognormal':
+        value = low + (high - low) * min(rng.lognormvariate(0, 0.75) / 6, 1)
+    else:
+        value = rng.uniform(low, high)
+    return round(min(max(value, low), high), 2)
+
+
+def generate_farm(path, n_fields, vertices, distribution='uniform', seed=0):
+    """
+    Write a synthetic farm GeoJSON file
+    :param path: path of .json file
+    :param n_fields: number of fields
+    :param vertices: vertices per polygon
+    :param distribution: distribution of numeric values, one of DISTRIBUTIONS
+    :param seed:
+    :return: path
+    """
+    rng = random.Random(seed)
+    registry = schema.get_registry()
+    with open(COLUMN_NAMES, 'r') as data:
+        columns = [c for c in data.read().splitlines() if c.strip() != '']
+
+    n_cols = math.ceil(math.sqrt(n_fields))
+    features = []
+    for i in range(n_fields):
+        properties = {}
+        for name in columns:
+            if name not in registry.fields:  # e.g. label positions, left empty
+                properties[name] = None
+            else:
+                properties[name] = get_value(rng, registry.field_type(name), name, distribution)
+        properties['name'] = str(i + 1)
+        properties['referenceArea_ha'] = HECTARES_PER_FIELD
+        properties['referenceArea'] = HECTARES_PER_FIELD * 10000
+
+        geometry = {'type': 'Polygon', 'coordinates': get_polygon(i % n_cols, i // n_cols, vertices)}
+        features.append({'type': 'Feature', 'properties': properties, 'geometry': geometry})
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as data:
+        json.dump({'type': 'FeatureCollection', 'features': features}, data)
+
+    return path
+
+
+"""
+
+    Runs
+
+"""
+
+
+def get_command(script, farm, work_dir, name):
+    """
+    :param script: name of script
+    :param farm: path to farm file
+    :param work_dir:
+    :param name: name of run, used for output files
+    :return: command line list
+    """
+    out = Path(work_dir).resolve()
+    command = [sys.executable, script + '.py', '-f', str(Path(farm).resolve()),
+               '-p', str(out / (name + '.qgs')), '--pdf', str(out / (name + '.pdf')),
+               '-c', 'P_mg_per_l', '--label_data', 'name']
+    if script == 'advanced_layout':  # name and area are always in its table
+        command += ['-t', 'P_mg_per_l', '--report', str(out / (name + '_report.json'))]
+    else:
+        command += ['-t', 'name', 'referenceArea_ha', 'P_mg_per_l']
+    return command
+
+
+def run_command(command, env):
+    """
+    Run a command and measure it
+    :param command: command line list
+    :param env: environment of process
+    :return: seconds, peak memory of process in MB (None if unknown), return code
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+
+    if hasattr(os, 'wait4'):  # resource use of this process only
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        # kilobytes on Linux, bytes on macOS
+        peak = usage.ru_maxrss / 1024 ** 2 if sys.platform == 'darwin' else usage.ru_maxrss / 1024
+        return seconds, peak, process.returncode
+
+    process.wait()
+    return time.perf_counter() - start, None, process.returncode
+
+
+def run_benchmark(args):
+    """
+    :param args: argument namespace
+    :return: dict of results keyed on '<script>/<fields>x<vertices>'
+    """
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen', BASEMAP_URL=args.basemap_url)
+    work_dir = Path(args.work_dir)
+
+    results = {}
+    for n_fields in args.fields:
+        for vertices in args.vertices:
+            size = '{0}x{1}'.format(n_fields, vertices)
+            farm = generate_farm(work_dir / ('farm_' + size + '.json'), n_fields, vertices,
+                                 args.distribution, args.seed)
+
+            for script in args.scripts:
+                name = script + '_' + size
+                report = work_dir / (name + '_report.json')
+                best = None
+                code = 0
+                for _ in range(args.repeat):
+                    if report.exists():  # never read the report of an earlier run
+                        report.unlink()
+                    seconds, peak, code = run_command(get_command(script, farm, work_dir, name), env)
+                    if code != 0:  # a run which crashed early would otherwise be the fastest
+                        logging.warning("{0} failed with exit code {1}".format(name, code))
+                        continue
+                    if best is None or seconds < best['seconds']:
+                        # stages and memory are None for scripts which don't write a run report
+                        best = {'seconds': seconds, 'peak_rss_mb': peak, 'returncode': code,
+                                'stages': None, 'memory': None}
+                        if report.exists():
+                            with open(report, 'r') as data:
+                                stored = json.load(data)
+                            best['stages'] = stored['stages']
+                            best['memory'] = stored.get('memory', {})
+
+                if best is None:
+                    best = {'seconds': None, 'peak_rss_mb': None, 'returncode': code}
+                    logging.info("{0}/{1}: failed".format(script, size))
+                else:
+                    logging.info("{0}/{1}: {2:.2f}s".format(script, size, best['seconds']))
+                results[script + '/' + size] = best
+
+    return results
+
+
+"""
+
+    Baseline
+
+"""
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE, min_seconds=MIN_REGRESSION_SECONDS):
+    """
+    :param results: dict from run_benchmark
+    :param baseline: dict from run_benchmark
+    :param tolerance: fraction slower than baseline which counts as a regression
+    :param min_seconds: slowdowns smaller than this are not regressions
+    :return: list of (key, stage, baseline seconds, seconds) which are slower than tolerance, stage None for total.
+        runs which failed are regressions with seconds None
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        if result['seconds'] is None:
+            regressions.append((key, None, baseline.get(key, {}).get('seconds'), None))
+            continue
+        if key not in baseline or baseline[key]['seconds'] is None:
+            continue
+        pairs = [(None, baseline[key]['seconds'], result['seconds'])]
+        for stage, seconds in (result.get('stages') or {}).items():
+            if stage in (baseline[key].get('stages') or {}):
+                pairs.append((stage, baseline[key]['stages'][stage], seconds))
+
+        for stage, before, after in pairs:
+            if after > before * (1 + tolerance) and after - before >= min_seconds:
+                regressions.append((key, stage, before, after))
+
+    return regressions
+
+
+def print_results(results, baseline):
+    print("{0:<36}{1:>10}{2:>10}{3:>9}{4:>10}".format('run', 'baseline', 'seconds', 'change', 'peak MB'))
+    for key, result in sorted(results.items()):
+        before = baseline.get(key, {}).get('seconds')
+        seconds = result['seconds']
+        change = '' if before is None or seconds is None else '{0:+.0%}'.format(seconds / before - 1)
+        peak = '' if result['peak_rss_mb'] is None else '{0:.0f}'.format(result['peak_rss_mb'])
+        print("{0:<36}{1:>10}{2:>10}{3:>9}{4:>10}".format(key, '' if before is None else '{0:.2f}'.format(before),
+                                                          'failed' if seconds is None else '{0:.2f}'.format(seconds),
+                                                          change, peak))
+
+
+def main(args):
+    """
+    :return: number of regressions
+    """
+    results = run_benchmark(args)
+
+    if args.save_baseline:
+        Path(args.baseline).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.baseline, 'w') as data:
+            json.dump({'machine': platform.node(), 'python': platform.python_version(), 'results': results},
+                      data, indent=2)
+        logging.info("baseline written to {0}".format(args.baseline))
+        print_results(results, {})
+        return 0
+
+    baseline = {}
+    if Path(args.baseline).exists():
+        with open(args.baseline, 'r') as data:
+            stored = json.load(data)
+        if stored['machine'] != platform.node():
+            logging.warning("baseline was recorded on {0}, timings may not be comparable".format(stored['machine']))
+        baseline = stored['results']
+    else:
+        logging.warning("no baseline at {0}, run with --save_baseline first".format(args.baseline))
+
+    print_results(results, baseline)
+    regressions = compare(results, baseline, args.tolerance)
+    for key, stage, before, after in regressions:
+        if after is None:
+            logging.warning("regression {0}: run failed".format(key))
+            continue
+        logging.warning("regression {0}{1}: {2:.2f}s -> {3:.2f}s".format(key, '' if stage is None else ' ' + stage,
+                                                                         before, after))
+    return len(regressions)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    arguments = get_args()
+
+    sys.exit(1 if main(arguments) else 0)
@@ -0,0 +1,233 @@
+"""
+    Classification of layer attributes into graduated renderer ranges
+
+    Values of the classification attribute are read into a NumPy array once and class breaks are computed
+    with vectorised code, so large layers are classified without the renderer scanning the layer itself.
+
+    Methods:
+        equal_interval  classes of equal width between min and max
+        quantile        classes with (about) the same number of features
+        std_dev         class breaks one standard deviation apart, centred on the mean
+        jenks           natural breaks, minimises the variance within classes
+
+    P_mg_per_l and K_mg_per_l use natural breaks by default.
+"""
+import hashlib
+import logging
+import numpy as np
+from qgis.core import *
+
+DEFAULT_CLASSES = 10
+DEFAULT_METHOD = 'equal_interval'
+# continuous variables classified with natural breaks unless another method is given
+FIELD_METHODS = {'P_mg_per_l': 'jenks', 'K_mg_per_l': 'jenks'}
+MAX_CACHED_JENKS = 128
+JENKS_CACHE = {}  # (digest of sorted values, classes): breaks
+
+
+def get_values(l, field):
+    """
+    Read values of a field or expression into an array, NULL values are dropped
+    :param l: vector layer
+    :param field: field name or expression
+    :return: 1d float array
+    """
+    values, ok, n_null = QgsVectorLayerUtils.getDoubleValues(l, field)
+    if not ok:
+        raise ValueError("cannot read values of '{0}' from layer {1}".format(field, l.name()))
+
+    return np.asarray(values, dtype=float)
+
+
+def equal_interval(values, classes):
+    """
+    :param values: 1d array
+    :param classes: number of classes
+    :return: array of classes + 1 breaks, first is the minimum and last the maximum
+    """
+    return np.linspace(values.min(), values.max(), classes + 1)
+
+
+def quantile(values, classes):
+    return np.quantile(values, np.linspace(0, 1, classes + 1))
+
+
+def std_dev(values, classes):
+    mean = values.mean()
+    sd = values.std()
+    inner = mean + (sd * (np.arange(1, classes) - (classes / 2)))
+    inner = np.clip(inner, values.min(), values.max())
+
+    return np.concatenate(([values.min()], inner, [values.max()]))
+
+
+def get_ssd(s0, s1, s2, i, j):
+    """
+    sum of squared deviations of runs x[i:j] of sorted values, from prefix sums of counts, x and x**2
+    """
+    total = s1[j] - s1[i]
+    return (s2[j] - s2[i]) - (total * total / (s0[j] - s0[i]))
+
+
+def get_next_costs(prev, c, s0, s1, s2):
+    """
+    One step of the Fisher-Jenks dynamic program: least deviation of x[:j] in c + 1 classes for every j,
+    given the least deviation prev[i] of x[:i] in c classes.
+    the start of the last class never moves left as j grows, so it is found by divide and conquer,
+    all intervals of one level of the recursion are solved in a single vectorised pass
+    :param prev: array of costs in c classes, length n + 1
+    :param c: number of classes of prev
+    :param s0: prefix sums of counts of values
+    :param s1: prefix sums of values
+    :param s2: prefix sums of squared values
+    :return: array of costs in c + 1 classes, array of start of last class
+    """
+    n = prev.size - 1
+    cost = np.full(n + 1, np.inf)
+    starts = np.zeros(n + 1, dtype=int)
+
+    # intervals of j still to solve and the range their last class can start in
+    j_lo, j_hi = np.array([c + 1]), np.array([n])
+    i_lo, i_hi = np.array([c]), np.array([n - 1])
+    while j_lo.size:
+        mid = (j_lo + j_hi) // 2
+        counts = np.minimum(i_hi, mid - 1) - i_lo + 1
+        offsets = np.cumsum(counts) - counts
+
+        # every candidate start of every interval, flattened
+        task = np.repeat(np.arange(mid.size), counts)
+        i = i_lo[task] + (np.arange(task.size) - offsets[task])
+        total = prev[i] + get_ssd(s0, s1, s2, i, mid[task])
+
+        lowest = np.minimum.reduceat(total, offsets)
+        # first minimum of each interval, candidates are in order of start
+        best = np.minimum.reduceat(np.where(total == lowest[task], i, n), offsets)
+        cost[mid] = lowest
+        starts[mid] = best
+
+        left = j_lo < mid
+        right = mid < j_hi
+        j_lo, j_hi = np.concatenate((j_lo[left], mid[right] + 1)), np.concatenate((mid[left] - 1, j_hi[right]))
+        i_lo, i_hi = np.concatenate((i_lo[left], best[right])), np.concatenate((best[left], i_hi[right]))
+
+    return cost, starts
+
+
+def get_jenks_breaks(x, classes):
+    """
+    :param x: sorted 1d array
+    :param classes: number of classes
+    :return: array of classes + 1 breaks, fewer if there are fewer distinct values than classes
+    """
+    # equal values always share a class, so classify distinct values weighted by their counts
+    x, counts = np.unique(x, return_counts=True)
+    n = x.size
+    classes = min(classes, n)
+
+    centred = x - np.average(x, weights=counts)  # keeps prefix sums small so deviations don't cancel out
+    s0 = np.concatenate(([0], np.cumsum(counts)))
+    s1 = np.concatenate(([0.], np.cumsum(counts * centred)))
+    s2 = np.concatenate(([0.], np.cumsum(counts * centred * centred)))
+
+    cost = np.concatenate(([0.], get_ssd(s0, s1, s2, np.zeros(n, dtype=int), np.arange(1, n + 1))))
+    starts = []
+    for c in range(1, classes):
+        cost, start = get_next_costs(cost, c, s0, s1, s2)
+        starts.append(start)
+
+    # walk back through the start of each class
+    breaks = [x[-1]]
+    j = n
+    for start in reversed(starts):
+        j = start[j]
+        breaks.append(x[j - 1])
+    breaks.append(x[0])
+
+    return np.array(breaks[::-1])
+
+
+def jenks(values, classes, sample_size=None):
+    """
+    Jenks natural breaks, exact Fisher-Jenks optimisation in O(k n log n) so regional layers need no sampling.
+    results are memoized by the values and number of classes, re-exports of the same data reuse them
+    :param values: 1d array
+    :param classes: number of classes
+    :param sample_size: optionally classify a random sample of this many values if there are more
+    :return: array of classes + 1 breaks
+    """
+    if sample_size is not None and values.size > sample_size:
+        sample = np.random.default_rng(0).choice(values, sample_size, replace=False)
+        # keep the extremes so the classes cover all values
+        values = np.concatenate((sample, [values.min(), values.max()]))
+
+    x = np.sort(values)
+    key = (hashlib.sha1(x.tobytes()).hexdigest(), classes)
+
+    if key not in JENKS_CACHE:
+        if len(JENKS_CACHE) >= MAX_CACHED_JENKS:
+            JENKS_CACHE.pop(next(iter(JENKS_CACHE)))  # oldest result
+        JENKS_CACHE[key] = get_jenks_breaks(x, classes)
+
+    return JENKS_CACHE[key].copy()
+
+
+METHODS = {
+    'equal_interval': equal_interval,
+    'quantile': quantile,
+    'std_dev': std_dev,
+    'jenks': jenks,
+}
+
+
+def get_method(field, method=None):
+    """
+    :param field: field being classified
+    :param method: method asked for, or None for the default of field
+    :return: name of classification method
+    """
+    return method or FIELD_METHODS.get(field, DEFAULT_METHOD)
+
+
+def get_breaks(values, classes=DEFAULT_CLASSES, method=DEFAULT_METHOD):
+    """
+    :param values: 1d array
+    :param classes: number of classes
+    :param method: name of classification method, key of METHODS
+    :return: array of unique breaks, one more than the number of classes (fewer if values repeat)
+    """
+    if method not in METHODS:
+        raise ValueError("unknown classification method '{0}', use one of {1}".format(method, list(METHODS)))
+    if values.size == 0:
+        return np.array([])
+
+    return np.unique(METHODS[method](values, classes))
+
+
+def get_ranges(l, field, ramp, classes=DEFAULT_CLASSES, method=None, precision=1):
+    """
+    Classify a layer attribute into renderer ranges
+    :param l: vector layer
+    :param field: field name or expression
+    :param ramp: QgsColorRamp to colour classes with
+    :param classes: number of classes
+    :param method: name of classification method, or None for the default of field (see FIELD_METHODS)
+    :param precision: decimal places of range labels
+    :return: list of QgsRendererRange, empty if there are fewer than two distinct values to classify
+    """
+    method = get_method(field, method)
+    breaks = get_breaks(get_values(l, field), classes, method)
+    if breaks.size < 2:  # all values NULL or the same
+        logging.warning("{0} has {1} distinct values, not classified".format(field, breaks.size))
+        return []
+
+    label = '{0:.' + str(precision) + 'f}-{1:.' + str(precision) + 'f}'
+    n = breaks.size - 1
+    range_list = []
+    for i in range(n):
+        sym = QgsSymbol.defaultSymbol(l.geometryType())
+        sym.setColor(ramp.color(i / (n - 1) if n > 1 else 0))
+        lower, upper = float(breaks[i]), float(breaks[i + 1])
+        range_list.append(QgsRendererRange(lower, upper, sym, label.format(lower, upper)))
+
+    logging.info("classified {0} into {1} classes ({2})".format(field, n, method))
+    return range_list
@@ -17,7 +17,11 @@ import os
 import logging
 from qgis.core import *
 from qgis.PyQt import QtGui
+from qgis.PyQt.QtCore import QVariant
 from pathlib import Path
+import classification
+import transforms
+import inset_maps
 
 # Identify environment variable file
 env_path = Path('.') / 'qgis_variables.env'
@@ -42,6 +46,7 @@ PH_INDEX_COLORS = [[0, 5.5, '#f00000'],
                    [7.5, 7.6, '#8000ff'],
                    [7.7, 14.0, '#ff00ff']]
 DEFAULT_PROJECT_DIR = 'projects/'
+DEFAULT_BASEMAP_URL = 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}'
 Path(DEFAULT_PROJECT_DIR).mkdir(parents=True, exist_ok=True)
 
 
@@ -72,16 +77,7 @@ def get_layer(arguments, proj):
     # create layer
     layer = QgsVectorLayer(arguments.file, "fields", "ogr")
 
-    # round to two decimal places all feature attribures that will go into table
-    # todo round without editing the source file for layer!
-    # possibly create a new temp file? or file in same project dir??
-    with edit(layer):
-        for feature in layer.getFeatures():
-            for name in arguments.table_fields:
-                if isinstance(feature[name], float):  # if a float value round to two decimal places
-                    feature.setAttribute(feature.fieldNameIndex(name), round(feature[name], 2))
-                    layer.updateFeature(feature)
-
+    # float values are rounded when the table is displayed, see set_table_rounding()
     if not layer.isValid():
         logging.info("Layer failed to load!")
     else:
@@ -90,6 +86,21 @@ def get_layer(arguments, proj):
     return layer
 
 
+def set_table_rounding(table, l):
+    """
+    Show float values of a table rounded to two decimal places, the source file for layer is not edited
+    :param table: QgsLayoutItemAttributeTable
+    :param l: layer of table
+    :return:
+    """
+    columns = table.columns()
+    for column in columns:
+        field_id = l.fields().indexFromName(column.attribute())
+        if field_id != -1 and l.fields().at(field_id).type() == QVariant.Double:
+            column.setAttribute('round("{0}", 2)'.format(column.attribute()))
+    table.setColumns(columns)
+
+
 def get_layout(name, proj):
     manager = proj.layoutManager()
 
@@ -118,24 +129,12 @@ def get_layout(name, proj):
 
 
 def get_rectangle(l, proj):
-    # get layer extents
-    ext = l.extent()  # QgsRectangle object
-    xmin = ext.xMinimum()  # floats
-    xmax = ext.xMaximum()
-    ymin = ext.yMinimum()
-    ymax = ext.yMaximum()
-
-    r_min = QgsPointXY(xmin, ymin)
-    r_max = QgsPointXY(xmax, ymax)
-
-    rect = QgsRectangle(r_min, r_max)
-
-    src_crs = QgsCoordinateReferenceSystem(4326)
-    dest_crs = QgsCoordinateReferenceSystem(32629)
-    xform = QgsCoordinateTransform(src_crs, dest_crs, proj)
-    rect = xform.transform(rect)
-
-    return rect
+    """
+    :param l: layer
+    :param proj: project, extent is given in project CRS
+    :return: QgsRectangle of layer extent
+    """
+    return transforms.transform_rect(l.extent(), l.crs().authid(), proj.crs().authid())
 
 """
 def round_data(l, dec_places):
@@ -201,11 +200,12 @@ def set_polygon_style(l, code=None):
         styles = QgsStyle().defaultStyle()
         defaultColorRampNames = styles.colorRampNames()
         ramp = styles.colorRamp(defaultColorRampNames[-6])
-        renderer = QgsGraduatedSymbolRenderer()
-        renderer.setClassAttribute(code)
+        range_list = classification.get_ranges(l, code, ramp)
+        if not range_list:  # nothing to classify, use default style
+            set_polygon_style(l)
+            return
+        renderer = QgsGraduatedSymbolRenderer(code, range_list)
         renderer.setSourceColorRamp(ramp)
-        # todo allow argument for number of classes
-        renderer.updateClasses(l, QgsGraduatedSymbolRenderer.EqualInterval, 10)
         l.setRenderer(renderer)
 
 
@@ -303,32 +303,15 @@ def main(args):
     app = QgsApplication([], False, None)
     QgsApplication.initQgis()
 
-    # need to remove old layers and layouts from QgsProject.instance() because using
-    # QgsApplication.exitQgis() doesn't work when called from GUI
-
-    # remove old layers
-    registryLayers = QgsProject.instance().mapLayers().keys()
-    layersToRemove = set(registryLayers)
-    QgsProject.instance().removeMapLayers(list(layersToRemove))
-
-    # remove old layouts
-    layout_manager = QgsProject.instance().layoutManager()
-    layouts_list = layout_manager.printLayouts()
-    for l in layouts_list:
-        layout_manager.removeLayout(l)
-
-    # project is 'cleared' now
-    project = QgsProject.instance()
+    # each run builds into its own project, layers and layouts are freed with it
+    project = QgsProject()
     proj_path = str(get_project_path(args.project_path))
     project.setFileName(proj_path)  # set project name
-    crs = QgsCoordinateReferenceSystem()
-    crs.createFromString("EPSG:32629")
-    project.setCrs(crs)
 
     # add tile layer
-    tile_layer_url = 'type=xyz&url=https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}'
+    # BASEMAP_URL overrides the tile url, empty disables the basemap
+    tile_layer_url = 'type=xyz&url=' + os.environ.get('BASEMAP_URL', DEFAULT_BASEMAP_URL)
     tile_layer = QgsRasterLayer(tile_layer_url, 'ESRI', 'wms')
-    # tile_layer.setCrs(crs)
 
     if tile_layer.isValid():
         project.addMapLayer(tile_layer)
@@ -346,6 +329,9 @@ def main(args):
     # Create a layer
     new_layer = get_layer(args, project)
 
+    # draw maps in the UTM zone of the farm
+    project.setCrs(transforms.get_crs(transforms.get_layer_utm_authid(new_layer)))
+
     # order layer features by 'name'
     request = QgsFeatureRequest()
 
@@ -372,22 +358,18 @@ def main(args):
     layout.addLayoutItem(map)
     map.attemptResize(page_size)  # resize map to layout size
 
-    if args.map_count > 1:  # add the rest of the maps in smaller size
-        for c in range(args.map_count-1):  # -1 since one map already created
-            # creating a map based on layout
-            map = QgsLayoutItemMap(layout)
-            # I have no idea what this does, but it is necessary
-            map.setRect(20, 20, 20, 20)
-            map.setExtent(get_rectangle(new_layer, project))  # Set Map Extent
-            map.setReferencePoint(QgsLayoutItem.LowerRight)
-            set_frame(map)  # set frame attributes around map
-            layout.addLayoutItem(map)
-            map.attemptResize(QgsLayoutSize(page_size.width()/2,
-                                            page_size.width()/2,
-                                            QgsUnitTypes.LayoutMillimeters))
-            map.attemptMove(QgsLayoutPoint(page_size.width()-(50*c),
-                                           page_size.height()-(50*c),
-                                           QgsUnitTypes.LayoutMillimeters))
+    # add the rest of the maps in smaller size, cropped from one render of the full sized map
+    insets = []
+    for c in range(args.map_count-1):  # -1 since one map already created
+        inset = inset_maps.add_inset(layout,
+                                     (page_size.width()/2, page_size.width()/2),
+                                     QgsLayoutPoint(page_size.width()-(50*c),
+                                                    page_size.height()-(50*c),
+                                                    QgsUnitTypes.LayoutMillimeters))
+        set_frame(inset)  # set frame attributes around map
+        insets.append(inset)
+    inset_maps.render_insets(layout, map, insets, get_rectangle(new_layer, project),
+                             project.layerTreeRoot().layerOrder(), proj_path)
 
     # table config
     #table_config = QgsAttributeTableConfig()
@@ -398,6 +380,7 @@ def main(args):
     table = QgsLayoutItemAttributeTable.create(layout)
     table.setVectorLayer(new_layer)  # add layer info to table
     table.setDisplayedFields(args.table_fields)
+    set_table_rounding(table, new_layer)  # rounded values, layer data is not edited
 
     # Create table font
     content_font, header_font = get_fonts()
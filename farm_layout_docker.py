@@ -16,15 +16,19 @@
 
 from qgis.core import *
 from qgis.PyQt import QtGui
+from qgis.PyQt.QtCore import QVariant
 import os
 import logging
 from pathlib import Path
+import classification
+import transforms
 
 # dictionary defining polygon style
 # for accepted dict key values see https://qgis.org/api/qgsfillsymbollayer_8cpp_source.html#l00160
 DEFAULT_POLYGON_STYLE = {'color': '0,0,0,0', 'line_color': 'white', 'width_border': '2.0'}
 DEFAULT_INDEX_COLORS = ['#0011FF', '#00FF00', '#FCFC0C', '#FF0000']
 DEFAULT_PROJECT_DIR = 'projects/'
+DEFAULT_BASEMAP_URL = 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}'
 Path(DEFAULT_PROJECT_DIR).mkdir(parents=True, exist_ok=True)
 os.environ["QT_QPA_PLATFORM"]="offscreen"
 
@@ -47,6 +51,11 @@ def get_args():
                         help="variable to colour code map")
     parser.add_argument("--label_data", type=str,
                         help="data column to create labels out of")
+    parser.add_argument("--classes", type=int, default=classification.DEFAULT_CLASSES,
+                        help="number of classes when colour coding a continuous variable")
+    parser.add_argument("--classification", type=str, choices=list(classification.METHODS),
+                        help="method used to classify a continuous variable for colour coding, "
+                             "default is natural breaks for P and K and equal interval otherwise")
     parser.add_argument("--pdf", type=str, help="path to .pdf file to export layout to")
     return parser.parse_args()
 
@@ -55,16 +64,7 @@ def get_layer(arguments, proj):
     # create layer
     layer = QgsVectorLayer(arguments.file, "fields", "ogr")
 
-    # round to two decimal places all feature attribures that will go into table
-    # todo round without editing the source file for layer!
-    # possibly create a new temp file? or file in same project dir??
-    with edit(layer):
-        for feature in layer.getFeatures():
-            for name in arguments.table_fields:
-                if isinstance(feature[name], float):  # if a float value round to two decimal places
-                    feature.setAttribute(feature.fieldNameIndex(name), round(feature[name], 2))
-                    layer.updateFeature(feature)
-
+    # float values are rounded when the table is displayed, see set_table_rounding()
     if not layer.isValid():
         logging.info("Layer failed to load!")
     else:
@@ -73,6 +73,21 @@ def get_layer(arguments, proj):
     return layer
 
 
+def set_table_rounding(table, l):
+    """
+    Show float values of a table rounded to two decimal places, the source file for layer is not edited
+    :param table: QgsLayoutItemAttributeTable
+    :param l: layer of table
+    :return:
+    """
+    columns = table.columns()
+    for column in columns:
+        field_id = l.fields().indexFromName(column.attribute())
+        if field_id != -1 and l.fields().at(field_id).type() == QVariant.Double:
+            column.setAttribute('round("{0}", 2)'.format(column.attribute()))
+    table.setColumns(columns)
+
+
 def get_layout(name, proj):
     manager = proj.layoutManager()
 
@@ -101,24 +116,12 @@ def get_layout(name, proj):
 
 
 def get_rectangle(l, proj):
-    # get layer extents
-    ext = l.extent()  # QgsRectangle object
-    xmin = ext.xMinimum()  # floats
-    xmax = ext.xMaximum()
-    ymin = ext.yMinimum()
-    ymax = ext.yMaximum()
-
-    r_min = QgsPointXY(xmin, ymin)
-    r_max = QgsPointXY(xmax, ymax)
-
-    rect = QgsRectangle(r_min, r_max)
-
-    src_crs = QgsCoordinateReferenceSystem(4326)
-    dest_crs = QgsCoordinateReferenceSystem(32629)
-    xform = QgsCoordinateTransform(src_crs, dest_crs, proj)
-    rect = xform.transform(rect)
-
-    return rect
+    """
+    :param l: layer
+    :param proj: project, extent is given in project CRS
+    :return: QgsRectangle of layer extent
+    """
+    return transforms.transform_rect(l.extent(), l.crs().authid(), proj.crs().authid())
 
 
 """
@@ -140,7 +143,7 @@ def round_data(l, dec_places):
     """
 
 
-def set_polygon_style(l, code=None):
+def set_polygon_style(l, code=None, classes=classification.DEFAULT_CLASSES, method=None):
     """
     function which will render colours of polygons based on user input...
     todo: if no colour coding specified, apply default white polygon boundaries and no fill
@@ -148,6 +151,8 @@ def set_polygon_style(l, code=None):
         - create another utilities file for rendering layers based on Farmeye-specific use cases
     :param l: a layer
     :param code: variable to base colour coding on
+    :param classes: number of classes for a continuous variable
+    :param method: classification method for a continuous variable, see classification.METHODS, None for default
     :return:
     """
 
@@ -158,13 +163,9 @@ def set_polygon_style(l, code=None):
         l.renderer().setSymbol(symbol)
         l.triggerRepaint()
     elif code.startswith('index'):  # if an index is used for color coding
-        vals = []
-        for f in l.getFeatures():
-            vals.append(f[code])
-
-        # lower = sorted(vals)[0]
+        # lower = values.min()
         lower = 0
-        upper = sorted(vals)[-1]
+        upper = classification.get_values(l, code).max()
         step = (upper - lower) / len(DEFAULT_INDEX_COLORS)
         range_list = []
         for c in DEFAULT_INDEX_COLORS:
@@ -182,11 +183,12 @@ def set_polygon_style(l, code=None):
         styles = QgsStyle().defaultStyle()
         defaultColorRampNames = styles.colorRampNames()
         ramp = styles.colorRamp(defaultColorRampNames[-6])
-        renderer = QgsGraduatedSymbolRenderer()
-        renderer.setClassAttribute(code)
+        range_list = classification.get_ranges(l, code, ramp, classes, method)
+        if not range_list:  # nothing to classify, use default style
+            set_polygon_style(l)
+            return
+        renderer = QgsGraduatedSymbolRenderer(code, range_list)
         renderer.setSourceColorRamp(ramp)
-        # todo allow argument for number of classes
-        renderer.updateClasses(l, QgsGraduatedSymbolRenderer.EqualInterval, 10)
         l.setRenderer(renderer)
 
 
@@ -284,32 +286,15 @@ def main(args):
     app = QgsApplication([], False)
     QgsApplication.initQgis()
 
-    # need to remove old layers and layouts from QgsProject.instance() because using
-    # QgsApplication.exitQgis() doesn't work when called from GUI
-
-    # remove old layers
-    registryLayers = QgsProject.instance().mapLayers().keys()
-    layersToRemove = set(registryLayers)
-    QgsProject.instance().removeMapLayers(list(layersToRemove))
-
-    # remove old layouts
-    layout_manager = QgsProject.instance().layoutManager()
-    layouts_list = layout_manager.printLayouts()
-    for l in layouts_list:
-        layout_manager.removeLayout(l)
-
-    # project is 'cleared' now
-    project = QgsProject.instance()
+    # each run builds into its own project, layers and layouts are freed with it
+    project = QgsProject()
     proj_path = str(get_project_path(args.project_path))
     project.setFileName(proj_path)  # set project name
-    crs = QgsCoordinateReferenceSystem()
-    crs.createFromString("EPSG:32629")
-    project.setCrs(crs)
 
     # add tile layer
-    tile_layer_url = 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}'
+    # BASEMAP_URL overrides the tile url, empty disables the basemap
+    tile_layer_url = os.environ.get('BASEMAP_URL', DEFAULT_BASEMAP_URL)
     tile_layer = QgsRasterLayer(tile_layer_url, 'ESRI', 'wms')
-    # tile_layer.setCrs(crs)
 
     if tile_layer.isValid():
         project.addMapLayer(tile_layer)
@@ -327,6 +312,9 @@ def main(args):
     # Create a layer
     new_layer = get_layer(args, project)
 
+    # draw maps in the UTM zone of the farm
+    project.setCrs(transforms.get_crs(transforms.get_layer_utm_authid(new_layer)))
+
     # order layer features by 'name'
     request = QgsFeatureRequest()
 
@@ -338,7 +326,7 @@ def main(args):
     # features = new_layer.getFeatures(request)
 
     # set layer colours
-    set_polygon_style(new_layer, args.color_code)
+    set_polygon_style(new_layer, args.color_code, args.classes, args.classification)
 
     # set layer labels
     if args.label_data is not None or "":
@@ -379,6 +367,7 @@ def main(args):
     table = QgsLayoutItemAttributeTable.create(layout)
     table.setVectorLayer(new_layer)  # add layer info to table
     table.setDisplayedFields(args.table_fields)
+    set_table_rounding(table, new_layer)  # rounded values, layer data is not edited
 
     # Create table font
     content_font, header_font = get_fonts()
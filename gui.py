@@ -5,12 +5,42 @@ import tkinter as tk
 from tkinter import filedialog
 from pathlib import Path
 import os
+import queue
+import logging
+import multiprocessing
 import advanced_layout
 import layout_utils
+import classification
+import layout_templates
+import tiled_export
+import render_daemon
+import tracing
+import preview
 
 DEFAULT_PROJECT_DIR = 'projects/'
 Path(DEFAULT_PROJECT_DIR).mkdir(parents=True, exist_ok=True)
 UI_TO_JSON_DICT = layout_utils.get_UI_to_JSON()
+POLL_INTERVAL = 100  # ms between checks for progress of the layout process
+MISSING_INFO_ERROR = "ERROR: Required information not given. \n (project name or source file) \n\nQGIS project not created"
+# text shown on the processing screen while a stage runs
+STAGE_TEXT = {
+    'cache': "Checking cached layouts...",
+    'init': "Starting QGIS...",
+    'project': "Creating project...",
+    'layer': "Loading fields...",
+    'modify': "Preparing field data...",
+    'table': "Creating table...",
+    'legend': "Creating legend...",
+    'maps': "Creating maps...",
+    'scalebar': "Creating scalebar...",
+    'simplify': "Simplifying field boundaries...",
+    'style': "Colouring fields...",
+    'insets': "Drawing smaller maps...",
+    'preview': "Drawing preview...",
+    'export': "Exporting pdf...",
+    'raster': "Exporting image...",
+    'save': "Saving project...",
+}
 
 # namespace to hold arguments to pass to farm_layout.py
 class QGISArgs:
@@ -25,7 +55,22 @@ class QGISArgs:
         self.color_code = None
         self.label_data = None
         self.area_acres = None
+        self.classes = classification.DEFAULT_CLASSES
+        self.classification = None
         self.pdf = None
+        self.preview = None
+        self.raster = None
+        self.dpi = tiled_export.DEFAULT_DPI
+        self.tile_cache = None
+        self.basemap_cache = None
+        self.color_codes = None
+        self.label_variables = None
+        self.cache_dir = None
+        self.max_cache_size = None
+        self.force = False
+        self.template = layout_templates.DEFAULT_SPEC
+        self.report = None
+        self.daemon = False
         self.__dict__.update(kwargs)
 
 
@@ -43,6 +88,12 @@ class MainApplication(tk.Frame):
         self.processing_screen = None
         self.end_screen = None
 
+        # previews are built in one long-lived process, started with the first preview
+        self.preview_process = None
+        self.preview_requests = None
+        self.preview_results = None
+        self.preview_path = preview.get_preview_path()
+
         #self.btn_start = tk.Button(self, text="Start", command=self.start)
         #self.btn_start.pack()
 
@@ -66,20 +117,61 @@ class MainApplication(tk.Frame):
 
     def start_processing_screen(self):
         self.data_input.pack_forget()
-        self.processing_screen = ProcessingScreen(self)
+
+        # layout is created in another process so the window keeps responding and the job can be cancelled
+        events = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_job, args=(self.qgis_args, events), daemon=True)
+        process.start()
+
+        self.processing_screen = ProcessingScreen(self, process, events)
         self.processing_screen.pack(padx=20, pady=20)
         self.update()
-        # create thread to run processing script
-        #th = threading.Thread(target=farm_layout.main, args=(self.qgis_args,))
-        #th.daemon = True
-        #th.start()
-        #th.join()
-        # todo catch errors from running qgis e.g. required args not specified
-        # notify and give option to 'restart' another project
+
+    def request_preview(self, qgis_args):
+        """
+        :param qgis_args: arguments of layout to preview
+        :return:
+        """
+        if self.preview_process is None or not self.preview_process.is_alive():
+            self.preview_requests = multiprocessing.Queue()
+            self.preview_results = multiprocessing.Queue()
+            self.preview_process = multiprocessing.Process(target=preview.serve,
+                                                           args=(self.preview_requests, self.preview_results),
+                                                           daemon=True)
+            self.preview_process.start()
+            self.after(POLL_INTERVAL, self.poll_preview)
+
+        self.preview_requests.put(preview.get_preview_args(qgis_args, self.preview_path))
+
+    def poll_preview(self):
+        """
+        Show previews as they are built, stops polling when the preview process has died
+        :return:
+        """
+        alive = self.preview_process.is_alive()  # checked first, a process which just finished has sent its results
         try:
-            advanced_layout.main(self.qgis_args)
-        except AssertionError:
-            self.error_message.set("ERROR: Required information not given. \n (project name or source file) \n\nQGIS project not created")
+            while True:
+                path, error_message = self.preview_results.get(timeout=0 if alive else 1)
+                if self.data_input is not None:
+                    self.data_input.show_preview(path, error_message)
+        except queue.Empty:
+            pass
+
+        if not alive:  # crashed, e.g. inside QGIS. the next preview starts a new process
+            if self.data_input is not None:
+                self.data_input.show_preview(None, "Preview process stopped unexpectedly (exit code {0})"
+                                             .format(self.preview_process.exitcode))
+            return
+
+        self.after(POLL_INTERVAL, self.poll_preview)
+
+    def finish_processing(self, error_message=None):
+        """
+        :param error_message: message to show, or None if layout was created
+        :return:
+        """
+        if error_message is not None:
+            self.error_message.set(error_message)
             self.error.set(True)
         self.start_end_screen()
 
@@ -259,7 +351,19 @@ class DataInput(tk.Frame):
                                                offvalue=False)
         self.chkbtn_area_unit.pack(side=tk.RIGHT)
 
-        # start processing
+        # preview, rebuilt shortly after the options stop changing
+        self.preview_id = None
+        self.preview_image = None
+        self.preview_text = tk.StringVar()
+        self.preview_text.set("Select a source file to see a preview")
+        self.lbl_preview = tk.Label(master=self, textvariable=self.preview_text, compound=tk.TOP)
+        self.lbl_preview.pack(padx=frame_pad, pady=frame_pad)
+
+        preview_vars = [self.input_source_file, self.color_var, self.label_var, self.area_acres]
+        for var in preview_vars + list(self.table_field_vars.values()):
+            var.trace_add('write', self.schedule_preview)
+
+        # start processing, only the full export is run
         self.btn_create = tk.Button(master=self, text="Create QGIS Layout", command=self.run_processing)
         self.btn_create.pack()
 
@@ -267,6 +371,44 @@ class DataInput(tk.Frame):
         filename = filedialog.askopenfilename()
         self.input_source_file.set(filename)
 
+    def schedule_preview(self, *args):
+        """
+        Build a preview once options have not changed for preview.DEBOUNCE_MS
+        :param args: arguments of variable trace, not used
+        :return:
+        """
+        if self.preview_id is not None:
+            self.after_cancel(self.preview_id)
+        self.preview_id = self.after(preview.DEBOUNCE_MS, self.request_preview)
+
+    def request_preview(self):
+        self.preview_id = None
+        if not Path(self.input_source_file.get()).is_file():
+            return
+
+        try:
+            qgis_args = self.get_qgis_args("")  # preview never writes a project
+        except ValueError:  # e.g. map count being typed
+            self.preview_text.set("Map count must be a whole number")
+            return
+
+        self.preview_text.set("Drawing preview...")
+        self.master.request_preview(qgis_args)
+
+    def show_preview(self, path, error_message=None):
+        """
+        :param path: path to preview image, None if it failed
+        :param error_message:
+        :return:
+        """
+        if error_message is not None:
+            self.preview_text.set(error_message)
+            return
+
+        self.preview_image = tk.PhotoImage(file=str(path))  # reference kept so image isn't garbage collected
+        self.lbl_preview.configure(image=self.preview_image)
+        self.preview_text.set("Preview")
+
     def run_processing(self):
         """
         Using data gathered by GUI, run farm_layout.py
@@ -276,16 +418,31 @@ class DataInput(tk.Frame):
         # create full project path
         project_path = self.get_project_path(self.ent_project_name.get())
 
-        map_count = 1 if self.ent_map_count.get() is "" else int(self.ent_map_count.get())
+        qgis_args = self.get_qgis_args(project_path)
+
+        self.master.set_qgis_args(qgis_args)
+
+        # set project path in MainApplication
+        self.master.set_project_path(project_path)
+
+        self.master.start_processing_screen()
+
+    def get_qgis_args(self, project_path):
+        """
+        :param project_path: path to .qgs file
+        :return: QGISArgs from options selected in GUI
+        """
+
+        map_count = 1 if self.ent_map_count.get() == "" else int(self.ent_map_count.get())
 
         table_fields = self.get_fields(self.table_field_vars)
         fields = None if len(table_fields) == 0 else table_fields
 
         color_code = self.color_var.get()
-        color_code = None if color_code is "" else UI_TO_JSON_DICT[color_code]
+        color_code = None if color_code == "" else UI_TO_JSON_DICT[color_code]
 
         label_var = self.label_var.get()
-        label_var = None if label_var is "" else UI_TO_JSON_DICT[label_var]
+        label_var = None if label_var == "" else UI_TO_JSON_DICT[label_var]
 
         area_acres = self.area_acres.get()
 
@@ -299,12 +456,7 @@ class DataInput(tk.Frame):
                              label_data=label_var,
                              area_acres=area_acres)
 
-        self.master.set_qgis_args(qgis_args)
-
-        # set project path in MainApplication
-        self.master.set_project_path(project_path)
-
-        self.master.start_processing_screen()
+        return qgis_args
 
     def get_project_path(self, input_string):
         """
@@ -355,13 +507,54 @@ class DataInput(tk.Frame):
 
 
 class ProcessingScreen(tk.Frame):
-    def __init__(self, master):
+    def __init__(self, master, process, events):
         tk.Frame.__init__(self)
         self.master = master
+        self.process = process
+        self.events = events
 
-        self.text = tk.Label(self, text="Processing...", width=50, height=5)
+        self.stage_text = tk.StringVar()
+        self.stage_text.set("Processing...")
+        self.text = tk.Label(self, textvariable=self.stage_text, width=50, height=5)
         self.text.pack()
 
+        self.btn_cancel = tk.Button(self, text="Cancel", command=self.cancel)
+        self.btn_cancel.pack()
+
+        self.poll_id = self.after(POLL_INTERVAL, self.poll)
+
+    def poll(self):
+        """
+        Show progress events of the layout process, finish when it is done or has died
+        :return:
+        """
+        alive = self.process.is_alive()  # checked first, a process which just finished has sent all its events
+        try:
+            while True:
+                message = self.events.get(timeout=0 if alive else 1)
+                if message[0] == 'stage':
+                    self.stage_text.set(STAGE_TEXT.get(message[1], "Processing..."))
+                elif message[0] == 'done':
+                    self.process.join()
+                    self.master.finish_processing(message[1])
+                    return
+        except queue.Empty:
+            pass
+
+        if not alive:  # crashed without reporting, e.g. inside QGIS
+            self.master.finish_processing("ERROR: layout process stopped unexpectedly (exit code {0})"
+                                          .format(self.process.exitcode))
+            return
+
+        self.poll_id = self.after(POLL_INTERVAL, self.poll)
+
+    def cancel(self):
+        self.after_cancel(self.poll_id)
+        # a job submitted to the render daemon keeps running there
+        self.process.terminate()
+        self.process.join()
+        self.master.finish_processing("Cancelled\n\nQGIS project may be incomplete")
+
 
 class EndScreen(tk.Frame):
     def __init__(self, master):
@@ -413,6 +606,34 @@ class DynamicGrid(tk.Frame):
 """
 
 
+def run_job(qgis_args, events):
+    """
+    Layout process, creates the layout and reports progress
+    :param qgis_args: QGISArgs
+    :param events: queue for ('stage', name) messages while running and a final ('done', error message or None)
+    :return:
+    """
+    def send_stage(event, stage, seconds):
+        if event == 'start':
+            events.put(('stage', stage))
+
+    tracing.add_listener(send_stage)
+
+    error_message = None
+    try:
+        if render_daemon.is_running():  # QGIS already loaded in daemon, no need to start it here
+            render_daemon.submit_job(qgis_args)
+        else:
+            advanced_layout.main(qgis_args)
+    except AssertionError:
+        error_message = MISSING_INFO_ERROR
+    except Exception as e:
+        logging.exception("failed to create layout for {0}".format(qgis_args.file))
+        error_message = "ERROR: {0}\n\nQGIS project not created".format(e)
+
+    events.put(('done', error_message))
+
+
 def start_qgis_project(path):
     # run qgis project created
     os.startfile(path)
@@ -436,6 +657,7 @@ def get_form_fields(file):
     return names
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # worker processes of a frozen (PyInstaller) build run their job, not the GUI
     root = tk.Tk()
     root.title("Layout Builder")
 
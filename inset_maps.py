@@ -0,0 +1,144 @@
+"""
+    Inset maps which share one render of the primary map
+
+    Extra maps of a layout (--map_count) show the same layers and extent as the primary map at a smaller size.
+    Instead of a map item for each of them, which renders the basemap and polygons again at export, the visible
+    extent of the primary map is rendered once at the resolution the most detailed inset needs, and each inset is
+    a picture cropped from that image. Images are written next to the project so the saved project keeps them.
+
+    Insets show a snapshot of the layers, call render_insets() again after the layer style changes
+    (e.g. for each colour code variant) and before export. With a basemap cache (see basemap_cache.py) the basemap
+    of the insets is rendered once and reused by every variant, only the layers over it are rendered again.
+"""
+import math
+import logging
+from pathlib import Path
+from qgis.core import *
+from qgis.PyQt.QtCore import QRect, QSize
+from qgis.PyQt.QtGui import QImage, QPainter
+import basemap_cache
+
+IMAGE_FORMAT = 'png'  # polygons and labels, keeps transparency
+
+
+def get_size_mm(layout, item):
+    """
+    :param layout:
+    :param item: layout item
+    :return: (width, height) of item in mm
+    """
+    size = layout.convertToLayoutUnits(item.sizeWithUnits())
+    return size.width(), size.height()
+
+
+def get_inset_extent(extent, size_mm):
+    """
+    extent grown to the aspect ratio of an item, as a map item of that size would show it
+    :param extent: QgsRectangle
+    :param size_mm: (width, height) of item
+    :return: QgsRectangle with same centre
+    """
+    width, height = extent.width(), extent.height()
+    if width / height > size_mm[0] / size_mm[1]:
+        height = width * size_mm[1] / size_mm[0]
+    else:
+        width = height * size_mm[0] / size_mm[1]
+
+    centre = extent.center()
+    return QgsRectangle(centre.x() - width / 2, centre.y() - height / 2,
+                        centre.x() + width / 2, centre.y() + height / 2)
+
+
+def get_inset_path(project_path, i):
+    """
+    :param project_path: path to .qgs file
+    :param i: index of inset
+    :return: path to image of inset
+    """
+    project_path = Path(project_path)
+    return project_path.parent / '{0}_inset_{1}.{2}'.format(project_path.stem, i, IMAGE_FORMAT)
+
+
+def add_inset(layout, size_mm, position):
+    """
+    Add a picture item holding an inset map, its image is set by render_insets()
+    :param layout:
+    :param size_mm: (width, height) of inset
+    :param position: QgsLayoutPoint of lower right corner
+    :return: QgsLayoutItemPicture
+    """
+    picture = QgsLayoutItemPicture(layout)
+    picture.setResizeMode(QgsLayoutItemPicture.Zoom)  # crop may be smaller than inset where primary map ends
+    picture.setReferencePoint(QgsLayoutItem.LowerRight)
+    layout.addLayoutItem(picture)
+    picture.attemptResize(QgsLayoutSize(size_mm[0], size_mm[1], QgsUnitTypes.LayoutMillimeters))
+    picture.attemptMove(position)
+    return picture
+
+
+def render_insets(layout, map_item, insets, extent, layers, project_path, basemap=None, cache_dir=None):
+    """
+    Render the visible extent of the primary map once and set the image of each inset to its crop of it
+    :param layout:
+    :param map_item: primary QgsLayoutItemMap, with its final size and extent
+    :param insets: list of pictures from add_inset()
+    :param extent: QgsRectangle shown by insets, e.g. layer extent
+    :param layers: list of map layers, top layer first
+    :param project_path: path to .qgs file, images are written next to it
+    :param basemap: optional basemap raster layer in layers, read from cache_dir
+    :param cache_dir: optional directory of rendered basemaps, see basemap_cache.py
+    :return: list of image paths
+    """
+    if not insets:
+        return []
+
+    map_extent = map_item.extent()  # visible extent of primary map
+    dpi = layout.renderContext().dpi()
+
+    # each inset shows its own extent, limited to what the primary map shows
+    crops = [get_inset_extent(extent, get_size_mm(layout, inset)).intersect(map_extent) for inset in insets]
+
+    # one image at the scale of the most detailed inset, never more detailed than the primary map
+    mm_per_unit = max(get_size_mm(layout, inset)[0] / crop.width() for inset, crop in zip(insets, crops))
+    mm_per_unit = min(mm_per_unit, get_size_mm(layout, map_item)[0] / map_extent.width())
+    px_per_unit = mm_per_unit / 25.4 * dpi
+    size_px = QSize(int(math.ceil(map_extent.width() * px_per_unit)), int(math.ceil(map_extent.height() * px_per_unit)))
+
+    # basemap of this extent and size is the same for every variant
+    background = None
+    if basemap is not None and cache_dir is not None:
+        size_mm = (size_px.width() / dpi * 25.4, size_px.height() / dpi * 25.4)
+        path = basemap_cache.get_basemap_image(basemap, map_extent, map_item.crs(), size_mm, dpi, cache_dir)
+        if path is not None:
+            background = QImage(str(path)).convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    if background is not None and not background.isNull():
+        layers = [l for l in layers if l.id() != basemap.id()]
+    else:
+        background = None
+
+    # symbols and labels keep their printed size in the scaled image
+    image, errors = basemap_cache.render_layers(layers, map_extent, map_item.crs(), size_px, dpi)
+    for error in errors:
+        logging.warning("inset render: {0}".format(error))
+
+    if background is not None:  # layers drawn over the cached basemap
+        painter = QPainter(background)
+        painter.drawImage(0, 0, image)
+        painter.end()
+        image = background
+
+    logging.debug("rendered {0} insets from one {1}x{2} image".format(len(insets), size_px.width(),
+                                                                       size_px.height()))
+
+    paths = []
+    for i, (inset, crop) in enumerate(zip(insets, crops)):
+        rect = QRect(int((crop.xMinimum() - map_extent.xMinimum()) * px_per_unit),
+                     int((map_extent.yMaximum() - crop.yMaximum()) * px_per_unit),
+                     int(crop.width() * px_per_unit),
+                     int(crop.height() * px_per_unit))
+        path = get_inset_path(project_path, i)
+        image.copy(rect).save(str(path), IMAGE_FORMAT)
+        inset.setPicturePath(str(path.resolve()))  # reloads image of previous variant
+        paths.append(path)
+
+    return paths
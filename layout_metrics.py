@@ -0,0 +1,71 @@
+"""
+    Text measurement for sizing layout items to their content
+
+    Widths are measured once per string and font at a large reference size and scaled to the size needed,
+    measurements are kept in an LRU cache so repeated layouts in a batch don't measure the same strings again.
+    QGIS (or another Qt GUI application) must be initialised before text is measured.
+"""
+from functools import lru_cache
+from qgis.core import QgsVectorLayerUtils
+from qgis.PyQt import QtGui
+import layout_utils as utils
+
+REFERENCE_SIZE = 1000  # pixels, font size text is measured at
+MIN_COL_WIDTH = 15  # mm
+MAX_CACHED_TEXTS = 65536
+
+
+@lru_cache(maxsize=32)
+def get_font_metrics(family, bold=False):
+    """
+    :param family: font family
+    :param bold:
+    :return: QFontMetricsF of font at reference size
+    """
+    font = QtGui.QFont(family)
+    font.setPixelSize(REFERENCE_SIZE)
+    font.setBold(bold)
+    return QtGui.QFontMetricsF(font)
+
+
+@lru_cache(maxsize=MAX_CACHED_TEXTS)
+def get_relative_width(text, family, bold=False):
+    """
+    :return: width of text as a multiple of font size
+    """
+    return get_font_metrics(family, bold).horizontalAdvance(text) / REFERENCE_SIZE
+
+
+def get_text_width(text, text_format):
+    """
+    Get printed width of text
+    :param text: string
+    :param text_format: QgsTextFormat with size in mm
+    :return: width in mm
+    """
+    font = text_format.font()
+    return get_relative_width(str(text), font.family(), font.bold()) * text_format.size()
+
+
+def get_column_widths(layer, columns, heading_format, content_format):
+    """
+    Get width of each table column so that its heading and all its values fit
+    :param layer: vector layer shown in table
+    :param columns: list of QgsLayoutTableColumn
+    :param heading_format: QgsTextFormat of headings
+    :param content_format: QgsTextFormat of content
+    :return: list of widths in mm
+    """
+    widths = []
+    for column in columns:
+        width = get_text_width(column.heading(), heading_format)
+
+        values, ok = QgsVectorLayerUtils.getValues(layer, column.attribute())
+        if ok:
+            # distinct strings only, most values in a column are measured once
+            for text in set('' if v is None else str(v) for v in values):
+                width = max(width, get_text_width(text, content_format))
+
+        widths.append(max(width + (2*utils.TABLE_MARGIN), MIN_COL_WIDTH))  # margin the table is given
+
+    return widths
@@ -0,0 +1,267 @@
+"""
+    Layout templates compiled from a declarative layout spec
+
+    The look of a layout (page, paddings, legend and scalebar style, north arrow, footer label slots) is described
+    in a spec file, see layout_spec.json. The spec is compiled into a QGIS layout template (.qpt) once and cached on
+    disk under a key made from the spec, the QGIS version and this module, so designers can change the look without
+    code changes and jobs don't build those items call by call. Each job loads the template and fills in the items
+    which depend on its data by id: map extent, legend layers, scalebar map, label text and positions which depend
+    on the size of the table.
+
+    Spec items are keyed by item id, "reference" is the corner of the item and of the page it is placed from,
+    "position" is the [x, y] offset in mm from that corner of the page inside the padding.
+    A "labels" item compiles to "count" label items with ids <id>_0, <id>_1, ... stacked "spacing" mm apart.
+"""
+import os
+import json
+import uuid
+import hashlib
+import logging
+from pathlib import Path
+from qgis.core import *
+from qgis.PyQt import QtGui
+from qgis.PyQt.QtXml import QDomDocument
+
+DEFAULT_SPEC = 'layout_spec.json'
+DEFAULT_TEMPLATE_DIR = 'templates/'
+TEMPLATES = {}  # key: template xml, templates compiled or read by this process
+REFERENCES = {
+    'upper_left': QgsLayoutItem.UpperLeft,
+    'upper_right': QgsLayoutItem.UpperRight,
+    'lower_left': QgsLayoutItem.LowerLeft,
+    'lower_right': QgsLayoutItem.LowerRight,
+}
+ORIENTATIONS = {
+    'landscape': QgsLayoutItemPage.Orientation.Landscape,
+    'portrait': QgsLayoutItemPage.Orientation.Portrait,
+}
+
+
+def read_spec(spec_path=DEFAULT_SPEC):
+    """
+    :param spec_path: path to layout spec (.json)
+    :return: dict
+    """
+    with open(spec_path, 'r') as data:
+        return json.load(data)
+
+
+def get_qgis_path():
+    """
+    :return: path of QGIS install, from the QGIS environment variable (see qgis_variables.env)
+    """
+    path = os.environ.get('QGIS')
+    if not path:
+        raise ValueError("QGIS environment variable is not set, "
+                         "it must point to the QGIS install (see qgis_variables.env)")
+    return path
+
+
+def get_svg_path(svg):
+    """
+    :param svg: path of svg relative to QGIS install
+    :return: absolute path
+    """
+    return get_qgis_path() + svg
+
+
+def get_position(spec, item, page_size, offset=(0, 0)):
+    """
+    :param spec: layout spec
+    :param item: item spec
+    :param page_size: QgsLayoutSize of page
+    :param offset: (x, y) mm added to the position of the item spec, inwards from its reference corner
+    :return: QgsLayoutPoint
+    """
+    x, y = item.get('position', [0, 0])
+    x += offset[0]
+    y += offset[1]
+    reference = item.get('reference', 'upper_left')
+    padding = spec['padding']
+
+    px = padding + x if reference.endswith('left') else page_size.width() - padding - x
+    py = padding + y if reference.startswith('upper') else page_size.height() - padding - y
+
+    return QgsLayoutPoint(px, py, QgsUnitTypes.LayoutMillimeters)
+
+
+def add_map(layout, item):
+    farm_map = QgsLayoutItemMap(layout)
+    farm_map.setRect(20, 20, 20, 20)  # DO NOT REMOVE I have no idea what this does, but it is necessary
+    return [farm_map]
+
+
+def add_legend(layout, item):
+    legend = QgsLayoutItemLegend(layout)
+    legend.setResizeToContents(False)
+    legend.attemptResize(QgsLayoutSize(*item['size']))
+    legend.setStyleMargin(QgsLegendStyle.SymbolLabel, item['label_margin'])
+    legend.setSymbolWidth(item['symbol_size'][0])
+    legend.setSymbolHeight(item['symbol_size'][1])
+    legend.setStyleMargin(QgsLegendStyle.Symbol, item['symbol_margin'])
+    legend.setLineSpacing(item['line_spacing'])
+    return [legend]
+
+
+def add_scalebar(layout, item):
+    scalebar = QgsLayoutItemScaleBar(layout)
+    scalebar.setStyle(item['style'])
+    scalebar.setUnits(QgsUnitTypes.DistanceMeters)
+    scalebar.setNumberOfSegments(item['segments'])
+    scalebar.setNumberOfSegmentsLeft(0)
+    scalebar.setUnitsPerSegment(item['units_per_segment'])
+    scalebar.setUnitLabel(item['unit_label'])
+    scalebar.setMaximumBarWidth(item['max_width'])
+    scalebar.setHeight(item['height'])
+
+    # scalebar text format
+    text_format = QgsTextFormat()
+    text_format.setFont(QtGui.QFont(item['font'], 36, QtGui.QFont.Bold if item.get('bold') else QtGui.QFont.Normal))
+    text_format.setSize(item['font_size'])
+    buffer = QgsTextBufferSettings()
+    buffer.setEnabled(True)
+    buffer.setSize(item['buffer'])
+    text_format.setBuffer(buffer)
+    shadow = QgsTextShadowSettings()
+    shadow.setEnabled(item.get('shadow', False))
+    text_format.setShadow(shadow)
+    text_format.setSizeUnit(QgsUnitTypes.RenderMapUnits)
+    scalebar.setTextFormat(text_format)
+    scalebar.update()
+    return [scalebar]
+
+
+def add_picture(layout, item):
+    picture = QgsLayoutItemPicture(layout)
+    picture.setPicturePath(get_svg_path(item['svg']))
+    picture.attemptResize(QgsLayoutSize(*item['size'], QgsUnitTypes.LayoutMillimeters))
+    return [picture]
+
+
+def add_labels(layout, item):
+    labels = []
+    for i in range(item['count']):
+        label = QgsLayoutItemLabel(layout)
+        label.setFont(QtGui.QFont(item['font'], item['font_size']))
+        labels.append(label)
+    return labels
+
+
+ITEM_TYPES = {
+    'map': add_map,
+    'legend': add_legend,
+    'scalebar': add_scalebar,
+    'picture': add_picture,
+    'labels': add_labels,
+}
+
+
+def compile_template(spec, path):
+    """
+    Build a layout from a spec and save it as a template
+    :param spec: layout spec
+    :param path: path of .qpt file
+    :return:
+    """
+    project = QgsProject()  # items don't refer to layers, template doesn't depend on a project
+    layout = QgsPrintLayout(project)
+    layout.initializeDefaults()
+
+    page = layout.pageCollection().pages()[0]
+    page.setPageSize(spec['page']['size'], ORIENTATIONS[spec['page']['orientation']])
+    page_size = page.pageSize()
+
+    for item_id, item in spec['items'].items():
+        items = ITEM_TYPES[item['type']](layout, item)
+        for i, layout_item in enumerate(items):
+            layout_item.setId(item_id if len(items) == 1 else '{0}_{1}'.format(item_id, i))
+            layout_item.setReferencePoint(REFERENCES[item.get('reference', 'upper_left')])
+            layout.addLayoutItem(layout_item)
+            layout_item.attemptMove(get_position(spec, item, page_size, (0, i * item.get('spacing', 0))))
+
+    # written under a temporary name and renamed into place, so other processes never read a partial template
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.parent / '.{0}-{1}{2}'.format(path.stem, uuid.uuid4().hex, path.suffix)
+    try:
+        if not layout.saveAsTemplate(str(partial_path), QgsReadWriteContext()):
+            raise RuntimeError("could not save layout template {0}".format(path))
+        os.replace(str(partial_path), str(path))
+    finally:
+        if partial_path.exists():
+            partial_path.unlink()
+    logging.info("compiled layout template {0}".format(path))
+
+
+def get_template_key(spec):
+    """
+    :param spec: layout spec
+    :return: hex digest identifying compiled template
+    """
+    h = hashlib.sha1(json.dumps(spec, sort_keys=True).encode('utf-8'))
+    h.update(Qgis.QGIS_VERSION.encode('utf-8'))
+    h.update(get_qgis_path().encode('utf-8'))  # svg paths are absolute
+    with open(__file__, 'rb') as data:
+        h.update(data.read())
+    return h.hexdigest()
+
+
+def get_template(spec_path=DEFAULT_SPEC, template_dir=DEFAULT_TEMPLATE_DIR):
+    """
+    Get template xml for a spec, compiling it only if it isn't cached yet
+    :param spec_path: path to layout spec (.json)
+    :param template_dir: directory of compiled templates
+    :return: template xml
+    """
+    key = get_template_key(read_spec(spec_path))
+
+    if key not in TEMPLATES:
+        path = Path(template_dir) / (key + '.qpt')
+        try:
+            TEMPLATES[key] = path.read_text()
+        except FileNotFoundError:
+            compile_template(read_spec(spec_path), path)
+            TEMPLATES[key] = path.read_text()
+
+    return TEMPLATES[key]
+
+
+def get_layout(name, proj, spec_path=DEFAULT_SPEC, template_dir=DEFAULT_TEMPLATE_DIR):
+    """
+    Create a layout in a project from the compiled template of a spec, replacing a layout of the same name
+    :param name: layout name
+    :param proj: project
+    :param spec_path: path to layout spec (.json)
+    :param template_dir: directory of compiled templates
+    :return: QgsPrintLayout
+    """
+    manager = proj.layoutManager()
+
+    # remove duplicate layouts
+    for l in manager.printLayouts():
+        if l.name() == name:
+            manager.removeLayout(l)
+
+    document = QDomDocument()
+    document.setContent(get_template(spec_path, template_dir))
+    layout = QgsPrintLayout(proj)
+    items, ok = layout.loadFromTemplate(document, QgsReadWriteContext())
+    if not ok:
+        raise RuntimeError("could not load layout template for {0}".format(spec_path))
+
+    layout.setName(name)
+    manager.addLayout(layout)
+
+    return layout
+
+
+def get_item(layout, item_id):
+    """
+    :param layout:
+    :param item_id: id of item in spec
+    :return: layout item, cast to its type
+    """
+    item = layout.itemById(item_id)
+    if item is None:
+        raise ValueError("layout template has no item '{0}'".format(item_id))
+    return item
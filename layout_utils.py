@@ -2,10 +2,16 @@
     collection of utility methods for creating QGIS layout data, objects, etc...
 """
 import os
+import math
 import logging
 from qgis.core import *
 from qgis.PyQt import QtGui
+from qgis.PyQt.QtCore import QVariant
 from pathlib import Path
+import schema
+import classification
+import transforms
+import tracing
 
 # dictionary defining polygon style
 # for accepted dict key values see https://qgis.org/api/qgsfillsymbollayer_8cpp_source.html#l00160
@@ -25,13 +31,20 @@ PH_INDEX_COLORS = [[0, 5.5, '#f00000'],
                    [7.7, 14.0, '#ff00ff']]
 DEFAULT_PROJECT_DIR = 'projects/'
 Path(DEFAULT_PROJECT_DIR).mkdir(parents=True, exist_ok=True)
-DEFAULT_ATTRIBUTE_NAMES = 'attribute_names.txt'
+DEFAULT_ATTRIBUTE_NAMES = schema.DEFAULT_ATTRIBUTE_NAMES
 
 HECTARE_STRING = 'Area (ha)'
 ACRE_STRING = 'Area (ac)'
+ACRE_FIELD = 'referenceArea_ac'  # virtual field holding area in acres
+ACRES_PER_HECTARE = 2.47105
 DEFAULT_CONTENT_SIZE = 9 # mm??
 DEFAULT_COL_WIDTH = 45  # mm
 MAX_TABLE_HEIGHT = 480  # mm
+MIN_CONTENT_SIZE = 4  # mm, smallest readable table font. larger tables are split over pages
+TABLE_MARGIN = 0.75  # mm, cell margin of tables, also used to size their columns (see layout_metrics.py)
+TABLE_LINE_WIDTH = 0.5  # mm
+SIMPLIFY_PIXEL_FRACTION = 0.5  # geometries are snapped to a grid of this fraction of a printed pixel
+METRES_PER_DEGREE = 111320  # at the equator, overestimates degrees of longitude elsewhere
 
 """
 
@@ -63,101 +76,149 @@ def get_table_fields(arguments):
 
 def get_UI_to_JSON(file=DEFAULT_ATTRIBUTE_NAMES):
     """
-    Method that returns a dictionary with keys: json field name, values: UI-suitable translation
+    Method that returns a dictionary with keys: UI-suitable translation, values: json field name
+    file is only parsed again if it changed, see schema.py
     :return:
     """
-    names = {}
-
-    with open(file, 'r') as data:
-        lines = data.read().splitlines()
-
-        for line in lines:
-            array = line.split(",")
-            names[array[1]] = array[0]
-
-    return names
+    return schema.get_registry(file).ui_to_json
 
 
 def get_JSON_to_UI(file=DEFAULT_ATTRIBUTE_NAMES):
     """
     Method that returns a dictionary with keys: json field name, values: UI-suitable translation
+    file is only parsed again if it changed, see schema.py
     :return:
     """
-    names = {}
-
-    with open(file, 'r') as data:
-        lines = data.read().splitlines()
-
-        for line in lines:
-            array = line.split(",")
-            names[array[0]] = array[1]
-
-    return names
+    return schema.get_registry(file).json_to_ui
 
 
 def get_layer(arguments, proj):
     # create layer
     layer = QgsVectorLayer(arguments.file, "fields", "ogr")
 
-    # round to two decimal places all feature attribures that will go into table
-    # todo round without editing the source file for layer!
-    # possibly create a new temp file? or file in same project dir??
-    with edit(layer):
-        for feature in layer.getFeatures():
-            for name in arguments.table_fields:
-                if isinstance(feature[name], float):  # if a float value round to two decimal places
-                    feature.setAttribute(feature.fieldNameIndex(name), round(feature[name], 2))
-                    layer.updateFeature(feature)
-
     if not layer.isValid():
         logging.info("Layer failed to load!")
     else:
+        # rounding etc. is applied when displayed, source file for layer is not edited
+        set_display_fields(layer, arguments)
         proj.addMapLayer(layer)
 
     return layer
 
 
-def modify_layer(l, a):
+def set_display_fields(l, a):
     """
-    Method which modifies layer based on user input
-     - performs sorting of layer features based on 'name' attribute
-     - applies expressions to data
-     - rounds float values to 2 decimal places
-     - changes headings to UI friendly versions
+    Method which sets how layer attributes are displayed based on user input, without editing layer data
+     - UI friendly aliases as headings
+     - area in acres as a virtual field
+     - float values displayed to the precision given in attribute names file
     :param l:
     :param a: argument namespace
     :return:
     """
     json_dict = get_JSON_to_UI()
-    count = 0  # number of features in layer
 
-    with edit(l):
+    # UI friendly attribute names
+    for field_id, field in enumerate(l.fields()):
+        l.setFieldAlias(field_id, json_dict[field.name()])
+
+    # area in acres calculated from area in hectares when displayed
+    if getattr(a, 'area_acres', False):
+        expression = '"referenceArea_ha" * {0}'.format(ACRES_PER_HECTARE)
+        l.addExpressionField(expression, QgsField(ACRE_FIELD, QVariant.Double))
+        l.setFieldAlias(l.fields().indexFromName(ACRE_FIELD), ACRE_STRING)
+
+    # precision used when values are shown in forms and attribute tables in QGIS
+    registry = schema.get_registry()
+    for field_id, field in enumerate(l.fields()):
+        if field.type() == QVariant.Double:
+            setup = QgsEditorWidgetSetup('Range', {'Precision': registry.precision(field.name())})
+            l.setEditorWidgetSetup(field_id, setup)
+
+
+def get_display_expression(l, name):
+    """
+    Get expression which displays a field, float values are rounded to the field's display precision
+    can be used for table columns and labels
+    :param l: a layer
+    :param name: field name
+    :return: expression string
+    """
+    field_id = l.fields().indexFromName(name)
+    if field_id != -1 and l.fields().at(field_id).type() == QVariant.Double:
+        return 'round("{0}", {1})'.format(name, schema.get_registry().precision(name))
+
+    return name
 
-        # UI friendly attribute names
-        for field in l.fields():
-            field_id = l.fields().indexFromName(field.name())
-            l.renameAttribute(field_id, json_dict[field.name()])
 
-        # convert area to acres
-        if a.area_acres:
-            field_id = l.fields().indexFromName(HECTARE_STRING)
-            l.renameAttribute(field_id, ACRE_STRING)
+def get_simplify_tolerance(layout, map_item, l, dpi=None):
+    """
+    Get largest change to geometries of a layer which can't be seen when map item is printed
+    call after map item has its final size and extent
+    :param layout: layout containing map item
+    :param map_item: QgsLayoutItemMap, the largest scale map of the layer
+    :param l: layer
+    :param dpi: output resolution, None for the dpi of the layout
+    :return: tolerance in layer units
+    """
+    size = layout.convertToLayoutUnits(map_item.sizeWithUnits())  # QSizeF in mm
+    ground_per_mm = map_item.extent().width() / size.width()  # map units (m) per printed mm
+    pixel = 25.4 / (dpi or layout.renderContext().dpi())  # mm
+    tolerance = ground_per_mm * pixel * SIMPLIFY_PIXEL_FRACTION
 
-            for feature in l.getFeatures():
-                feature.setAttribute(feature.fieldNameIndex(ACRE_STRING), feature[ACRE_STRING]*2.47105)
-                l.updateFeature(feature)
+    if l.crs().isGeographic():
+        tolerance /= METRES_PER_DEGREE
 
-        # round to two decimal places all feature attributes that will go into table
-        for feature in l.getFeatures():
-            count += 1  # iterate count
-            for name in get_table_fields(a):
-                if isinstance(feature[name], float):  # if a float value round to two decimal places
-                    feature.setAttribute(feature.fieldNameIndex(name), round(feature[name], 2))
-                    l.updateFeature(feature)
+    return tolerance
+
+
+def count_vertices(l):
+    """
+    :param l: vector layer
+    :return: total number of vertices of all geometries
+    """
+    request = QgsFeatureRequest().setSubsetOfAttributes([])
+    return sum(f.geometry().constGet().nCoordinates() for f in l.getFeatures(request) if f.hasGeometry())
 
-        # sort based on field name
 
-    return l, count
+def simplify_layer(l, tolerance):
+    """
+    Snap vertices of all geometries of a memory layer to a grid, dropping vertices which fall on the same point.
+    all geometries share the grid so boundaries shared by polygons stay shared
+    :param l: memory layer
+    :param tolerance: grid spacing in layer units
+    :return: dict of feature id: original geometry, to restore the layer with restore_geometries
+    """
+    request = QgsFeatureRequest().setSubsetOfAttributes([])
+
+    original = {}
+    simplified = {}
+    n_before = n_after = 0
+    for f in l.getFeatures(request):
+        geom = f.geometry()
+        snapped = geom.snappedToGrid(tolerance, tolerance)
+        if snapped.isEmpty():  # polygon smaller than the grid, keep as is
+            continue
+        original[f.id()] = geom
+        simplified[f.id()] = snapped
+        n_before += geom.constGet().nCoordinates()
+        n_after += snapped.constGet().nCoordinates()
+
+    # one provider call for all features
+    l.dataProvider().changeGeometryValues(simplified)
+    logging.info("simplified {0} to {1} vertices".format(n_before, n_after))
+    tracing.count('vertices_exported', n_after)
+
+    return original
+
+
+def restore_geometries(l, geometries):
+    """
+    :param l: memory layer
+    :param geometries: dict of feature id: geometry, from simplify_layer
+    :return:
+    """
+    l.dataProvider().changeGeometryValues(geometries)
 
 
 def get_layout(name, proj):
@@ -188,24 +249,12 @@ def get_layout(name, proj):
 
 
 def get_rectangle(l, proj):
-    # get layer extents
-    ext = l.extent()  # QgsRectangle object
-    xmin = ext.xMinimum()  # floats
-    xmax = ext.xMaximum()
-    ymin = ext.yMinimum()
-    ymax = ext.yMaximum()
-
-    r_min = QgsPointXY(xmin, ymin)
-    r_max = QgsPointXY(xmax, ymax)
-
-    rect = QgsRectangle(r_min, r_max)
-
-    src_crs = QgsCoordinateReferenceSystem(4326)
-    dest_crs = QgsCoordinateReferenceSystem(32629)
-    xform = QgsCoordinateTransform(src_crs, dest_crs, proj)
-    rect = xform.transform(rect)
-
-    return rect
+    """
+    :param l: layer
+    :param proj: project, extent is given in project CRS
+    :return: QgsRectangle of layer extent
+    """
+    return transforms.transform_rect(l.extent(), l.crs().authid(), proj.crs().authid())
 
 
 def set_polygon_style(l, code=None):
@@ -251,11 +300,12 @@ def set_polygon_style(l, code=None):
         styles = QgsStyle().defaultStyle()
         defaultColorRampNames = styles.colorRampNames()
         ramp = styles.colorRamp(defaultColorRampNames[-6])
-        renderer = QgsGraduatedSymbolRenderer()
-        renderer.setClassAttribute(code)
+        range_list = classification.get_ranges(l, code, ramp)
+        if not range_list:  # nothing to classify, use default style
+            set_polygon_style(l)
+            return
+        renderer = QgsGraduatedSymbolRenderer(code, range_list)
         renderer.setSourceColorRamp(ramp)
-        # todo allow argument for number of classes
-        renderer.updateClasses(l, QgsGraduatedSymbolRenderer.EqualInterval, 10)
         l.setRenderer(renderer)
 
 
@@ -309,14 +359,17 @@ def get_fonts():
     return [content, header]
 
 
-def get_text_formats(n_features):
+def get_text_formats(n_features, content_size=None):
     """
     Method which generates QgsTextFormat objects for headings and content in table
     size is in points
+    :param n_features: number of features in table, used to calculate font size if content_size not given
+    :param content_size: optional content font size
     :return:
     """
 
-    content_size = calculate_font_size(n_features)
+    if content_size is None:
+        content_size = calculate_font_size(n_features)
     heading_size = content_size + 1
 
     heading_format = QgsTextFormat()
@@ -360,20 +413,20 @@ def get_project_path(input_string):
     return project_path
 
 
-def calculate_font_size(n_features, size=DEFAULT_CONTENT_SIZE):
+def calculate_font_size(n_features, size=DEFAULT_CONTENT_SIZE, max_height=MAX_TABLE_HEIGHT):
     """
     calculate the appropriate content font size based on number of features in layer
+    solves get_table_height(n, c + 1, c) <= max_height for the largest whole content size c
     :param n_features:
-    :param size:
+    :param size: largest content font size
+    :param max_height: height of table in mm
     :return: size of content font to be used
     """
+    fixed = 1 + (2*TABLE_MARGIN) + (2*TABLE_LINE_WIDTH) + (n_features*((2*TABLE_MARGIN) + TABLE_LINE_WIDTH))
+    largest = (max_height - fixed) / (n_features + 1)
 
-    # if table with current font size is too large, decrease font size and check again
-    if get_table_height(n_features, size + 1, size) > MAX_TABLE_HEIGHT:
-        # recursive search for font size that doesn't exceed max table height
-        size = calculate_font_size(n_features, size - 1)
-
-    return size
+    # small tolerance so sizes which fit exactly are not lost to rounding
+    return min(size, math.floor(largest + 1e-9))
 
 
 def get_table_height(n, h_size, c_size):
@@ -385,9 +438,60 @@ def get_table_height(n, h_size, c_size):
     :param c_size: content font size
     :return:
     """
-    margin = 0.75  # num pixels margin
-    line_width = 0.5
+    margin = TABLE_MARGIN
+    line_width = TABLE_LINE_WIDTH
 
     size = h_size + (2*margin) + (2*line_width) + (n*(c_size + (2*margin) + line_width))
 
     return size
+
+
+def get_rows_per_frame(h_size, c_size, max_height=MAX_TABLE_HEIGHT):
+    """
+    Method which gets the number of rows which fit in a table frame, inverse of get_table_height
+    :param h_size: header font size
+    :param c_size: content font size
+    :param max_height: height of frame in mm
+    :return: number of rows
+    """
+    fixed = h_size + (2*TABLE_MARGIN) + (2*TABLE_LINE_WIDTH)
+    row = c_size + (2*TABLE_MARGIN) + TABLE_LINE_WIDTH
+
+    return max(int((max_height - fixed) // row), 1)
+
+
+def get_table_pages(n_features, max_height=MAX_TABLE_HEIGHT, min_size=MIN_CONTENT_SIZE):
+    """
+    Method which works out the content font size of a table and how its rows are split over frames.
+    the font is shrunk to fit one frame, but not below min_size. after that rows go to more frames
+    :param n_features: number of features in table
+    :param max_height: height of a frame in mm
+    :param min_size: smallest content font size
+    :return: content font size, list with number of rows in each frame
+    """
+    size = calculate_font_size(n_features)
+    if size >= min_size:
+        return size, [n_features]
+
+    size = min_size
+    rows = get_rows_per_frame(size + 1, size, max_height)
+    n_frames = -(-n_features // rows)  # ceiling division
+    frame_rows = [rows] * (n_frames - 1) + [n_features - rows * (n_frames - 1)]
+
+    return size, frame_rows
+
+
+def add_pages(layout, n_pages):
+    """
+    Method which adds pages to a layout until it has n_pages, new pages are the size of the first page
+    :param layout:
+    :param n_pages: total number of pages
+    :return:
+    """
+    collection = layout.pageCollection()
+    size = collection.page(0).pageSize()
+
+    while collection.pageCount() < n_pages:
+        page = QgsLayoutItemPage(layout)
+        page.setPageSize(size)
+        collection.addPage(page)
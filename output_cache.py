@@ -0,0 +1,223 @@
+"""
+    Cache of layout outputs, so farms which haven't changed are not generated again
+
+    Outputs (project file, saved layer and pdfs) are stored under a key made from
+     - contents of the input file
+     - the layout arguments
+     - the attribute names file
+     - the colour tables and default polygon style
+     - the source code of this project
+    On a hit the outputs are copied to their destinations and QGIS is not used at all.
+
+    Note:
+        - cached pdfs keep the date of the run which created them
+        - the cache is kept under a size cap, least recently used entries are removed first
+        - --force builds the layout even if it is cached, the cache entry is replaced
+        - several processes can share a cache: entries are written under a temporary name and renamed into place,
+          and entries being restored are marked so that they are not evicted
+"""
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+DEFAULT_MAX_SIZE = 5 * 1024 ** 3  # bytes
+# arguments which don't change the outputs
+IGNORED_ARGS = ['daemon', 'force', 'cache_dir', 'max_cache_size', 'pdf', 'report']
+# arguments holding paths, the same file given as a relative or absolute path gives the same key
+PATH_ARGS = ['file', 'project_path', 'template', 'tile_cache', 'basemap_cache']
+MANIFEST = 'outputs.json'
+READING_PREFIX = '.reading-'  # marker files of processes restoring an entry
+STALE_READ_SECONDS = 3600  # markers older than this were left by a process which died
+
+
+def hash_file(file, h=None):
+    h = h or hashlib.sha256()
+    with open(file, 'rb') as data:
+        for block in iter(lambda: data.read(1024 ** 2), b''):
+            h.update(block)
+    return h
+
+
+def get_code_version():
+    """
+    :return: digest of all source files of this project
+    """
+    h = hashlib.sha256()
+    for file in sorted(Path(__file__).resolve().parent.glob('*.py')):
+        hash_file(file, h)
+    return h.hexdigest()
+
+
+def get_cache_key(args, attribute_file, color_tables):
+    """
+    :param args: argument namespace
+    :param attribute_file: path to attribute names file
+    :param color_tables: list of colour tables/styles used for rendering
+    :return: hex digest identifying outputs of args
+    """
+    options = {k: v for k, v in sorted(vars(args).items()) if k not in IGNORED_ARGS}
+    for k in PATH_ARGS:
+        if options.get(k):
+            options[k] = str(Path(options[k]).resolve())
+    options['pdf'] = args.pdf is not None  # only whether a pdf is exported changes the outputs
+
+    h = hash_file(args.file)
+    h.update(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+    hash_file(attribute_file, h)
+    h.update(repr(color_tables).encode('utf-8'))
+    h.update(get_code_version().encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def get_size(path):
+    try:
+        return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+    except FileNotFoundError:  # removed by another process
+        return 0
+
+
+def get_last_used(entry):
+    try:
+        return (entry / MANIFEST).stat().st_mtime
+    except FileNotFoundError:  # incomplete or removed
+        return 0
+
+
+def get_entries(cache_dir):
+    """
+    :param cache_dir:
+    :return: complete and incomplete entries, entries being written or removed are hidden
+    """
+    return [e for e in Path(cache_dir).iterdir() if e.is_dir() and not e.name.startswith('.')]
+
+
+def is_being_read(entry):
+    """
+    :param entry: cache entry directory
+    :return: True if another process is restoring outputs from entry
+    """
+    now = time.time()
+    for marker in entry.glob(READING_PREFIX + '*'):
+        try:
+            if now - marker.stat().st_mtime < STALE_READ_SECONDS:
+                return True
+        except FileNotFoundError:  # reader just finished
+            pass
+    return False
+
+
+def remove_entry(entry):
+    """
+    Rename entry out of sight first, so readers see either the whole entry or none of it
+    :param entry: cache entry directory
+    :return:
+    """
+    removed = entry.with_name('.{0}-{1}'.format(entry.name, uuid.uuid4().hex))
+    try:
+        entry.rename(removed)
+    except FileNotFoundError:  # removed by another process
+        return
+    shutil.rmtree(removed, ignore_errors=True)
+
+
+def evict(cache_dir, max_size):
+    """
+    Remove least recently used entries until cache is below max_size
+    :param cache_dir:
+    :param max_size: bytes
+    :return: number of entries removed
+    """
+    entries = sorted(get_entries(cache_dir), key=get_last_used)
+    sizes = {e: get_size(e) for e in entries}
+    total = sum(sizes.values())
+
+    removed = 0
+    for entry in entries:
+        if total <= max_size:
+            break
+        if is_being_read(entry):
+            continue
+        remove_entry(entry)
+        total -= sizes[entry]
+        removed += 1
+
+    return removed
+
+
+def restore(key, cache_dir, outputs):
+    """
+    Copy cached outputs to their destinations
+    :param key: cache key
+    :param cache_dir:
+    :param outputs: list of destination paths
+    :return: True if all outputs were restored from cache
+    """
+    entry = Path(cache_dir) / key
+    manifest = entry / MANIFEST
+    if not manifest.exists():
+        return False
+
+    marker = entry / (READING_PREFIX + uuid.uuid4().hex)  # keeps entry from being evicted while copying
+    try:
+        marker.touch()
+
+        with open(manifest, 'r') as data:
+            cached = json.load(data)
+
+        if sorted(cached) != sorted(Path(o).name for o in outputs):
+            return False
+
+        for output in outputs:
+            Path(output).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(entry / Path(output).name, output)
+
+        manifest.touch()  # mark as recently used
+        return True
+    except FileNotFoundError:  # entry replaced by another process, build layout instead
+        logging.info("cache entry {0} removed while restoring".format(key))
+        return False
+    finally:
+        try:
+            marker.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def store(key, cache_dir, outputs, max_size=DEFAULT_MAX_SIZE):
+    """
+    Copy outputs into cache
+    :param key: cache key
+    :param cache_dir:
+    :param outputs: list of paths of output files
+    :param max_size: bytes
+    :return:
+    """
+    entry = Path(cache_dir) / key
+    # written under a hidden name, other processes only see the entry once it is complete
+    partial = Path(cache_dir) / '.{0}-{1}'.format(key, uuid.uuid4().hex)
+    partial.mkdir(parents=True)
+
+    for output in outputs:
+        if not Path(output).exists():
+            logging.info("output {0} missing, layout not cached".format(output))
+            shutil.rmtree(partial)
+            return
+        shutil.copy2(output, partial / Path(output).name)
+
+    # manifest is written last, entries without one are incomplete
+    with open(partial / MANIFEST, 'w') as data:
+        json.dump([Path(o).name for o in outputs], data)
+
+    if entry.exists():
+        remove_entry(entry)
+    try:
+        partial.rename(entry)
+    except OSError:  # same layout stored by another process meanwhile
+        shutil.rmtree(partial, ignore_errors=True)
+
+    evict(cache_dir, max_size)
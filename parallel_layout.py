@@ -0,0 +1,212 @@
+"""
+    Script which generates layouts for many farms in parallel over a pool of worker processes
+
+    Each worker process initialises its own QGIS application once and then builds farm layouts
+    one after another, each job in its own QgsProject.
+    Input is the same as batch_layout.py (a directory of farm files or a manifest).
+
+    Note:
+        - results are returned in the order the jobs were given, not the order they finished
+        - jobs are handed to workers one at a time, a job which runs longer than the timeout has its worker killed
+          and replaced by a new worker
+        - a worker which crashes (e.g. segfault inside QGIS) is replaced and its job reported as failed
+"""
+import os
+import time
+import queue
+import logging
+import multiprocessing
+from collections import deque
+from pathlib import Path
+import advanced_layout
+import batch_layout
+
+POLL_INTERVAL = 0.5  # seconds between checks for timed out or crashed workers
+
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", required=True, type=str,
+                        help="directory of farm files (.json) or manifest file (.json) listing farms and options")
+    parser.add_argument("--project_dir", type=str, default=advanced_layout.DEFAULT_PROJECT_DIR,
+                        help="directory to save projects to when a farm has no project_path")
+    parser.add_argument("--pdf_dir", type=str,
+                        help="optional directory to export a pdf for each farm which has no pdf path")
+    parser.add_argument("--cache_dir", type=str,
+                        help="optional directory of cached outputs, unchanged farms are copied from it")
+    parser.add_argument("--force", action="store_true",
+                        help="build layouts even if their outputs are cached")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="optional maximum number of seconds for one farm")
+    return parser.parse_args()
+
+
+def worker(task_queue, result_queue):
+    """
+    Worker process loop. Initialises QGIS once, then builds layouts until it gets None from its task queue
+    :param task_queue: queue of (index, argument namespace) tuples for this worker
+    :param result_queue: queue for ('ready', pid, None) and ('done', pid, (index, (file, seconds, error))) messages
+    :return:
+    """
+    advanced_layout.init_qgis()
+    result_queue.put(('ready', os.getpid(), None))
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        index, args = task
+        start = time.perf_counter()
+        error = None
+        try:
+            advanced_layout.run_layout(args)
+        except Exception as e:
+            logging.exception("failed to create layout for {0}".format(args.file))
+            error = str(e)
+
+        result_queue.put(('done', os.getpid(), (index, (args.file, time.perf_counter() - start, error))))
+
+
+def start_worker(context, result_queue):
+    """
+    :return: (process, task queue of process)
+    """
+    task_queue = context.Queue()
+    process = context.Process(target=worker, args=(task_queue, result_queue), daemon=True)
+    process.start()
+    return process, task_queue
+
+
+def get_messages(result_queue):
+    """
+    Wait for a message and take every other message already queued, so finished jobs are seen before timeouts
+    :param result_queue:
+    :return: list of messages
+    """
+    try:
+        messages = [result_queue.get(timeout=POLL_INTERVAL)]
+    except queue.Empty:
+        return []
+
+    while True:
+        try:
+            messages.append(result_queue.get_nowait())
+        except queue.Empty:
+            return messages
+
+
+def run_parallel(jobs, workers=None, timeout=None):
+    """
+    Build and export a layout for every job over a pool of worker processes.
+    jobs are handed to each worker one at a time once it is ready, their timeout counts from then
+    :param jobs: list of argument namespaces
+    :param workers: number of worker processes, defaults to number of CPUs
+    :param timeout: optional maximum number of seconds for one job
+    :return: list of (file, seconds, error) tuples in job order, error is None on success
+    """
+    if len(jobs) == 0:
+        return []
+
+    workers = min(workers or os.cpu_count(), len(jobs))
+    context = multiprocessing.get_context()
+    result_queue = context.Queue()
+
+    processes = {}  # worker pid -> (process, task queue)
+    for i in range(workers):
+        p, task_queue = start_worker(context, result_queue)
+        processes[p.pid] = (p, task_queue)
+
+    results = [None] * len(jobs)
+    waiting = deque(range(len(jobs)))  # indexes of jobs not handed to a worker yet
+    running = {}  # worker pid -> (job index, time job was handed to worker)
+
+    def dispatch(pid):
+        if waiting:
+            index = waiting.popleft()
+            processes[pid][1].put((index, jobs[index]))
+            running[pid] = (index, time.monotonic())
+        else:
+            processes[pid][1].put(None)  # stop
+
+    def replace_worker(pid, error):
+        # worker only ever holds the one job it was given, messages it queued before it was killed are ignored
+        index, started = running.pop(pid)
+        processes.pop(pid)[0].terminate()
+        if waiting:
+            p, task_queue = start_worker(context, result_queue)
+            processes[p.pid] = (p, task_queue)
+        results[index] = (jobs[index].file, time.monotonic() - started, error)
+        logging.info("{0}: {1}".format(jobs[index].file, error))
+
+    while any(r is None for r in results):
+        for kind, pid, value in get_messages(result_queue):
+            if pid not in processes:  # worker was already replaced
+                continue
+            if kind == 'done':
+                if pid not in running or running[pid][0] != value[0]:
+                    continue
+                running.pop(pid)
+                index, result = value
+                results[index] = result
+                logging.info("{0}: {1:.2f}s{2}".format(result[0], result[1], "" if result[2] is None else " (failed)"))
+            dispatch(pid)
+
+        now = time.monotonic()
+        for pid, (index, started) in list(running.items()):
+            if timeout is not None and now - started > timeout:
+                replace_worker(pid, "timed out after {0:.0f}s".format(timeout))
+            elif not processes[pid][0].is_alive():
+                replace_worker(pid, "worker exited with code {0}".format(processes[pid][0].exitcode))
+
+        # forget workers which exited without a job, e.g. stopped or failed to initialise QGIS
+        for pid in [pid for pid, (p, task_queue) in processes.items() if pid not in running and not p.is_alive()]:
+            processes.pop(pid)[0].join()
+
+        if len(processes) == 0:  # nothing left to run the remaining jobs
+            for index in range(len(jobs)):
+                if results[index] is None:
+                    results[index] = (jobs[index].file, 0.0, "no workers left to run job")
+
+    for p, task_queue in processes.values():
+        task_queue.put(None)
+        p.join()
+
+    return results
+
+
+def main(args):
+    """
+    :return:
+    """
+    if args.pdf_dir is not None:
+        Path(args.pdf_dir).mkdir(parents=True, exist_ok=True)
+    Path(args.project_dir).mkdir(parents=True, exist_ok=True)
+
+    entries = batch_layout.read_manifest(args.input)
+    for entry in entries:  # options given for a farm override options for the batch
+        entry.setdefault('cache_dir', args.cache_dir)
+        entry.setdefault('force', args.force)
+
+    jobs = [batch_layout.get_farm_args(entry, args.project_dir, args.pdf_dir) for entry in entries]
+
+    start = time.perf_counter()
+    results = run_parallel(jobs, args.workers, args.timeout)
+
+    failed = [r for r in results if r[2] is not None]
+    logging.info("{0} farms in {1:.2f}s on {2} workers, {3} failed".format(len(results),
+                                                                          time.perf_counter() - start,
+                                                                          args.workers,
+                                                                          len(failed)))
+
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    arguments = get_args()
+
+    main(arguments)
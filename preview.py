@@ -0,0 +1,82 @@
+"""
+    Low resolution previews of a layout for the GUI
+
+    Previews are built in a long-lived worker process, so QGIS is only started for the first one.
+    The layout is built as for export but at advanced_layout.PREVIEW_DPI, with simplified geometries,
+    without the basemap (unless a local tile cache is given) and without saving the project.
+    Requests which arrive while a preview is being built are collapsed, only the newest is built.
+
+    Messages:
+        requests    argument namespaces from get_preview_args(), None stops the worker
+        results     (path to .png, None) or (None, error message) for each preview built
+"""
+import os
+import copy
+import queue
+import logging
+import tempfile
+from pathlib import Path
+import advanced_layout
+
+DEBOUNCE_MS = 400  # wait for options to stop changing before building a preview
+
+
+def get_preview_path():
+    """
+    :return: path of preview image for this GUI process
+    """
+    return Path(tempfile.gettempdir()) / 'layout_preview_{0}.png'.format(os.getpid())
+
+
+def get_preview_args(qgis_args, path):
+    """
+    :param qgis_args: arguments of the layout to preview
+    :param path: path to .png file
+    :return: copy of arguments which only writes the preview
+    """
+    args = copy.copy(qgis_args)
+    args.preview = str(path)
+    args.project_path = str(Path(path).with_suffix('.qgs'))  # never written
+    args.pdf = None
+    args.raster = None
+    args.report = None
+    args.cache_dir = None
+    args.daemon = False
+    return args
+
+
+def get_newest(requests):
+    """
+    Wait for a request and skip any which have been superseded by a newer one
+    :param requests: queue of requests
+    :return: newest request, None to stop
+    """
+    args = requests.get()
+    while args is not None:
+        try:
+            args = requests.get_nowait()
+        except queue.Empty:
+            break
+    return args
+
+
+def serve(requests, results):
+    """
+    Worker process, builds previews until None is requested
+    :param requests: queue of argument namespaces
+    :param results: queue of (path, error message)
+    :return:
+    """
+    advanced_layout.init_qgis()
+
+    while True:
+        args = get_newest(requests)
+        if args is None:
+            return
+
+        try:
+            advanced_layout.build_layout(args)
+            results.put((args.preview, None))
+        except Exception as e:
+            logging.exception("preview failed")
+            results.put((None, "Preview failed: {0}".format(e)))
@@ -0,0 +1,196 @@
+"""
+    Long-running render daemon which keeps QGIS loaded between layouts
+
+    QGIS is initialised once when the daemon starts, fonts and SVG resources are loaded then too,
+    so every job after that only pays for building and exporting its own layout.
+    Jobs are posted as JSON to a local HTTP endpoint, keys match the QGISArgs fields in gui.py
+    (and the arguments of advanced_layout.py). Paths in a job are made absolute by the client, since the daemon
+    runs in its own working directory. The response holds the paths of the project and pdfs.
+
+    Usage:
+        start daemon:           python render_daemon.py
+        submit from a script:   python advanced_layout.py -f farm.json -p farm --daemon
+
+    Endpoints:
+        GET  /status    check that the daemon is running
+        POST /render    build a layout, returns {"project_path": ..., "pdfs": [...], "seconds": ...}
+                        a run report is written by the daemon if the job has a report path
+"""
+import json
+import time
+import logging
+from pathlib import Path
+import urllib.error
+import urllib.request
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from qgis.core import QgsApplication
+from qgis.PyQt import QtGui
+import advanced_layout
+import batch_layout
+import layout_templates
+
+DEFAULT_HOST = '127.0.0.1'  # only accept jobs from this machine
+DEFAULT_PORT = 8765
+# job arguments holding paths, resolved against the working directory of the client
+PATH_ARGS = ['file', 'project_path', 'pdf', 'raster', 'report', 'template', 'tile_cache', 'basemap_cache',
+             'cache_dir']
+
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST,
+                        help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="port to listen on")
+    return parser.parse_args()
+
+
+def warm_up():
+    """
+    Load resources which are otherwise loaded by the first layout of each run
+    :return:
+    """
+    QtGui.QFontDatabase()  # populates application font database
+    spec = layout_templates.read_spec()
+    arrow_path = layout_templates.get_svg_path(spec['items']['north_arrow']['svg'])
+    QgsApplication.svgCache().svgAsImage(arrow_path, 60, QtGui.QColor('black'), QtGui.QColor('black'), 1, 1)
+    layout_templates.get_template()  # compiled once, before the first layout
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to the daemon. Each layout is built in its own QgsProject, requests are still
+    handled one at a time since layout items are rendered on the thread which created them
+    """
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/render':
+            self.send_json(404, {'error': 'unknown path ' + self.path})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length))
+            args = batch_layout.get_farm_args(job)
+        except Exception as e:  # e.g. TypeError from None or "" in numeric fields, client always gets a response
+            self.send_json(400, {'error': 'invalid job: {0}'.format(e)})
+            return
+
+        start = time.perf_counter()
+        try:
+            advanced_layout.main(args)  # writes run report if the job has a report path
+        except Exception as e:
+            logging.exception("failed to create layout for {0}".format(args.file))
+            self.send_json(500, {'error': str(e)})
+            return
+
+        seconds = time.perf_counter() - start
+        logging.info("{0}: {1:.2f}s".format(args.file, seconds))
+        pdfs = [o for o in advanced_layout.get_outputs(args) if Path(o).suffix == '.pdf'] if args.pdf else []
+        self.send_json(200, {'project_path': str(advanced_layout.get_project_path(args.project_path)),
+                             'pdfs': pdfs,
+                             'seconds': seconds})
+
+    def send_json(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Initialise QGIS and handle jobs until interrupted
+    :param host:
+    :param port:
+    :return:
+    """
+    advanced_layout.init_qgis()
+    warm_up()
+
+    server = HTTPServer((host, port), RenderHandler)
+    logging.info("render daemon listening on {0}:{1}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+"""
+
+    Client methods
+
+"""
+
+
+def get_url(path, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    return 'http://{0}:{1}{2}'.format(host, port, path)
+
+
+def is_running(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Check if a daemon is listening at host:port
+    :return: True if daemon is running
+    """
+    try:
+        with urllib.request.urlopen(get_url('/status', host, port), timeout=1) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def get_job(args):
+    """
+    :param args: argument namespace or QGISArgs object
+    :return: dict of job arguments with paths made absolute
+    """
+    job = dict(vars(args))
+    if job.get('project_path'):  # a bare project name is placed in the project dir of the client
+        job['project_path'] = str(advanced_layout.get_project_path(job['project_path']) or job['project_path'])
+
+    for k in PATH_ARGS:
+        if job.get(k):
+            job[k] = str(Path(job[k]).resolve())
+    return job
+
+
+def submit_job(args, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Send a layout job to the daemon and wait for it to finish
+    :param args: argument namespace or QGISArgs object
+    :param host:
+    :param port:
+    :return: dict with 'project_path', 'pdfs' (one per colour code variant) and 'seconds'
+    """
+    body = json.dumps(get_job(args)).encode('utf-8')
+    request = urllib.request.Request(get_url('/render', host, port), data=body,
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        error = json.loads(e.read()).get('error')
+        if e.code == 400:  # job could not be read by the daemon
+            raise ValueError(error)
+        raise RuntimeError(error)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    arguments = get_args()
+
+    serve(arguments.host, arguments.port)
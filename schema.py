@@ -0,0 +1,93 @@
+"""
+    Registry of the fields in farm json files, loaded once from attribute_names.txt
+
+    Each line of the file describes one field:
+        json name,UI name[,type[,display precision]]
+    type is one of str, int, float or date (default str), display precision is the number of
+    decimal places float values are shown with (default 2)
+
+    The file is parsed once and only parsed again when its modification time changes,
+    so long running processes pick up edits without re-reading the file on every lookup.
+    Dictionaries returned by the registry are updated in place on reload, so references to them stay current.
+"""
+import os
+from collections import namedtuple
+
+DEFAULT_ATTRIBUTE_NAMES = 'attribute_names.txt'
+DEFAULT_TYPE = 'str'
+DEFAULT_PRECISION = 2
+
+FieldSchema = namedtuple('FieldSchema', ['name', 'ui_name', 'type', 'precision'])
+
+
+class SchemaRegistry:
+    def __init__(self, file=DEFAULT_ATTRIBUTE_NAMES):
+        self.file = file
+        self.mtime = None
+        self.fields = {}  # json name -> FieldSchema
+        self.json_to_ui = {}
+        self.ui_to_json = {}
+
+    def refresh(self):
+        """
+        Parse file again if it was modified since it was last loaded
+        :return: self
+        """
+        mtime = os.stat(self.file).st_mtime_ns
+        if mtime != self.mtime:
+            self.load()
+            self.mtime = mtime
+
+        return self
+
+    def load(self):
+        fields = {}
+
+        with open(self.file, 'r') as data:
+            lines = data.read().splitlines()
+
+            for line in lines:
+                if line.strip() == '':
+                    continue
+                array = line.split(",")
+                field_type = array[2] if len(array) > 2 else DEFAULT_TYPE
+                precision = int(array[3]) if len(array) > 3 else DEFAULT_PRECISION
+                fields[array[0]] = FieldSchema(array[0], array[1], field_type, precision)
+
+        self.fields.clear()
+        self.fields.update(fields)
+        self.json_to_ui.clear()
+        self.json_to_ui.update({f.name: f.ui_name for f in fields.values()})
+        self.ui_to_json.clear()
+        self.ui_to_json.update({f.ui_name: f.name for f in fields.values()})
+
+    def precision(self, name):
+        """
+        :param name: json field name
+        :return: number of decimal places to display field with
+        """
+        field = self.fields.get(name)
+        return DEFAULT_PRECISION if field is None else field.precision
+
+    def field_type(self, name):
+        """
+        :param name: json field name
+        :return: type name of field, one of str, int, float or date
+        """
+        field = self.fields.get(name)
+        return DEFAULT_TYPE if field is None else field.type
+
+
+REGISTRIES = {}  # file path -> SchemaRegistry
+
+
+def get_registry(file=DEFAULT_ATTRIBUTE_NAMES):
+    """
+    Get registry for an attribute names file, loading it on first use or if it changed
+    :param file: path to attribute names file
+    :return: SchemaRegistry
+    """
+    if file not in REGISTRIES:
+        REGISTRIES[file] = SchemaRegistry(file)
+
+    return REGISTRIES[file].refresh()
@@ -0,0 +1,137 @@
+"""
+    Tests of the MBTiles tile cache and prefetch, against a stand-in tile server on localhost
+
+    Run from the repository root:
+        python -m pytest tests
+"""
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import tile_cache
+
+WORLD = (-180.0, -85.0, 180.0, 85.0)  # extent covering every tile of a zoom level
+MISSING_TILE = (1, 0, 0)  # answered with 404
+TRUNCATED_TILE = (1, 1, 0)  # answered with less data than its Content-Length
+
+
+def get_tile_data(z, x, y):
+    return '{0}/{1}/{2}'.format(z, x, y).encode('utf-8')
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    """
+    Serves /{z}/{y}/{x} with the tile coordinates as tile data
+    """
+
+    def do_GET(self):
+        z, y, x = [int(v) for v in self.path.strip('/').split('/')]
+        self.server.requests.append((z, x, y))
+        if (z, x, y) == MISSING_TILE:
+            self.send_error(404)
+            return
+
+        data = get_tile_data(z, x, y)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        if (z, x, y) == TRUNCATED_TILE:
+            self.send_header('Content-Length', str(len(data) + 100))
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.dir.name) / 'basemap.mbtiles'
+        self.cache = tile_cache.TileCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir.cleanup()
+
+    def test_tms_row(self):
+        self.assertEqual(tile_cache.tms_row(0, 0), 0)
+        self.assertEqual(tile_cache.tms_row(1, 0), 1)
+        self.assertEqual(tile_cache.tms_row(3, 2), 5)
+
+    def test_put_stores_tms_row(self):
+        self.cache.put(3, 4, 2, b'tile')
+
+        connection = sqlite3.connect(str(self.path))
+        rows = connection.execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall()
+        connection.close()
+        self.assertEqual(rows, [(3, 4, 5)])
+
+    def test_get(self):
+        self.cache.put(3, 4, 2, b'tile')
+
+        self.assertEqual(self.cache.get(3, 4, 2), b'tile')
+        self.assertIsNone(self.cache.get(3, 4, 5))  # TMS row of the tile is not its XYZ row
+        self.assertEqual(self.cache.missing([(3, 4, 2), (3, 4, 5)]), [(3, 4, 5)])
+
+    def test_evict_least_recently_used(self):
+        self.cache.max_size = 10
+        self.cache.put(1, 0, 0, b'a' * 4)
+        self.cache.put(1, 0, 1, b'b' * 4)
+        self.cache.put(1, 1, 0, b'c' * 4)
+        self.cache.connection.execute('UPDATE tile_access SET last_access = tile_column * 10 + tile_row')
+        self.cache.touch([(1, 0, 0)])  # used most recently
+
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertEqual(self.cache.size(), 8)
+        self.assertIsNone(self.cache.get(1, 0, 1))  # TMS row 0, oldest access
+        self.assertIsNotNone(self.cache.get(1, 0, 0))
+        self.assertIsNotNone(self.cache.get(1, 1, 0))
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), TileHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{0}/{{z}}/{{y}}/{{x}}'.format(self.server.server_port)
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = tile_cache.TileCache(Path(self.dir.name) / 'basemap.mbtiles')
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir.cleanup()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_failed_tiles_do_not_stop_prefetch(self):
+        fetched, cached, failed = tile_cache.prefetch(self.cache, WORLD, [0, 1], self.url, workers=4)
+
+        self.assertEqual((fetched, cached, failed), (3, 0, 2))
+        self.assertEqual(self.cache.get(0, 0, 0), get_tile_data(0, 0, 0))
+        self.assertEqual(self.cache.get(1, 1, 1), get_tile_data(1, 1, 1))
+        self.assertIsNone(self.cache.get(*MISSING_TILE))
+        self.assertIsNone(self.cache.get(*TRUNCATED_TILE))
+        self.assertEqual(self.cache.get_metadata('minzoom'), '0')
+        self.assertEqual(self.cache.get_metadata('maxzoom'), '1')
+
+    def test_cached_tiles_are_not_fetched_again(self):
+        tile_cache.prefetch(self.cache, WORLD, [1], self.url)
+        self.server.requests.clear()
+
+        fetched, cached, failed = tile_cache.prefetch(self.cache, WORLD, [1], self.url)
+
+        self.assertEqual((fetched, cached, failed), (0, 2, 2))
+        self.assertEqual(sorted(self.server.requests), sorted([MISSING_TILE, TRUNCATED_TILE]))
+
+
+if __name__ == '__main__':
+    unittest.main()
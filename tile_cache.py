@@ -0,0 +1,333 @@
+"""
+    Offline cache of basemap tiles stored as an MBTiles (SQLite) file
+
+    advanced_layout.py reads the basemap from the cache with --tile_cache instead of fetching tiles
+    from the ESRI server during pdf export. The cache is filled with the prefetch command, which downloads
+    the tiles covering a farm's extent at the zoom levels needed for A1 output, using concurrent requests.
+
+    Usage:
+        python tile_cache.py -f farm.json --cache basemap.mbtiles
+        python tile_cache.py -f farm.json --cache basemap.mbtiles --url http://localhost:8000/{z}/{y}/{x}
+
+    Note:
+        - tiles are stored in the MBTiles layout (TMS row numbering) so QGIS/GDAL can open the file directly
+        - the cache is kept under a size cap, least recently used tiles are removed first.
+            tiles count as used when they are prefetched (even if already cached) or read with get()
+"""
+import json
+import math
+import time
+import sqlite3
+import logging
+import http.client
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_TILE_URL = 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}'
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3  # bytes
+DEFAULT_DPI = 300
+DEFAULT_MAP_WIDTH = 841  # mm, width of A1 landscape page
+DEFAULT_LEVELS = 3  # number of zoom levels to fetch, ending at the level needed for output
+MAX_ZOOM = 19
+TILE_SIZE = 256  # pixels
+EARTH_CIRCUMFERENCE = 40075016.686  # m
+USER_AGENT = 'qgis-map-maker'
+
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file", required=True, nargs="+",
+                        help="farm file(s) (.json) to fetch basemap tiles for")
+    parser.add_argument("--cache", required=True, type=str,
+                        help="path to MBTiles cache file, created if it doesn't exist")
+    parser.add_argument("--url", type=str, default=DEFAULT_TILE_URL,
+                        help="tile url template with {z}, {x} and {y}")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI,
+                        help="output resolution tiles are needed for")
+    parser.add_argument("--levels", type=int, default=DEFAULT_LEVELS,
+                        help="number of zoom levels to fetch")
+    parser.add_argument("--max_size", type=int, default=DEFAULT_MAX_SIZE // 1024 ** 2,
+                        help="maximum cache size in MB")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="number of concurrent requests")
+    return parser.parse_args()
+
+
+"""
+
+    Tile maths (web mercator XYZ tiles)
+
+"""
+
+
+def lonlat_to_tile(lon, lat, zoom):
+    """
+    :return: (x, y) of XYZ tile containing point
+    """
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_extent(extent, zoom):
+    """
+    :param extent: (xmin, ymin, xmax, ymax) in degrees
+    :param zoom:
+    :return: list of (zoom, x, y) XYZ tiles covering extent
+    """
+    xmin, ymin, xmax, ymax = extent
+    x0, y0 = lonlat_to_tile(xmin, ymax, zoom)  # y counts down from north
+    x1, y1 = lonlat_to_tile(xmax, ymin, zoom)
+    return [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def zoom_for_extent(extent, width_mm=DEFAULT_MAP_WIDTH, dpi=DEFAULT_DPI):
+    """
+    Get lowest zoom level which has enough detail to print extent across width_mm at dpi
+    :param extent: (xmin, ymin, xmax, ymax) in degrees
+    :param width_mm: printed width of map
+    :param dpi:
+    :return: zoom level
+    """
+    xmin, ymin, xmax, ymax = extent
+    lat = math.radians((ymin + ymax) / 2)
+    width_m = (xmax - xmin) / 360.0 * EARTH_CIRCUMFERENCE * math.cos(lat)
+    pixels = width_mm / 25.4 * dpi
+    if width_m <= 0:
+        return MAX_ZOOM
+
+    # metres per pixel at zoom z is circumference * cos(lat) / (tile size * 2^z)
+    zoom = math.log2(EARTH_CIRCUMFERENCE * math.cos(lat) * pixels / (TILE_SIZE * width_m))
+    return min(max(int(math.ceil(zoom)), 0), MAX_ZOOM)
+
+
+def get_geojson_extent(file):
+    """
+    Get extent of all coordinates in a GeoJSON file, without loading it in QGIS
+    :param file: path to .json file (EPSG:4326)
+    :return: (xmin, ymin, xmax, ymax)
+    """
+    with open(file, 'r') as data:
+        content = json.load(data)
+
+    xs = []
+    ys = []
+
+    def add_coordinates(c):
+        if isinstance(c[0], (int, float)):
+            xs.append(c[0])
+            ys.append(c[1])
+        else:
+            for item in c:
+                add_coordinates(item)
+
+    features = content['features'] if 'features' in content else [content]
+    for feature in features:
+        geometry = feature.get('geometry', feature)
+        if geometry and geometry.get('coordinates'):
+            add_coordinates(geometry['coordinates'])
+
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+"""
+
+    MBTiles store
+
+"""
+
+
+class TileCache:
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param path: path to .mbtiles file, created if it doesn't exist
+        :param max_size: maximum total size of tile data in bytes
+        """
+        self.path = str(path)
+        self.max_size = max_size
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                                              tile_data BLOB);
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+            CREATE TABLE IF NOT EXISTS tile_access (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+                                                    last_access REAL, size INTEGER,
+                                                    PRIMARY KEY (zoom_level, tile_column, tile_row));
+            CREATE INDEX IF NOT EXISTS access_index ON tile_access (last_access);
+        ''')
+        self.set_metadata({'name': 'basemap', 'type': 'baselayer', 'version': '1.1', 'format': 'jpg'})
+
+    def close(self):
+        self.connection.close()
+
+    def set_metadata(self, values):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+                                        [(k, str(v)) for k, v in values.items()])
+
+    def get_metadata(self, name):
+        row = self.connection.execute('SELECT value FROM metadata WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def add_bounds(self, extent):
+        """
+        Grow bounds metadata to include extent, GDAL uses it as the extent of the raster
+        :param extent: (xmin, ymin, xmax, ymax) in degrees
+        """
+        bounds = self.get_metadata('bounds')
+        if bounds is not None:
+            old = [float(v) for v in bounds.split(',')]
+            extent = (min(old[0], extent[0]), min(old[1], extent[1]), max(old[2], extent[2]), max(old[3], extent[3]))
+        self.set_metadata({'bounds': ','.join(str(v) for v in extent)})
+
+    def get(self, z, x, y):
+        """
+        :return: tile data of XYZ tile, or None if not cached
+        """
+        row = self.connection.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                      'AND tile_row = ?', (z, x, tms_row(z, y))).fetchone()
+        if row is not None:
+            self.touch([(z, x, y)])
+        return None if row is None else row[0]
+
+    def missing(self, tiles):
+        """
+        :param tiles: list of (z, x, y) XYZ tiles
+        :return: tiles which are not cached
+        """
+        query = 'SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'
+        return [t for t in tiles if self.connection.execute(query, (t[0], t[1], tms_row(t[0], t[2]))).fetchone() is None]
+
+    def put(self, z, x, y, data):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                                    (z, x, tms_row(z, y), sqlite3.Binary(data)))
+            self.connection.execute('INSERT OR REPLACE INTO tile_access VALUES (?, ?, ?, ?, ?)',
+                                    (z, x, tms_row(z, y), time.time(), len(data)))
+
+    def touch(self, tiles):
+        """
+        Mark tiles as used now
+        :param tiles: list of (z, x, y) XYZ tiles
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany('UPDATE tile_access SET last_access = ? WHERE zoom_level = ? '
+                                        'AND tile_column = ? AND tile_row = ?',
+                                        [(now, z, x, tms_row(z, y)) for z, x, y in tiles])
+
+    def size(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM tile_access').fetchone()[0]
+
+    def evict(self):
+        """
+        Remove least recently used tiles until cache is below its size cap
+        :return: number of tiles removed
+        """
+        excess = self.size() - self.max_size
+        removed = 0
+        if excess <= 0:
+            return removed
+
+        rows = self.connection.execute('SELECT zoom_level, tile_column, tile_row, size FROM tile_access '
+                                       'ORDER BY last_access').fetchall()
+        victims = []
+        for z, x, row, size in rows:
+            if excess <= 0:
+                break
+            victims.append((z, x, row))
+            excess -= size
+
+        with self.connection:
+            for table in ('tiles', 'tile_access'):
+                self.connection.executemany('DELETE FROM {0} WHERE zoom_level = ? AND tile_column = ? '
+                                            'AND tile_row = ?'.format(table), victims)
+            removed = len(victims)
+
+        self.connection.execute('VACUUM')
+        return removed
+
+
+def tms_row(z, y):
+    """
+    MBTiles numbers rows from the south (TMS), XYZ tiles from the north
+    """
+    return (2 ** z) - 1 - y
+
+
+def fetch_tile(url, z, x, y, timeout=30):
+    request = urllib.request.Request(url.format(z=z, x=x, y=y), headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+def prefetch(cache, extent, zooms, url=DEFAULT_TILE_URL, workers=8):
+    """
+    Download tiles covering extent which are not in cache yet
+    :param cache: TileCache
+    :param extent: (xmin, ymin, xmax, ymax) in degrees
+    :param zooms: list of zoom levels
+    :param url: tile url template with {z}, {x} and {y}
+    :param workers: number of concurrent requests
+    :return: (number of tiles fetched, number already cached, number failed)
+    """
+    tiles = [t for z in zooms for t in tiles_for_extent(extent, z)]
+    missing = cache.missing(tiles)
+    cache.touch(tiles)
+
+    fetched = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_tile, url, *t): t for t in missing}
+        for future in as_completed(futures):
+            t = futures[future]
+            try:
+                cache.put(*t, future.result())  # sqlite connection is only used from this thread
+                fetched += 1
+            except (OSError, ValueError, http.client.HTTPException, sqlite3.Error) as e:
+                # e.g. network errors, truncated or malformed responses, one bad tile doesn't stop the others
+                logging.info("failed to fetch tile {0}: {1}".format(t, e))
+                failed += 1
+
+    zooms_cached = [int(z) for z in (cache.get_metadata('minzoom'), cache.get_metadata('maxzoom')) if z is not None]
+    cache.set_metadata({'minzoom': min(zooms_cached + list(zooms)), 'maxzoom': max(zooms_cached + list(zooms))})
+    cache.add_bounds(extent)
+    cache.evict()
+
+    return fetched, len(tiles) - len(missing), failed
+
+
+def get_zooms(extent, dpi=DEFAULT_DPI, levels=DEFAULT_LEVELS):
+    """
+    :return: zoom levels to fetch for extent, ending at the level needed to print at dpi
+    """
+    zoom = zoom_for_extent(extent, DEFAULT_MAP_WIDTH, dpi)
+    return list(range(max(zoom - levels + 1, 0), zoom + 1))
+
+
+def main(args):
+    """
+    :return:
+    """
+    cache = TileCache(args.cache, args.max_size * 1024 ** 2)
+
+    for file in args.file:
+        extent = get_geojson_extent(file)
+        zooms = get_zooms(extent, args.dpi, args.levels)
+        start = time.perf_counter()
+        fetched, cached, failed = prefetch(cache, extent, zooms, args.url, args.workers)
+        logging.info("{0}: zoom {1}-{2}, {3} tiles fetched, {4} already cached, {5} failed in {6:.2f}s".format(
+            file, zooms[0], zooms[-1], fetched, cached, failed, time.perf_counter() - start))
+
+    cache.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    arguments = get_args()
+
+    main(arguments)
@@ -0,0 +1,401 @@
+"""
+    Raster export of large layouts in strips, with memory bounded independent of dpi
+
+    QgsLayoutExporter.exportToImage renders a page as a single image, an A1 page at 300 dpi is a ~280 MB buffer
+    and grows with the square of the dpi. Here the page is rendered in full width strips of at most
+    MAX_STRIP_BYTES and each strip is streamed to the output file. Strips waiting to be encoded and written
+    are capped at MAX_PENDING_BYTES, so memory stays at a few MB whatever the page size and dpi.
+    Strips are painted straight into an RGBA image which the encoders read in place, without copies.
+
+    Outputs:
+        .tif    GeoTIFF written with GDAL, deflate compressed, georeferenced from the reference map of the layout
+        .png    written by a streaming PNG encoder, strips are compressed independently and joined into one stream
+
+    Map items would render their whole extent at the export dpi each time a strip they overlap is painted, so
+    they are rendered by this module instead: for each strip the layers of a map are rendered for the part of its
+    extent inside the strip only, then its frame is drawn. Other items are painted by the exporter, in z order with
+    the maps. Labels of a map are placed for each strip on its own. Rotated maps and maps with grids or overviews
+    are painted by the exporter like other items.
+
+    Layout items can only be painted from the thread which owns the layout, so strips are rendered one after
+    another on the calling thread while earlier strips are encoded in a pool of worker threads (zlib and GDAL
+    release the GIL). The image is written under a temporary name and renamed into place once complete.
+"""
+import os
+import uuid
+import zlib
+import struct
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from qgis.core import *
+from qgis.PyQt.QtCore import QRectF, QSizeF, Qt
+from qgis.PyQt.QtGui import QImage, QPainter, QPen
+
+try:
+    from osgeo import gdal
+except ImportError:  # .png export still works
+    gdal = None
+
+DEFAULT_DPI = 300
+MAX_STRIP_BYTES = 4 * 1024 ** 2  # RGBA bytes of one rendered strip
+MAX_PENDING_BYTES = 16 * 1024 ** 2  # RGBA bytes of strips rendered but not yet written
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1)
+PNG_COMPRESSION = 6
+ADLER_BASE = 65521  # largest prime smaller than 65536
+FORMATS = ['.tif', '.tiff', '.png']
+
+
+def get_page_region(layout, page=0):
+    """
+    :param layout:
+    :param page: index of page
+    :return: QRectF of page in layout units (mm)
+    """
+    page_item = layout.pageCollection().page(page)
+    size = layout.convertToLayoutUnits(page_item.pageSize())
+    return QRectF(page_item.pos().x(), page_item.pos().y(), size.width(), size.height())
+
+
+def get_strip_rows(width, height, max_strip_bytes=MAX_STRIP_BYTES):
+    """
+    :param width: px
+    :param height: px
+    :param max_strip_bytes:
+    :return: rows of pixels per strip
+    """
+    return max(1, min(height, max_strip_bytes // (width * 4)))
+
+
+def is_clipped_map(item):
+    """
+    :param item: layout item
+    :return: True if item is a map which can be rendered clipped to a strip
+    """
+    return (isinstance(item, QgsLayoutItemMap) and item.mapRotation() == 0 and item.itemRotation() == 0
+            and not item.grids().hasEnabledItems() and not item.overviews().hasEnabledItems())
+
+
+def get_runs(layout):
+    """
+    Split the visible items of a layout in z order into maps rendered clipped to each strip and runs of other items
+    painted together by the exporter
+    :param layout:
+    :return: list of (map item, None) or (None, list of items)
+    """
+    items = [item for item in layout.items() if isinstance(item, QgsLayoutItem) and item.isVisible()]
+    runs = []
+    for item in sorted(items, key=lambda i: i.zValue()):  # pages are at the bottom
+        if is_clipped_map(item):
+            runs.append((item, None))
+        elif runs and runs[-1][0] is None:
+            runs[-1][1].append(item)
+        else:
+            runs.append((None, [item]))
+    return runs
+
+
+def render_map_clip(painter, layout, map_item, strip_region, px_per_mm, dpi):
+    """
+    Render the part of a map inside a strip: background, layers and frame
+    :param painter: painter of strip image
+    :param layout:
+    :param map_item: QgsLayoutItemMap, not rotated
+    :param strip_region: QRectF of strip in layout units
+    :param px_per_mm: (x, y) px per layout unit
+    :param dpi:
+    :return:
+    """
+    item_rect = QRectF(map_item.pos(), map_item.rect().size())
+    clip = item_rect.intersected(strip_region)
+
+    # whole pixels of the strip, the extent is taken from them so neighbouring strips meet exactly
+    left = int(round((clip.left() - strip_region.left()) * px_per_mm[0]))
+    right = int(round((clip.right() - strip_region.left()) * px_per_mm[0]))
+    top = int(round((clip.top() - strip_region.top()) * px_per_mm[1]))
+    bottom = int(round((clip.bottom() - strip_region.top()) * px_per_mm[1]))
+
+    if right > left and bottom > top:
+        extent = map_item.extent()
+        units_per_mm = (extent.width() / item_rect.width(), extent.height() / item_rect.height())
+        x_min = strip_region.left() + left / px_per_mm[0] - item_rect.left()
+        x_max = strip_region.left() + right / px_per_mm[0] - item_rect.left()
+        y_min = strip_region.top() + top / px_per_mm[1] - item_rect.top()
+        y_max = strip_region.top() + bottom / px_per_mm[1] - item_rect.top()
+        clip_extent = QgsRectangle(extent.xMinimum() + x_min * units_per_mm[0],
+                                   extent.yMaximum() - y_max * units_per_mm[1],
+                                   extent.xMinimum() + x_max * units_per_mm[0],
+                                   extent.yMaximum() - y_min * units_per_mm[1])
+
+        if map_item.hasBackground():
+            painter.fillRect(left, top, right - left, bottom - top, map_item.backgroundColor())
+
+        settings = map_item.mapSettings(clip_extent, QSizeF(right - left, bottom - top), dpi, True)
+        painter.save()
+        try:
+            painter.translate(left, top)
+            painter.setClipRect(0, 0, right - left, bottom - top)
+            QgsMapRendererCustomPainterJob(settings, painter).renderSynchronously()
+        finally:
+            painter.restore()
+
+    if map_item.frameEnabled():  # centred on the edge of the item as the item draws it, may reach into the strip
+        stroke = layout.convertToLayoutUnits(map_item.frameStrokeWidth())
+        pen = QPen(map_item.frameStrokeColor())
+        pen.setWidthF(stroke * px_per_mm[0])
+        pen.setJoinStyle(map_item.frameJoinStyle())
+        painter.save()
+        try:
+            painter.setPen(pen)
+            painter.setBrush(Qt.NoBrush)
+            painter.drawRect(QRectF((item_rect.left() - strip_region.left()) * px_per_mm[0],
+                                    (item_rect.top() - strip_region.top()) * px_per_mm[1],
+                                    item_rect.width() * px_per_mm[0], item_rect.height() * px_per_mm[1]))
+        finally:
+            painter.restore()
+
+
+def set_visible(runs, run):
+    """
+    :param runs: from get_runs()
+    :param run: items to show, all items of runs are shown if None
+    :return:
+    """
+    for map_item, items in runs:
+        for item in items or [map_item]:
+            item.setVisible(run is None or item in run)
+
+
+def render_strip(exporter, layout, runs, region, width, rows, dpi, px_per_mm):
+    """
+    Paint a region of the layout into a new image
+    :param exporter: QgsLayoutExporter
+    :param layout:
+    :param runs: items of layout from get_runs()
+    :param region: QRectF in layout units
+    :param width: px
+    :param rows: px
+    :param dpi:
+    :param px_per_mm: (x, y) px per layout unit
+    :return: (QImage, (rows, width, 4) RGBA uint8 array viewing its pixels), keep the image while using the array
+    """
+    image = QImage(width, rows, QImage.Format_RGBA8888)  # byte order of PNG and TIFF, not premultiplied
+    dots_per_metre = int(round(dpi / 25.4 * 1000))
+    image.setDotsPerMeterX(dots_per_metre)
+    image.setDotsPerMeterY(dots_per_metre)
+    image.fill(Qt.transparent)
+
+    painter = QPainter(image)
+    try:
+        for map_item, run in runs:
+            if map_item is None:
+                if len(runs) > 1:
+                    set_visible(runs, run)
+                exporter.renderRegion(painter, region)
+            elif region.intersects(map_item.sceneBoundingRect()):  # bounding rect includes frame
+                render_map_clip(painter, layout, map_item, region, px_per_mm, dpi)
+    finally:
+        painter.end()
+
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * rows)  # 4 byte pixels, rows have no padding
+    return image, np.frombuffer(bits, np.uint8).reshape(rows, width, 4)
+
+
+def adler32_combine(adler1, adler2, length2):
+    """
+    Adler-32 of two byte strings joined, from the checksums of each (zlib's adler32_combine)
+    :param adler1: checksum of first string
+    :param adler2: checksum of second string
+    :param length2: length of second string
+    :return: checksum
+    """
+    rem = length2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xffff) + ADLER_BASE - 1) % ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem) % ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+class PngWriter:
+    """
+    Streams RGBA strips to a PNG. Each strip is deflated on its own and ends on a byte boundary (sync flush),
+    so the compressed strips can be joined into the single zlib stream of the image in order.
+    """
+
+    def __init__(self, path, width, height, geo=None):
+        self.file = open(path, 'wb')
+        self.adler = 1  # checksum of no data
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))  # 8 bit RGBA
+        self.first = True
+
+    def write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    @staticmethod
+    def encode(strip, last):
+        """
+        :param strip: (rows, width, 4) array
+        :param last: True for the last strip of the image
+        :return: (compressed data, adler32 of raw data, length of raw data)
+        """
+        compressor = zlib.compressobj(PNG_COMPRESSION, zlib.DEFLATED, -15)  # raw deflate, no zlib header
+        data = []
+        adler = 1
+        for row in strip:  # compressed from the image in place, one row at a time
+            pixels = memoryview(row).cast('B')
+            data.append(compressor.compress(b'\x00'))  # filter type 0 at start of each row
+            data.append(compressor.compress(pixels))
+            adler = zlib.adler32(pixels, zlib.adler32(b'\x00', adler))
+        data.append(compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH))
+        return b''.join(data), adler, strip.shape[0] * (strip.shape[1] * 4 + 1)
+
+    def write(self, encoded):
+        data, adler, length = encoded
+        if self.first:
+            data = b'\x78\x9c' + data  # zlib header
+            self.first = False
+        self.adler = adler32_combine(self.adler, adler, length)
+        self.write_chunk(b'IDAT', data)
+
+    def close(self):
+        try:
+            self.write_chunk(b'IDAT', struct.pack('>I', self.adler))  # end of zlib stream
+            self.write_chunk(b'IEND', b'')
+        finally:
+            self.file.close()
+
+
+class TiffWriter:
+    """
+    Streams RGBA strips to a GeoTIFF with GDAL, which compresses blocks in its own threads
+    """
+
+    def __init__(self, path, width, height, geo=None):
+        if gdal is None:
+            raise ValueError("GDAL python bindings are needed for .tif export")
+
+        options = ['COMPRESS=DEFLATE', 'PHOTOMETRIC=RGB', 'ALPHA=YES', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS']
+        self.dataset = gdal.GetDriverByName('GTiff').Create(str(path), width, height, 4, gdal.GDT_Byte, options)
+        self.width = width
+        self.row = 0
+
+        if geo is not None:
+            transform, wkt = geo
+            self.dataset.SetGeoTransform(transform)
+            self.dataset.SetProjection(wkt)
+
+    @staticmethod
+    def encode(strip, last):
+        return strip
+
+    def write(self, strip):
+        self.dataset.WriteRaster(0, self.row, self.width, strip.shape[0], memoryview(strip).cast('B'),
+                                 buf_pixel_space=4, buf_line_space=self.width * 4, buf_band_space=1)
+        self.row += strip.shape[0]
+
+    def close(self):
+        self.dataset.FlushCache()
+        self.dataset = None  # closes file
+
+
+def get_writer(path, width, height, geo=None):
+    """
+    :param path: output path, format from suffix
+    :param width: px
+    :param height: px
+    :param geo: optional (GDAL geotransform, CRS wkt)
+    :return: PngWriter or TiffWriter
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix not in FORMATS:
+        raise ValueError("raster export supports {0}, not '{1}'".format(', '.join(FORMATS), suffix))
+    if suffix == '.png':
+        return PngWriter(path, width, height, geo)
+    return TiffWriter(path, width, height, geo)
+
+
+def get_georeference(exporter, layout, dpi):
+    """
+    :param exporter: QgsLayoutExporter
+    :param layout:
+    :param dpi:
+    :return: (GDAL geotransform, CRS wkt) of first page from reference map, or None if layout has no map
+    """
+    reference_map = layout.referenceMap()
+    if reference_map is None:
+        return None
+
+    a, b, c, d, e, f = exporter.computeWorldFileParameters(dpi)
+    return [c, a, b, f, d, e], reference_map.crs().toWkt()
+
+
+def export_tiled(layout, path, dpi=DEFAULT_DPI, page=0, max_strip_bytes=MAX_STRIP_BYTES,
+                 max_pending_bytes=MAX_PENDING_BYTES, workers=DEFAULT_WORKERS):
+    """
+    Export a page of a layout to a .tif or .png in strips. the dpi of the layout is only changed during export
+    :param layout:
+    :param path: output path, format from suffix
+    :param dpi:
+    :param page: index of page
+    :param max_strip_bytes: bytes of one rendered strip
+    :param max_pending_bytes: bytes of strips rendered but not yet written, at least one strip is held
+    :param workers: number of encoding threads
+    :return: (width, height) of image in px
+    """
+    path = Path(path)
+    exporter = QgsLayoutExporter(layout)
+    region = get_page_region(layout, page)
+    width = int(round(region.width() / 25.4 * dpi))
+    height = int(round(region.height() / 25.4 * dpi))
+    rows = get_strip_rows(width, height, max_strip_bytes)
+    mm_per_row = region.height() / height
+    px_per_mm = (width / region.width(), height / region.height())
+
+    geo = get_georeference(exporter, layout, dpi) if page == 0 else None
+    partial_path = path.parent / '.{0}-{1}{2}'.format(path.stem, uuid.uuid4().hex, path.suffix)
+    writer = get_writer(partial_path, width, height, geo)
+    runs = get_runs(layout)
+    pending = deque()  # (future, image, bytes) of strips being encoded, written in order
+    pending_bytes = 0
+
+    context = layout.renderContext()
+    layout_dpi = context.dpi()
+    context.setDpi(dpi)  # sizes of items drawn in pixels, e.g. map and picture resolution
+    try:
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for top in range(0, height, rows):
+                    n = min(rows, height - top)
+                    strip_region = QRectF(region.x(), region.y() + top * mm_per_row, region.width(), n * mm_per_row)
+                    image, strip = render_strip(exporter, layout, runs, strip_region, width, n, dpi, px_per_mm)
+                    pending.append((pool.submit(writer.encode, strip, top + n == height), image, strip.nbytes))
+                    pending_bytes += strip.nbytes
+
+                    while pending and pending_bytes > max_pending_bytes:
+                        future, image, nbytes = pending.popleft()
+                        writer.write(future.result())
+                        pending_bytes -= nbytes
+
+                while pending:
+                    future, image, nbytes = pending.popleft()
+                    writer.write(future.result())
+        finally:
+            context.setDpi(layout_dpi)
+            set_visible(runs, None)
+            writer.close()
+        os.replace(str(partial_path), str(path))
+    except BaseException:
+        if partial_path.exists():  # never leave a truncated image
+            partial_path.unlink()
+        raise
+
+    logging.info("exported {0}x{1} px in strips of {2} rows to {3}".format(width, height, rows, path))
+    return width, height
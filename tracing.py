@@ -0,0 +1,177 @@
+"""
+    Lightweight timing of pipeline stages with a machine readable report
+
+    A trace is started for each layout, stages of the layout are timed with span() and counts (features,
+    vertices, pages, ...) are recorded with count(). end_trace() returns the report as a dict:
+        {"name": "farm.json", "seconds": 12.3, "process_peak_rss_mb": 410.2,
+         "stages": {"layer": 0.4, "table": 1.2, "export": 8.1, ...},
+         "memory": {"layer": 35.0, "export": 210.4, ...},
+         "counts": {"features": 120, "vertices": 35120}}
+    A stage timed more than once in a layout (e.g. style, once per colour code) is reported as its total.
+    Time of a span nested in another (e.g. modify inside layer) only counts towards the inner stage,
+    so stages are never counted twice.
+    "memory" is how much each stage raised the peak RSS of the process in MB, the stages which set the peak.
+
+    The peak RSS of a report is the peak of the whole process up to the end of the run. In a batch run in one
+    process, farms after the largest one show its peak, the batch total is the peak of the batch.
+
+    Spans outside a trace are still passed to listeners (e.g. to report progress) but are not recorded.
+    Peak RSS is None where the resource module is missing (Windows).
+"""
+import sys
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CURRENT_TRACE = None  # report of the layout being traced, or None
+ACTIVE_SPANS = []  # [stage, seconds, peak RSS growth in MB of nested spans] of running spans, innermost last
+LISTENERS = []  # callables taking (event, stage, seconds), event is 'start' or 'end'
+
+
+def get_peak_rss():
+    """
+    :return: peak resident memory of this process in MB, or None if unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def add_listener(listener):
+    LISTENERS.append(listener)
+
+
+def remove_listener(listener):
+    if listener in LISTENERS:
+        LISTENERS.remove(listener)
+
+
+def notify(event, stage, seconds=None):
+    for listener in LISTENERS:
+        listener(event, stage, seconds)
+
+
+def start_trace(name):
+    """
+    :param name: name of traced run, e.g. farm file
+    :return:
+    """
+    global CURRENT_TRACE
+    CURRENT_TRACE = {'name': name, 'start': time.perf_counter(), 'stages': {}, 'memory': {}, 'counts': {}}
+
+
+def is_tracing():
+    return CURRENT_TRACE is not None
+
+
+def end_trace():
+    """
+    :return: report of current trace, or None if nothing was traced
+    """
+    global CURRENT_TRACE
+    if CURRENT_TRACE is None:
+        return None
+
+    report = CURRENT_TRACE
+    CURRENT_TRACE = None
+    report['seconds'] = time.perf_counter() - report.pop('start')
+    report['process_peak_rss_mb'] = get_peak_rss()
+
+    return report
+
+
+@contextmanager
+def span(stage):
+    """
+    Time a stage of the pipeline
+        with tracing.span('export'):
+            exporter.exportToPdf(...)
+    :param stage: name of stage
+    :return:
+    """
+    notify('start', stage)
+    start = time.perf_counter()
+    start_peak = get_peak_rss()
+    ACTIVE_SPANS.append([stage, 0.0, 0.0])
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        growth = get_peak_rss() - start_peak if start_peak is not None else 0.0
+        nested_seconds, nested_growth = ACTIVE_SPANS.pop()[1:]
+        if ACTIVE_SPANS:
+            ACTIVE_SPANS[-1][1] += seconds
+            ACTIVE_SPANS[-1][2] += growth
+        if CURRENT_TRACE is not None:
+            stages = CURRENT_TRACE['stages']
+            stages[stage] = stages.get(stage, 0) + seconds - nested_seconds
+            memory = CURRENT_TRACE['memory']
+            memory[stage] = memory.get(stage, 0) + growth - nested_growth
+        logging.debug("{0}: {1:.3f}s".format(stage, seconds))
+        notify('end', stage, seconds)
+
+
+def count(name, value):
+    """
+    Record a count in the current trace, e.g. number of features
+    :param name:
+    :param value:
+    :return:
+    """
+    if CURRENT_TRACE is not None:
+        CURRENT_TRACE['counts'][name] = value
+
+
+def aggregate(reports):
+    """
+    Combine reports of a batch
+    :param reports: list of reports from end_trace
+    :return: dict with totals, per stage total, mean and max seconds and largest memory growth,
+        reports of each run included
+    """
+    stages = {}
+    for report in reports:
+        for stage, seconds in report['stages'].items():
+            stages.setdefault(stage, []).append(seconds)
+
+    memory = {}
+    for report in reports:
+        for stage, mb in report.get('memory', {}).items():
+            memory[stage] = max(memory.get(stage, 0), mb)
+
+    counts = {}
+    for report in reports:
+        for name, value in report['counts'].items():
+            counts[name] = counts.get(name, 0) + value
+
+    peaks = [r['process_peak_rss_mb'] for r in reports if r['process_peak_rss_mb'] is not None]
+
+    return {
+        'runs': len(reports),
+        'seconds': sum(r['seconds'] for r in reports),
+        'peak_rss_mb': max(peaks) if peaks else None,
+        'stages': {stage: {'total': sum(s), 'mean': sum(s) / len(s), 'max': max(s)}
+                   for stage, s in stages.items()},
+        'memory': memory,  # largest peak RSS growth of each stage in MB
+        'counts': counts,
+        'reports': reports,
+    }
+
+
+def write_report(report, path):
+    """
+    :param report: report or aggregated report
+    :param path: path of .json file
+    :return:
+    """
+    with open(path, 'w') as data:
+        json.dump(report, data, indent=2)
+    logging.info("run report written to {0}".format(path))
@@ -0,0 +1,70 @@
+"""
+    Coordinate reference systems and transforms shared by all layouts of a process
+
+    CRS and transform objects are created once per authority id / (source, destination) pair and reused,
+    so a batch of farms, or several map items of one farm, don't construct them again for every extent.
+    Transforms use a default transform context rather than a project's, so they stay valid after the project
+    they were first used with is cleared.
+
+    Maps are drawn in the WGS 84 / UTM zone of the farm, worked out from the centre of the farm layer.
+"""
+from functools import lru_cache
+from qgis.core import *
+
+WGS84 = 'EPSG:4326'
+
+
+@lru_cache(maxsize=None)
+def get_crs(authid):
+    """
+    :param authid: authority id, e.g. 'EPSG:4326'
+    :return: QgsCoordinateReferenceSystem
+    """
+    crs = QgsCoordinateReferenceSystem(authid)
+    if not crs.isValid():
+        raise ValueError("invalid coordinate reference system '{0}'".format(authid))
+    return crs
+
+
+@lru_cache(maxsize=None)
+def get_transform(src, dst):
+    """
+    :param src: authority id of source CRS
+    :param dst: authority id of destination CRS
+    :return: QgsCoordinateTransform
+    """
+    return QgsCoordinateTransform(get_crs(src), get_crs(dst), QgsCoordinateTransformContext())
+
+
+def get_utm_authid(lon, lat):
+    """
+    :param lon: longitude in degrees
+    :param lat: latitude in degrees
+    :return: authority id of WGS 84 / UTM zone containing point, EPSG:326xx north, EPSG:327xx south
+    """
+    zone = min(max(int((lon + 180) // 6) + 1, 1), 60)
+    return 'EPSG:{0}{1:02d}'.format(326 if lat >= 0 else 327, zone)
+
+
+def get_layer_utm_authid(l):
+    """
+    :param l: vector layer
+    :return: authority id of UTM zone containing centre of layer extent
+    """
+    centre = l.extent().center()
+    if l.crs().authid() != WGS84:
+        centre = get_transform(l.crs().authid(), WGS84).transform(centre)
+    return get_utm_authid(centre.x(), centre.y())
+
+
+def transform_rect(rect, src, dst):
+    """
+    :param rect: QgsRectangle in src
+    :param src: authority id of source CRS
+    :param dst: authority id of destination CRS
+    :return: QgsRectangle in dst bounding transformed rect
+    """
+    if src == dst:
+        return QgsRectangle(rect)
+    return get_transform(src, dst).transformBoundingBox(rect)
+